@@ -18,15 +18,37 @@ def handle_client(conn, addr):
         conn.sendall(str(result).encode('utf-8'))
     conn.close()
 
-def start_server(host='127.0.0.1', port=65432):
+def reject_client(conn, addr):
+    print(f"Server busy, turning away {addr}")
+    conn.sendall("Server busy, try again later".encode('utf-8'))
+
+def serve_client(conn, addr, slots):
+    try:
+        handle_client(conn, addr)
+    finally:
+        slots.release()
+
+def start_server(host='127.0.0.1', port=65432, max_clients=32):
+    # At most max_clients threads at once, later clients are told to retry
+    slots = threading.BoundedSemaphore(max_clients)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.bind((host, port))
         s.listen()
         print(f"Server listening on {host}:{port}")
-        while True:
-            conn, addr = s.accept()
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-            client_thread.start()
+        try:
+            while True:
+                conn, addr = s.accept()
+                if not slots.acquire(blocking=False):
+                    try:
+                        reject_client(conn, addr)
+                    except OSError:
+                        pass
+                    conn.close()
+                    continue
+                client_thread = threading.Thread(target=serve_client, args=(conn, addr, slots))
+                client_thread.start()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
 
 if __name__ == "__main__":
     start_server()
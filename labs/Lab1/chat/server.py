@@ -32,17 +32,41 @@ def handle_client(client_socket, client_address):
         clients.remove(client_socket)
         client_socket.close()
 
-def start_server(host='127.0.0.1', port=65432):
+def reject_client(client_socket, client_address):
+    """Tell a client the chat room is full."""
+    print(f"Chat full, turning away {client_address}")
+    client_socket.send("Server busy, try again later".encode('utf-8'))
+
+def serve_client(client_socket, client_address, slots):
+    """Handle a client and free its slot once it leaves."""
+    try:
+        handle_client(client_socket, client_address)
+    finally:
+        slots.release()
+
+def start_server(host='127.0.0.1', port=65432, max_clients=64):
     """Start the chat server."""
+    # Each chat session holds a slot for as long as it lasts
+    slots = threading.BoundedSemaphore(max_clients)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         server_socket.bind((host, port))
         server_socket.listen()
         print(f"Server listening on {host}:{port}")
 
-        while True:
-            client_socket, client_address = server_socket.accept()
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
-            client_thread.start()
+        try:
+            while True:
+                client_socket, client_address = server_socket.accept()
+                if not slots.acquire(blocking=False):
+                    try:
+                        reject_client(client_socket, client_address)
+                    except OSError:
+                        pass
+                    client_socket.close()
+                    continue
+                client_thread = threading.Thread(target=serve_client, args=(client_socket, client_address, slots))
+                client_thread.start()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
 
 if __name__ == "__main__":
     start_server()
@@ -0,0 +1,102 @@
+"""Compare the message codecs on directory listings.
+
+Builds an `ls` reply of each server with the given number of entries,
+shaped like the real ones:
+  nfs    - every entry has name, is_dir and size
+  bigfs  - files have name, type and size; directories have no size
+
+and reports the encoded size, raw and after zlib level 1 (the frame
+compression), and the best encode and decode time of several rounds.
+
+Usage: python bench_codecs.py [--entries 10000] [--rounds 20] [--codecs compact json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.serialization import CODECS, available
+
+
+def nfs_listing(entries):
+    files = []
+    for i in range(entries):
+        is_dir = random.random() < 0.1
+        files.append({
+            'name': f'dir_{i}' if is_dir else f'file_{i}_{random.randrange(10 ** 6)}.dat',
+            'is_dir': is_dir,
+            'size': 4096 if is_dir else random.randrange(1 << 34),
+        })
+    return {'status': 'success', 'files': files, 'next_cursor': None}
+
+
+def bigfs_listing(entries):
+    files = []
+    for i in range(entries):
+        if random.random() < 0.1:
+            files.append({"name": f"pasta_{i}", "type": "directory"})
+        else:
+            files.append({"name": f"relatório_{i}.pdf", "type": "file", "size": random.randrange(1 << 34)})
+    return {
+        "status": "success",
+        "type": "directory",
+        "files": files,
+        "next_cursor": None,
+        "message": "Contents of root directory:",
+    }
+
+
+def best_time(function, argument, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(codec, listing, message, rounds):
+    payload = codec.encode(message)
+    if codec.decode(payload) != message:
+        raise AssertionError(f'{codec.name} does not round-trip the {listing} listing')
+    return {
+        'codec': codec.name,
+        'listing': listing,
+        'entries': len(message['files']),
+        'bytes': len(payload),
+        'zlib_bytes': len(zlib.compress(payload, 1)),
+        'encode_ms': best_time(codec.encode, message, rounds) * 1000,
+        'decode_ms': best_time(codec.decode, payload, rounds) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Message codec benchmark')
+    parser.add_argument('--entries', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--codecs', nargs='+', default=available(), choices=list(CODECS))
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    random.seed(0)
+    listings = {'nfs': nfs_listing(args.entries), 'bigfs': bigfs_listing(args.entries)}
+    results = []
+    print(f"{'listing':>8} {'codec':>8} {'bytes':>10} {'zlib':>10} {'encode':>10} {'decode':>10}")
+    for listing, message in listings.items():
+        for name in args.codecs:
+            result = bench(CODECS[name], listing, message, args.rounds)
+            results.append(result)
+            print(f"{listing:>8} {name:>8} {result['bytes']:>10} {result['zlib_bytes']:>10} "
+                  f"{result['encode_ms']:>8.2f}ms {result['decode_ms']:>8.2f}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
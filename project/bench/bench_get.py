@@ -0,0 +1,173 @@
+"""Compare BigFS download throughput and CPU use across transfer modes.
+
+Modes:
+  hex       - the original protocol: whole file hex-encoded inside one JSON reply
+  buffered  - streamed frames copied through a user-space buffer
+  sendfile  - streamed frames sent with os.sendfile (zero-copy)
+
+Each run starts a fresh FileServer process so its CPU time can be read from
+RUSAGE_CHILDREN once it exits.
+
+Usage: python bench_get.py [--sizes 1M 100M 1G] [--modes hex buffered sendfile]
+"""
+import argparse
+import binascii
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'entrega_1'))
+from common.protocol import Connection
+from server import FileServer
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    if text[-1].upper() in UNITS:
+        return int(text[:-1]) * UNITS[text[-1].upper()]
+    return int(text)
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            n = min(len(block), remaining)
+            f.write(block[:n])
+            remaining -= n
+
+
+class HexFileServer(FileServer):
+    """FileServer answering `get` the way it did before streaming existed"""
+
+    def handle_client(self, client_socket, address):
+        try:
+            data = client_socket.recv(4096).decode('utf-8')
+            path = os.path.join(self.root_dir, json.loads(data)['path'])
+            with open(path, 'rb') as f:
+                content = f.read()
+            client_socket.sendall(json.dumps({
+                "status": "success",
+                "type": "file",
+                "name": os.path.basename(path),
+                "content": content.hex()
+            }).encode('utf-8'))
+        finally:
+            client_socket.close()
+
+
+def run_server(mode, port, root_dir, ready):
+    sys.stdout = open(os.devnull, 'w')
+    server_class = HexFileServer if mode == 'hex' else FileServer
+    server = server_class(port=port, root_dir=root_dir, use_sendfile=(mode == 'sendfile'))
+    server.server_socket.bind((server.host, server.port))
+    server.server_socket.listen(5)
+    ready.set()
+    while True:
+        client_socket, address = server.server_socket.accept()
+        server.handle_client(client_socket, address)
+
+
+def download(mode, port, name):
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        if mode == 'hex':
+            sock.sendall(json.dumps({"command": "get", "path": name}).encode('utf-8'))
+            parts = []
+            while True:
+                packet = sock.recv(1024 * 1024)
+                if not packet:
+                    break
+                parts.append(packet)
+            response = json.loads(b''.join(parts).decode('utf-8'))
+            return len(binascii.unhexlify(response['content']))
+
+        conn = Connection(sock)
+        conn.send_message({"command": "get", "path": name})
+        conn.recv_message()
+        received = 0
+        while True:
+            chunk = conn.recv_frame()
+            if not chunk:
+                return received
+            received += len(chunk)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench(mode, size, root_dir, name):
+    port = free_port()
+    ready = multiprocessing.Event()
+    before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    before_self = resource.getrusage(resource.RUSAGE_SELF)
+    server = multiprocessing.Process(target=run_server, args=(mode, port, root_dir, ready))
+    server.start()
+    ready.wait()
+
+    start = time.perf_counter()
+    received = download(mode, port, name)
+    elapsed = time.perf_counter() - start
+
+    server.terminate()
+    server.join()
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    after_self = resource.getrusage(resource.RUSAGE_SELF)
+
+    server_cpu = (after_children.ru_utime + after_children.ru_stime) - (before_children.ru_utime + before_children.ru_stime)
+    client_cpu = (after_self.ru_utime + after_self.ru_stime) - (before_self.ru_utime + before_self.ru_stime)
+    return {
+        'mode': mode,
+        'size': size,
+        'ok': received == size,
+        'seconds': elapsed,
+        'mb_per_s': size / elapsed / UNITS['M'],
+        'server_cpu': server_cpu,
+        'client_cpu': client_cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BigFS get benchmark')
+    parser.add_argument('--sizes', nargs='+', default=['1M', '100M', '1G'])
+    parser.add_argument('--modes', nargs='+', default=['hex', 'buffered', 'sendfile'],
+                        choices=['hex', 'buffered', 'sendfile'])
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as root_dir:
+        print(f"{'size':>8} {'mode':>9} {'MB/s':>10} {'server cpu':>11} {'client cpu':>11}")
+        for size_text in args.sizes:
+            size = parse_size(size_text)
+            name = f'bench_{size_text}.bin'
+            make_file(os.path.join(root_dir, name), size)
+            for mode in args.modes:
+                try:
+                    result = bench(mode, size, root_dir, name)
+                except MemoryError:
+                    print(f"{size_text:>8} {mode:>9}   out of memory")
+                    continue
+                results.append(result)
+                flag = '' if result['ok'] else '  (incomplete)'
+                print(f"{size_text:>8} {mode:>9} {result['mb_per_s']:>10.1f} "
+                      f"{result['server_cpu']:>10.2f}s {result['client_cpu']:>10.2f}s{flag}")
+            os.remove(os.path.join(root_dir, name))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""Reproducible load benchmarks for the BigFS and NFS servers.
+
+Starts a fresh server process (entrega_1/server.py or entrega_2/server.py)
+on a free local port for every step, drives it with one workload from
+`--clients` concurrent connections and reports throughput, latency
+percentiles and the server's peak memory and CPU time. Workloads:
+  ls     - listing a directory of 100 small files, back to back
+  get    - downloading one large file (`--file-size`), get or read
+  mixed  - copying a small file to a new name, then deleting the copy
+
+Results are printed and saved as JSON under results/, named after the
+git commit of the tree under test, so runs can be compared across commits.
+`--tree` points the suite at another checkout, such as an older commit in
+a git worktree:
+
+    python bench_suite.py --servers bigfs nfs --workloads ls get mixed --clients 1 16
+    python bench_suite.py --tree /tmp/old/project --output results/old.json
+    python bench_suite.py --compare results/old.json results/new.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, '..'))
+from common.protocol import Connection
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+SMALL_FILES = 100
+
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+
+def parse_size(text):
+    if text[-1].upper() in UNITS:
+        return int(text[:-1]) * UNITS[text[-1].upper()]
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_commit(tree):
+    """Short commit of the tree, with '-dirty' if it has uncommitted changes"""
+    def git(*args):
+        return subprocess.run(['git', '-C', tree, *args], capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('-dirty' if git('status', '--porcelain', '--untracked-files=no', '--', '.') else '')
+
+
+def make_tree(root_dir, large_file):
+    """The files every workload uses: small files to list and copy, and a
+    hard link to the large file to download"""
+    os.makedirs(root_dir)
+    for i in range(SMALL_FILES):
+        with open(os.path.join(root_dir, f'file_{i}.txt'), 'wb') as f:
+            f.write(b'x' * 1024)
+    os.link(large_file, os.path.join(root_dir, 'large.bin'))
+
+
+def start_server(tree, kind, engine, port, root_dir, work_dir, clients):
+    # The thread engine starts one thread per allowed connection up front
+    limit = str(max(clients, 256))
+    if kind == 'bigfs':
+        command = [sys.executable, os.path.join(tree, 'entrega_1', 'server.py'), '--port', str(port),
+                   '--root', root_dir, '--engine', engine, '--max-connections', limit]
+    else:
+        command = [sys.executable, os.path.join(tree, 'entrega_2', 'server.py'), '--host', '127.0.0.1',
+                   '--port', str(port), '--export-dir', root_dir, '--engine', engine,
+                   '--max-connections', limit]
+    # The NFS server writes its log to the working directory, kept out of the export
+    process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+
+def process_usage(pid):
+    """Peak resident memory in bytes and CPU seconds of a process so far"""
+    with open(f'/proc/{pid}/status') as f:
+        peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rpartition(')')[2].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return peak, (int(fields[11]) + int(fields[12])) / ticks
+
+
+def requests_for(kind, workload, client, n):
+    """The (operation, request) pairs of one iteration of a workload"""
+    if kind == 'bigfs':
+        if workload == 'ls':
+            return [('ls', {'command': 'ls', 'path': ''})]
+        if workload == 'get':
+            return [('get', {'command': 'get', 'path': 'large.bin'})]
+        name = f'copy_{client}_{n}.txt'
+        return [('copy', {'command': 'cp', 'source': 'file_0.txt', 'destination': name}),
+                ('delete', {'command': 'rm', 'path': name})]
+    if workload == 'ls':
+        return [('ls', {'command': 'ls', 'args': ['remoto:/']})]
+    if workload == 'get':
+        return [('get', {'command': 'read', 'args': ['remoto:/large.bin']})]
+    name = f'remoto:/copy_{client}_{n}.txt'
+    return [('copy', {'command': 'copy', 'args': ['remoto:/file_0.txt', name]}),
+            ('delete', {'command': 'delete', 'args': [name]})]
+
+
+def exchange(conn, operation, request):
+    """Send a request and read its answer, returns (ok, bytes of file data)"""
+    conn.send_message(request)
+    response = conn.recv_message()
+    if response is None:
+        raise ConnectionError('Connection closed by server')
+    ok = response.get('status') == 'success'
+    received = 0
+    if operation == 'get' and ok:
+        while True:
+            chunk = conn.recv_frame()
+            if not chunk:
+                break
+            received += len(chunk)
+    return ok, received
+
+
+def client(port, kind, workload, index, start_at, stop_at, samples, errors):
+    """Run one workload back to back, keeping samples taken after start_at"""
+    conn = None
+    try:
+        conn = Connection(socket.create_connection(('127.0.0.1', port)))
+        n = 0
+        while time.perf_counter() < stop_at:
+            for operation, request in requests_for(kind, workload, index, n):
+                started = time.perf_counter()
+                ok, received = exchange(conn, operation, request)
+                if started >= start_at:
+                    samples.append((operation, time.perf_counter() - started, received))
+                    if not ok:
+                        errors.append(operation)
+            n += 1
+    except OSError:
+        # A dropped connection ends this client and counts as one error
+        errors.append('connection')
+    finally:
+        if conn:
+            conn.close()
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    summary = {'requests': len(latencies)}
+    for name, fraction in PERCENTILES:
+        summary[f'{name}_ms'] = latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+    summary['max_ms'] = latencies[-1] * 1000
+    return summary
+
+
+def run_step(tree, kind, engine, workload, clients, duration, warmup, large_file, scratch):
+    root_dir = os.path.join(scratch, 'root')
+    make_tree(root_dir, large_file)
+    port = free_port()
+    server = start_server(tree, kind, engine, port, root_dir, scratch, clients)
+    samples, errors = [], []
+    try:
+        start_at = time.perf_counter() + warmup
+        stop_at = start_at + duration
+        _, cpu_before = process_usage(server.pid)
+        threads = [threading.Thread(target=client, args=(port, kind, workload, i, start_at, stop_at, samples, errors))
+                   for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        peak, cpu_after = process_usage(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(root_dir)
+
+    result = {
+        'server': kind,
+        'engine': engine,
+        'workload': workload,
+        'clients': clients,
+        'seconds': duration,
+        'errors': len(errors),
+        'requests_per_s': len(samples) / duration,
+        'mb_per_s': sum(received for _, _, received in samples) / duration / UNITS['M'],
+        'server_peak_rss_mb': peak / UNITS['M'],
+        'server_cpu_s': cpu_after - cpu_before,
+    }
+    if samples:
+        result.update(summarize([latency for _, latency, _ in samples]))
+        result['operations'] = {operation: summarize([latency for op, latency, _ in samples if op == operation])
+                                for operation in sorted({op for op, _, _ in samples})}
+    return result
+
+
+def print_result(result):
+    print(f"{result['server']:>6} {result['engine']:>8} {result['workload']:>6} {result['clients']:>7} "
+          f"{result['requests_per_s']:>9.0f} {result['mb_per_s']:>8.1f} {result.get('p50_ms', 0):>8.2f} "
+          f"{result.get('p99_ms', 0):>8.2f} {result.get('p999_ms', 0):>8.2f} {result['errors']:>6} "
+          f"{result['server_peak_rss_mb']:>7.1f}MB {result['server_cpu_s']:>6.2f}s")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda result: (result['server'], result['engine'], result['workload'], result['clients'])
+    before = {key(result): result for result in old['results']}
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'server':>6} {'engine':>8} {'load':>6} {'clients':>7} {'req/s':>19} {'p99 ms':>21} {'rss MB':>17}")
+    for result in new['results']:
+        base = before.get(key(result))
+        if not base:
+            continue
+        change = lambda a, b: f'{(b - a) / a * 100:+.0f}%' if a else 'n/a'
+        print(f"{result['server']:>6} {result['engine']:>8} {result['workload']:>6} {result['clients']:>7} "
+              f"{base['requests_per_s']:>7.0f} {result['requests_per_s']:>7.0f} "
+              f"{change(base['requests_per_s'], result['requests_per_s']):>4} "
+              f"{base.get('p99_ms', 0):>7.2f} {result.get('p99_ms', 0):>7.2f} "
+              f"{change(base.get('p99_ms', 0), result.get('p99_ms', 0)):>5} "
+              f"{base['server_peak_rss_mb']:>5.0f} {result['server_peak_rss_mb']:>5.0f} "
+              f"{change(base['server_peak_rss_mb'], result['server_peak_rss_mb']):>5}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File server benchmark suite')
+    parser.add_argument('--tree', default=os.path.join(BENCH_DIR, '..'),
+                        help='Project directory holding entrega_1 and entrega_2 (default: this checkout)')
+    parser.add_argument('--servers', nargs='+', default=['bigfs', 'nfs'], choices=['bigfs', 'nfs'])
+    parser.add_argument('--engines', nargs='+', default=['thread'], choices=['thread', 'asyncio'])
+    parser.add_argument('--workloads', nargs='+', default=['ls', 'get', 'mixed'], choices=['ls', 'get', 'mixed'])
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 16], help='Concurrent connections per step')
+    parser.add_argument('--duration', type=float, default=5.0, help='Measured seconds per step')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Seconds run before measuring')
+    parser.add_argument('--file-size', default='64M', help='Size of the file of the get workload')
+    parser.add_argument('--output', help='JSON file for the results (default: results/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    tree = os.path.abspath(args.tree)
+    commit = git_commit(tree)
+    run = {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': f'{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs',
+        'config': {key: getattr(args, key) for key in ('servers', 'engines', 'workloads', 'clients',
+                                                       'duration', 'warmup', 'file_size')},
+        'results': [],
+    }
+
+    print(f"Benchmarking {tree} at {commit}")
+    print(f"{'server':>6} {'engine':>8} {'load':>6} {'clients':>7} {'req/s':>9} {'MB/s':>8} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'p999 ms':>8} {'errors':>6} {'peak rss':>9} {'cpu':>7}")
+    with tempfile.TemporaryDirectory() as scratch:
+        large_file = os.path.join(scratch, 'large.bin')
+        with open(large_file, 'wb') as f:
+            remaining = parse_size(args.file_size)
+            block = os.urandom(UNITS['M'])
+            while remaining:
+                remaining -= f.write(block[:min(len(block), remaining)])
+        for kind in args.servers:
+            for engine in args.engines:
+                for workload in args.workloads:
+                    for clients in args.clients:
+                        result = run_step(tree, kind, engine, workload, clients, args.duration, args.warmup,
+                                          large_file, scratch)
+                        run['results'].append(result)
+                        print_result(result)
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Connection count versus latency for the thread and asyncio server engines.
+
+Starts the BigFS or NFS server in a subprocess for each engine, opens an
+increasing number of concurrent client connections that each issue `ls`
+requests back to back, and reports throughput, latency percentiles and
+the server's memory and thread count.
+
+Usage: python loadtest.py [--server bigfs|nfs] [--connections 10 100 1000] [--duration 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, engine, port, root_dir):
+    if kind == 'bigfs':
+        command = [sys.executable, os.path.join(PROJECT_DIR, 'entrega_1', 'server.py'),
+                   '--port', str(port), '--root', root_dir, '--engine', engine,
+                   '--max-connections', '100000']
+    else:
+        command = [sys.executable, os.path.join(PROJECT_DIR, 'entrega_2', 'server.py'),
+                   '--host', '127.0.0.1', '--port', str(port), '--export-dir', root_dir,
+                   '--engine', engine, '--max-connections', '100000']
+    process = subprocess.Popen(command, cwd=root_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f'{kind} server did not start')
+
+
+def process_status(pid):
+    """Resident memory in kB and thread count of a process"""
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                status[key] = int(value.split()[0])
+    return status
+
+
+def ls_request(kind):
+    request = {'command': 'ls', 'path': ''} if kind == 'bigfs' else {'command': 'ls', 'args': ['remoto:']}
+    payload = json.dumps(request).encode('utf-8')
+    return struct.pack('!I', len(payload)) + payload
+
+
+async def client(port, request, stop_at, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            writer.write(request)
+            (length,) = struct.unpack('!I', await reader.readexactly(4))
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def sample_peak(pid, peak, stop_at):
+    while time.perf_counter() < stop_at:
+        for key, value in process_status(pid).items():
+            peak[key] = max(peak.get(key, 0), value)
+        await asyncio.sleep(0.1)
+
+
+async def drive(port, pid, kind, connections, duration):
+    request = ls_request(kind)
+    latencies = []
+    peak = {}
+    stop_at = time.perf_counter() + duration
+    sampler = asyncio.create_task(sample_peak(pid, peak, stop_at))
+    results = await asyncio.gather(*[client(port, request, stop_at, latencies) for _ in range(connections)],
+                                   return_exceptions=True)
+    await sampler
+    errors = sum(isinstance(r, Exception) for r in results)
+    return latencies, errors, peak
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File server load test')
+    parser.add_argument('--server', choices=['bigfs', 'nfs'], default='bigfs')
+    parser.add_argument('--engines', nargs='+', default=['thread', 'asyncio'])
+    parser.add_argument('--connections', nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per step')
+    args = parser.parse_args()
+
+    # Both ends need one descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f"{'engine':>8} {'conns':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} "
+          f"{'errors':>6} {'peak rss':>10} {'threads':>7}")
+    for engine in args.engines:
+        with tempfile.TemporaryDirectory() as root_dir:
+            for i in range(50):
+                with open(os.path.join(root_dir, f'file_{i}.txt'), 'w') as f:
+                    f.write('x' * i)
+            port = free_port()
+            server = start_server(args.server, engine, port, root_dir)
+            try:
+                for connections in args.connections:
+                    latencies, errors, peak = asyncio.run(
+                        drive(port, server.pid, args.server, connections, args.duration))
+                    latencies.sort()
+                    print(f"{engine:>8} {connections:>6} {len(latencies) / args.duration:>9.0f} "
+                          f"{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f} "
+                          f"{percentile(latencies, 0.999) * 1000:>8.2f} {errors:>6} "
+                          f"{peak.get('VmRSS', 0):>7} kB {peak.get('Threads', 0):>7}")
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    main()
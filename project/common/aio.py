@@ -0,0 +1,263 @@
+"""asyncio engine for the file servers.
+
+Speaks the same framed protocol as protocol.Connection, but serves every
+client from one event loop instead of one OS thread per connection. The
+servers' existing request handlers run unchanged on a bounded thread pool,
+so blocking filesystem calls never stall the loop.
+"""
+import asyncio
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import serialization
+from common.compression import COMPRESSED, LENGTH_MASK, MIN_SIZE, Compressor, decompress
+from common.protocol import MAX_FRAME_SIZE, hello_response
+from common.transfer import CHUNK_SIZE, COALESCE_SIZE, CRC_SIZE, read_checked_chunk
+
+
+def _read_compressed(file, size, offset, compressor):
+    chunk = os.pread(file.fileno(), size, offset)
+    if not chunk:
+        return 0, b'', False
+    return (len(chunk),) + compressor.compress(chunk)
+
+
+def _read_checked(file, size, offset, digest, compressor):
+    payload = read_checked_chunk(file, size, offset, digest)
+    if compressor is None or not payload:
+        return len(payload), payload, False
+    return (len(payload),) + compressor.compress(payload)
+
+
+class AsyncConnection:
+    """A stream pair that sends and receives framed messages"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.sock = writer.get_extra_info('socket')
+        # Held while writing a message or a whole file stream, see Connection
+        self.send_lock = asyncio.Lock()
+        # Codecs agreed in the hello handshake, see Connection
+        self.codec = serialization.DEFAULT
+        self.compression = None
+        self.compressor = None
+        # Registry counting the bytes moved and decode timing, see Connection
+        self.metrics = None
+        self.time_decode = False
+        self.decode_seconds = 0.0
+
+    def set_compression(self, codec):
+        self.compression = codec
+        self.compressor = Compressor(codec) if codec else None
+
+    def set_codec(self, name):
+        self.codec = serialization.CODECS[name]
+
+    async def accept_hello(self, request, **fields):
+        """Answer a client's hello and switch to the codecs chosen for it"""
+        response = hello_response(request, **fields)
+        async with self.send_lock:
+            self._write_frame(self.codec.encode(response))
+            await self.writer.drain()
+            self.set_compression(response['compression'])
+            self.set_codec(response['codec'])
+        return response
+
+    async def _read_payload(self, header):
+        (header,) = struct.unpack('!I', header)
+        length = header & LENGTH_MASK
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f'Frame of {length} bytes exceeds the limit')
+        payload = await self.reader.readexactly(length) if length else b''
+        if self.metrics:
+            self.metrics.inc('received_bytes_total', 4 + length)
+        if header & COMPRESSED:
+            return decompress(self.compression, payload, MAX_FRAME_SIZE)
+        return payload
+
+    async def recv_frame(self):
+        return await self._read_payload(await self.reader.readexactly(4))
+
+    async def recv_message(self):
+        """Read one message, or return None if the peer closed the connection
+        cleanly between messages"""
+        try:
+            header = await self.reader.readexactly(4)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise ConnectionError('Connection closed by peer')
+        frame = await self._read_payload(header)
+        if not self.time_decode:
+            return self.codec.decode(frame)
+        started = time.perf_counter()
+        try:
+            return self.codec.decode(frame)
+        finally:
+            self.decode_seconds = time.perf_counter() - started
+
+    async def send_frame(self, payload):
+        async with self.send_lock:
+            self._write_frame(*self._compress(payload))
+            # Waiting for the buffer to drain is what applies backpressure
+            # to a handler producing data faster than the client reads it
+            await self.writer.drain()
+
+    async def send_message(self, message):
+        await self.send_frame(self.codec.encode(message))
+
+    def _compress(self, payload):
+        if self.compressor:
+            return self.compressor.compress(payload)
+        return payload, False
+
+    def _write_frame(self, payload, compressed=False):
+        header = struct.pack('!I', len(payload) | (COMPRESSED if compressed else 0))
+        if self.metrics:
+            self.metrics.inc('sent_bytes_total', 4 + len(payload))
+        if len(payload) <= COALESCE_SIZE:
+            self.writer.write(header + payload)
+        else:
+            self.writer.write(header)
+            self.writer.write(payload)
+
+    def stream_compressor(self):
+        """A compressor for one file stream, see Connection"""
+        return self.compressor.fork() if self.compressor else None
+
+    async def send_file(self, file, offset=0, count=None, use_sendfile=True, executor=None, header=None, end=True,
+                        compressor=None):
+        """Stream an open file as data frames terminated by an empty frame.
+
+        Data frames go out through loop.sendfile, which uses os.sendfile when
+        the platform allows it. Without `use_sendfile` the chunks are read on
+        `executor` and written through the transport. A `header` message, if
+        given, is sent first as part of the same atomic write. With a
+        negotiated codec the chunks are read and compressed on `executor`,
+        unless the first one does not shrink. Without `end` the empty frame
+        is left to the caller and `compressor` may be shared by the files
+        of one stream, see Connection.send_file.
+        """
+        loop = asyncio.get_running_loop()
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        compressor = compressor or self.stream_compressor()
+        sent = 0
+        async with self.send_lock:
+            if header is not None:
+                self._write_frame(*self._compress(self.codec.encode(header)))
+            while sent < count:
+                size = min(CHUNK_SIZE, count - sent)
+                if compressor:
+                    n, payload, compressed = await loop.run_in_executor(
+                        executor, _read_compressed, file, size, offset + sent, compressor)
+                    if not n:
+                        break
+                    self._write_frame(payload, compressed)
+                    await self.writer.drain()
+                    if not sent and not compressed and n >= MIN_SIZE:
+                        # Already compressed data, send the rest as is
+                        compressor = None
+                elif use_sendfile:
+                    self.writer.write(struct.pack('!I', size))
+                    n = await loop.sendfile(self.writer.transport, file, offset + sent, size)
+                    if n != size:
+                        raise ConnectionError('File truncated during transfer')
+                    if self.metrics:
+                        self.metrics.inc('sent_bytes_total', 4 + n)
+                else:
+                    chunk = await loop.run_in_executor(executor, os.pread, file.fileno(), size, offset + sent)
+                    if not chunk:
+                        break
+                    self._write_frame(chunk)
+                    n = len(chunk)
+                    await self.writer.drain()
+                sent += n
+            if end:
+                self._write_frame(b'')
+            await self.writer.drain()
+        return sent
+
+    async def send_file_checked(self, file, offset=0, count=None, digest=None, executor=None, end=True,
+                                compressor=None):
+        """Stream an open file as CRC32-checked data frames.
+
+        Reading, checksumming, hashing into `digest` and compression run on
+        `executor`.
+        """
+        loop = asyncio.get_running_loop()
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        compressor = compressor or self.stream_compressor()
+        sent = 0
+        async with self.send_lock:
+            while sent < count:
+                size = min(CHUNK_SIZE, count - sent)
+                n, payload, compressed = await loop.run_in_executor(
+                    executor, _read_checked, file, size, offset + sent, digest, compressor)
+                if not n:
+                    break
+                self._write_frame(payload, compressed)
+                await self.writer.drain()
+                sent += n - CRC_SIZE
+            if end:
+                self._write_frame(b'')
+            await self.writer.drain()
+        return sent
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncServer:
+    """Accepts connections on a listening socket and runs `handler(conn, address)`
+    for each of them.
+
+    At most `max_connections` clients are served at once; further
+    connections are accepted but not read until a slot frees up, so their
+    requests queue in the kernel instead of in server memory. Blocking work
+    goes through `run_blocking`, which uses a pool of `workers` threads or
+    the server's own `executor` when one is passed.
+    """
+
+    def __init__(self, sock, handler, max_connections=1000, workers=32, executor=None):
+        self.sock = sock
+        self.handler = handler
+        self.max_connections = max_connections
+        self.executor = executor or ThreadPoolExecutor(max_workers=workers)
+        self.slots = None
+        self.active = 0
+
+    async def run_blocking(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def on_connection(self, reader, writer):
+        conn = AsyncConnection(reader, writer)
+        address = writer.get_extra_info('peername')
+        async with self.slots:
+            self.active += 1
+            try:
+                await self.handler(conn, address)
+            finally:
+                self.active -= 1
+                await conn.close()
+
+    async def serve_forever(self):
+        self.slots = asyncio.Semaphore(self.max_connections)
+        server = await asyncio.start_server(self.on_connection, sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve_forever())
+        finally:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,115 @@
+"""Optional per-connection compression of frames.
+
+Client and server agree on a codec in the 'hello' handshake that opens a
+connection. From then on either side may compress any frame on its own and
+marks it by setting the top bit of the frame length, so small frames and
+data that does not shrink still travel as they are. zlib is always
+available; zstd and lz4 are offered when the zstandard or lz4 packages are
+installed.
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Top bit of the frame length: the payload is compressed
+COMPRESSED = 0x80000000
+LENGTH_MASK = 0x7fffffff
+
+# Frames smaller than this are never worth compressing
+MIN_SIZE = 512
+
+# A compressed frame is only sent when it is at most this fraction of the original
+MAX_RATIO = 0.9
+
+# After a frame that did not shrink, the next 1, 2, 4... up to this many
+# frames are sent without trying
+MAX_BACKOFF = 64
+
+
+def _zlib_decompress(data, limit):
+    decompressor = zlib.decompressobj()
+    output = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail:
+        raise ConnectionError('Compressed frame exceeds the size limit')
+    return output
+
+
+def _check_limit(output, limit):
+    if len(output) > limit:
+        raise ConnectionError('Compressed frame exceeds the size limit')
+    return output
+
+
+# name: (factory of a compress function, decompress(data, limit))
+CODECS = {
+    'zlib': (lambda: lambda data: zlib.compress(data, 1), _zlib_decompress),
+}
+if zstandard:
+    CODECS['zstd'] = (
+        lambda: zstandard.ZstdCompressor(level=3).compress,
+        lambda data, limit: _check_limit(zstandard.ZstdDecompressor().decompress(data, max_output_size=limit), limit),
+    )
+if lz4:
+    CODECS['lz4'] = (
+        lambda: lz4.frame.compress,
+        lambda data, limit: _check_limit(lz4.frame.decompress(data), limit),
+    )
+
+# Fastest codecs first; the server picks the first one the client offers
+PREFERENCE = ['lz4', 'zstd', 'zlib']
+
+
+def available():
+    """Names of the codecs usable in this process, in order of preference"""
+    return [name for name in PREFERENCE if name in CODECS]
+
+
+def negotiate(offered):
+    """Pick the codec for a connection from those a client offered, or None"""
+    for name in available():
+        if name in offered:
+            return name
+    return None
+
+
+def decompress(codec, data, limit):
+    if codec not in CODECS:
+        raise ConnectionError('Compressed frame received without a negotiated codec')
+    return CODECS[codec][1](data, limit)
+
+
+class Compressor:
+    """Compresses the frames of one stream, backing off while they do not shrink"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.function = CODECS[codec][0]()
+        self.skip = 0
+        self.backoff = 0
+
+    def compress(self, payload):
+        """Return the bytes to send for `payload` and whether they are compressed"""
+        if len(payload) < MIN_SIZE:
+            return payload, False
+        if self.skip:
+            self.skip -= 1
+            return payload, False
+        data = self.function(payload)
+        if len(data) > len(payload) * MAX_RATIO:
+            self.backoff = min(max(1, self.backoff * 2), MAX_BACKOFF)
+            self.skip = self.backoff
+            return payload, False
+        self.backoff = 0
+        return data, True
+
+    def fork(self):
+        """A compressor with fresh backoff state, for a separate stream such as one file"""
+        return Compressor(self.codec)
@@ -0,0 +1,60 @@
+"""Server-side cache of whole-file SHA-256 digests.
+
+A checked get ends with the digest of the file up to the end of the range,
+so a resumed download used to make the server read back everything the
+client already had. Once a file has been hashed to its end its digest is
+kept here, and a later range reaching the end of the file sends it without
+hashing anything.
+
+Digests are keyed by the file's inode, size, mtime and ctime, so a file
+replaced or written to since is a miss; a file rewritten in place also
+changes its ctime even when its mtime is set back. Files modified within
+RACY_WINDOW are not cached, as a change within the same timestamp tick
+would go unnoticed. Entries are evicted least-recently-used beyond
+`max_entries`.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Files modified this recently are not cached, see the module docstring
+RACY_WINDOW = 1.0
+
+
+def stat_key(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+
+
+class DigestCache:
+    """LRU cache mapping file paths to the hex SHA-256 of their contents"""
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # path -> (stat key, hex digest)
+        self.digests = OrderedDict()
+
+    def get(self, path, stat):
+        """The digest of `path` if cached for the file `stat` describes"""
+        with self.lock:
+            cached = self.digests.get(path)
+            if cached and cached[0] == stat_key(stat):
+                self.digests.move_to_end(path)
+                return cached[1]
+        return None
+
+    def store(self, path, stat, digest):
+        """Cache the digest of the file `stat` was taken from before hashing
+        it, unless `path` has changed since or is too recent to tell"""
+        try:
+            current = os.stat(path)
+        except OSError:
+            return
+        if stat_key(current) != stat_key(stat) or time.time() - current.st_mtime_ns / 1e9 <= RACY_WINDOW:
+            return
+        with self.lock:
+            self.digests.pop(path, None)
+            self.digests[path] = (stat_key(stat), digest)
+            while len(self.digests) > self.max_entries:
+                self.digests.popitem(last=False)
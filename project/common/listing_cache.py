@@ -0,0 +1,111 @@
+"""Server-side cache of directory listings.
+
+A listing is built with a single os.scandir pass: entry types come from the
+directory read itself and only regular files cost one extra stat for their
+size. Cached listings are revalidated against the directory's mtime on
+every lookup (one stat instead of one per entry), dropped explicitly when
+the server itself mutates a path, and evicted least-recently-used once the
+estimated memory use passes `max_bytes`.
+
+The directory mtime only changes when entries are added, removed or
+renamed, so a file rewritten in place by another process keeps its old
+size in the cache for at most `max_age` seconds.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Rough per-entry memory cost of a cached (name, is_dir, size, mtime) tuple
+ENTRY_OVERHEAD = 200
+
+# Listings of directories modified this recently are not cached: a change
+# within the same mtime tick would otherwise go unnoticed
+RACY_WINDOW = 1.0
+
+
+class ListingCache:
+    """LRU cache mapping directory paths to lists of entry tuples
+    (name, is_dir, size, mtime), sorted by name. Directories have size 0.
+    `file_size(path, stat)`, if given, returns the size reported for a
+    file instead of its st_size."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_age=10.0, file_size=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.file_size = file_size
+        self.lock = threading.Lock()
+        # path -> (dir mtime_ns, time cached, estimated bytes, entries)
+        self.listings = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Return the entries of directory `path`, which must be normalized.
+        Raises OSError like os.scandir for missing paths or non-directories."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        now = time.time()
+        with self.lock:
+            cached = self.listings.get(path)
+            if cached and cached[0] == mtime_ns and now - cached[1] < self.max_age:
+                self.listings.move_to_end(path)
+                self.hits += 1
+                return cached[3]
+            self.misses += 1
+
+        entries = self.scan(path)
+        if now - mtime_ns / 1e9 > RACY_WINDOW:
+            self.store(path, mtime_ns, now, entries)
+        return entries
+
+    def scan(self, path):
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir:
+                        entries.append((entry.name, True, 0, 0))
+                    else:
+                        stat = entry.stat()
+                        size = self.file_size(entry.path, stat) if self.file_size else stat.st_size
+                        entries.append((entry.name, False, size, stat.st_mtime))
+                except OSError:
+                    # Broken symlinks and entries removed during the scan
+                    entries.append((entry.name, False, 0, 0))
+        entries.sort()
+        return entries
+
+    def store(self, path, mtime_ns, now, entries):
+        size = sum(ENTRY_OVERHEAD + len(entry[0]) for entry in entries)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.listings.pop(path, None)
+            if old:
+                self.size -= old[2]
+            self.listings[path] = (mtime_ns, now, size, entries)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.listings.popitem(last=False)
+                self.size -= evicted[2]
+
+    def invalidate(self, path):
+        """Drop the listings affected by a mutation of `path`: its parent
+        directory, the path itself and anything cached below it"""
+        parent = os.path.dirname(path)
+        prefix = path.rstrip(os.sep) + os.sep
+        with self.lock:
+            for cached_path in list(self.listings):
+                if cached_path in (path, parent) or cached_path.startswith(prefix):
+                    self.size -= self.listings.pop(cached_path)[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'listings': len(self.listings),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
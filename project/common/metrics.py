@@ -0,0 +1,190 @@
+"""Runtime metrics of the file servers.
+
+A Metrics registry keeps counters and latency histograms in memory. The
+servers answer a `stats` command with snapshot(), and serve() publishes
+the same numbers in the Prometheus text format over HTTP on localhost.
+
+Histograms count observations in fixed buckets spaced by a factor of
+sqrt(2) from 10 microseconds to about two minutes, so recording a value
+costs one bisect under a lock and percentiles are estimated within ~20%
+by interpolating inside their bucket.
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = tuple(1e-5 * 2 ** (i / 2) for i in range(48))
+
+# Percentiles reported by snapshot()
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+
+class Histogram:
+    """Observation counts per bucket, plus their sum, minimum and maximum"""
+
+    def __init__(self):
+        # The last count is for values past the largest bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Estimate the value below which a fraction `q` of the observations fall"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = max(BUCKETS[index - 1] if index else 0.0, self.min)
+                upper = min(BUCKETS[index] if index < len(BUCKETS) else self.max, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        summary = {'count': self.count, 'sum': round(self.sum, 6),
+                   'max': round(self.max, 6) if self.count else None}
+        for name, q in PERCENTILES:
+            value = self.percentile(q)
+            summary[name] = round(value, 6) if value is not None else None
+        return summary
+
+
+def series_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """Registry of the metrics of one server, named `<namespace>_<name>`.
+
+    Every metric is declared with describe() first. Counters and histograms
+    may carry labels, passed as keyword arguments to inc() and observe().
+    Metrics declared with a `function` are read from it when reported,
+    which suits gauges and counts kept elsewhere.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # name -> (kind, help, function)
+        self.kinds = {}
+        # name -> {sorted label items: number or Histogram}
+        self.series = {}
+
+    def describe(self, name, kind, help, function=None):
+        """Declare a 'counter', 'gauge' or 'histogram'"""
+        self.kinds[name] = (kind, help, function)
+        self.series[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        """Every series by name, histograms summarized with their percentiles"""
+        stats = {'uptime_seconds': round(time.monotonic() - self.started, 3)}
+        with self.lock:
+            for name, series in self.series.items():
+                for labels, value in sorted(series.items()):
+                    stats[series_name(name, labels)] = value.summary() if isinstance(value, Histogram) else value
+        for name, (_, _, function) in self.kinds.items():
+            if function:
+                stats[name] = function()
+        return stats
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, (kind, help, function) in self.kinds.items():
+                full = f'{self.namespace}_{name}'
+                lines.append(f'# HELP {full} {help}')
+                lines.append(f'# TYPE {full} {kind}')
+                if function:
+                    lines.append(f'{full} {function()}')
+                    continue
+                for labels, value in sorted(self.series[name].items()):
+                    if not isinstance(value, Histogram):
+                        lines.append(f'{series_name(full, labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, value.counts):
+                        cumulative += count
+                        lines.append(f'{series_name(full + "_bucket", labels + (("le", f"{bound:.6g}"),))} {cumulative}')
+                    lines.append(f'{series_name(full + "_bucket", labels + (("le", "+Inf"),))} {value.count}')
+                    lines.append(f'{series_name(full + "_sum", labels)} {value.sum}')
+                    lines.append(f'{series_name(full + "_count", labels)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve prometheus() at http://host:port/metrics from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def server_metrics(namespace, active_connections, listing_cache=None):
+    """A registry with the metrics both file servers report: requests by
+    command, bytes on the wire, connections and listing cache hits"""
+    metrics = Metrics(namespace)
+    metrics.describe('requests_total', 'counter', 'Requests handled, by command and status')
+    metrics.describe('request_seconds', 'histogram', 'Time to handle and answer a request, by command')
+    metrics.describe('received_bytes_total', 'counter', 'Bytes received from clients')
+    metrics.describe('sent_bytes_total', 'counter', 'Bytes sent to clients, file data included')
+    metrics.describe('connections_total', 'counter', 'Client connections served')
+    metrics.describe('connections_rejected_total', 'counter', 'Client connections turned away as busy')
+    metrics.describe('connections_active', 'gauge', 'Clients connected now', active_connections)
+    if listing_cache is not None:
+        metrics.describe('listing_cache_hits_total', 'counter', 'Directory listings served from the cache',
+                         lambda: listing_cache.hits)
+        metrics.describe('listing_cache_misses_total', 'counter', 'Directory listings read from disk',
+                         lambda: listing_cache.misses)
+        metrics.describe('listing_cache_hit_ratio', 'gauge', 'Share of directory listings served from the cache',
+                         lambda: round(listing_cache.hits / max(listing_cache.hits + listing_cache.misses, 1), 4))
+    return metrics
@@ -0,0 +1,144 @@
+"""Bounded queues of messages pushed to a client without blocking the pusher.
+
+Servers send some messages from threads that serve other work: lease
+recalls go out from the request of another client, and copy progress
+from a shared worker. Writing them directly would hold that thread until
+the client reads, so a few clients that stop reading could stall every
+worker. Instead they are put in the client's outbox and written by a
+sender of its own.
+
+put() never blocks. It returns a threading.Event set once the message is
+written, or given up on, for senders that must know it went out before
+going on. When the outbox is full, a `droppable` message, such as a
+progress report, is dropped; any other closes the connection, since a
+client that far behind cannot be told in time.
+"""
+import asyncio
+import queue
+import socket
+import threading
+
+# Messages waiting per client
+OUTBOX_SIZE = 1024
+
+
+class Outbox:
+    """Outbox of a protocol.Connection, written by a thread started on first use"""
+
+    def __init__(self, conn, size=OUTBOX_SIZE):
+        self.conn = conn
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def put(self, message, droppable=False):
+        sent = threading.Event()
+        with self.lock:
+            if self.closed:
+                sent.set()
+                return sent
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            try:
+                self.queue.put_nowait((message, sent))
+            except queue.Full:
+                sent.set()
+                if not droppable:
+                    self.overflow()
+        return sent
+
+    def overflow(self):
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            message, sent = item
+            try:
+                self.conn.send_message(message)
+            except Exception:
+                # The connection is gone; keep emptying the queue until close()
+                pass
+            finally:
+                sent.set()
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until the messages put so far are written"""
+        self.queue.join()
+
+    def close(self):
+        """Write the queued messages, then stop the sender; later messages
+        are ignored"""
+        with self.lock:
+            self.closed = True
+            thread, self.thread = self.thread, None
+        if not thread:
+            return
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            self.overflow()
+            self.queue.put(None)
+        thread.join()
+
+
+class AsyncOutbox:
+    """Outbox of an aio.AsyncConnection, written by a task of its event
+    loop. put() may be called from any thread"""
+
+    def __init__(self, conn, size=OUTBOX_SIZE):
+        self.conn = conn
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(size)
+        self.closed = False
+        self.task = self.loop.create_task(self.run())
+
+    def put(self, message, droppable=False):
+        sent = threading.Event()
+        try:
+            self.loop.call_soon_threadsafe(self.enqueue, message, droppable, sent)
+        except RuntimeError:
+            # The event loop is closed
+            sent.set()
+        return sent
+
+    def enqueue(self, message, droppable, sent):
+        if self.closed:
+            sent.set()
+            return
+        try:
+            self.queue.put_nowait((message, sent))
+        except asyncio.QueueFull:
+            sent.set()
+            if not droppable:
+                self.conn.writer.transport.abort()
+
+    async def run(self):
+        while True:
+            message, sent = await self.queue.get()
+            try:
+                await self.conn.send_message(message)
+            except Exception:
+                pass
+            finally:
+                sent.set()
+                self.queue.task_done()
+
+    async def flush(self):
+        """Wait until the messages put so far are written"""
+        await self.queue.join()
+
+    async def close(self):
+        """Write the queued messages, then stop the sender; later messages
+        are ignored"""
+        self.closed = True
+        await self.flush()
+        self.task.cancel()
@@ -0,0 +1,119 @@
+"""Sorting, filtering and cursor pagination of directory listings.
+
+Cursors are opaque to clients: they encode the sort order and the sort key
+of the last entry returned, so the next page resumes right after it even
+if entries were added or removed in between.
+"""
+import base64
+import bisect
+import fnmatch
+import json
+
+OPTION_TYPES = {
+    'limit': int,
+    'cursor': str,
+    'sort': str,
+    'reverse': lambda value: value if isinstance(value, bool) else value.lower() in ('1', 'true', 'yes'),
+    'pattern': str,
+    'type': str,
+    'min_size': int,
+    'max_size': int,
+}
+
+SORT_KEYS = {
+    'name': lambda entry: (entry[0],),
+    'size': lambda entry: (entry[2], entry[0]),
+    'mtime': lambda entry: (entry[3], entry[0]),
+}
+
+
+def encode_cursor(sort, reverse, key):
+    return base64.urlsafe_b64encode(json.dumps([sort, reverse, list(key)]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort, reverse):
+    try:
+        cursor_sort, cursor_reverse, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort or cursor_reverse != reverse:
+        raise ValueError('Cursor was issued for a different sort order')
+    return tuple(key)
+
+
+def page_entries(entries, limit=None, cursor=None, sort='name', reverse=False,
+                 pattern=None, kind=None, min_size=None, max_size=None):
+    """Select one page of (name, is_dir, size, mtime) entries sorted by name.
+
+    `kind` is 'file' or 'dir'; `pattern` is a glob matched against names;
+    size bounds only apply to files. Returns (page, next_cursor), where
+    next_cursor is None on the last page. Raises ValueError for bad options.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f'Unknown sort key: {sort}')
+    if kind not in (None, 'file', 'dir'):
+        raise ValueError(f'Unknown entry type: {kind}')
+    if limit is not None and limit <= 0:
+        raise ValueError('limit must be positive')
+    sort_key = SORT_KEYS[sort]
+
+    # Entries arrive sorted by name, so that order needs no extra sort and
+    # the cursor position is found by bisection
+    if sort == 'name':
+        ordered = entries[::-1] if reverse else entries
+    else:
+        ordered = sorted(entries, key=sort_key, reverse=reverse)
+
+    start = 0
+    if cursor:
+        after = decode_cursor(cursor, sort, reverse)
+        if sort == 'name':
+            # Names are unique within a directory, so probing with the bare
+            # name tuple splits the entries around it
+            before = bisect.bisect_left(entries, (after[0],))
+            if reverse:
+                start = len(entries) - before
+            else:
+                start = before + (before < len(entries) and entries[before][0] == after[0])
+        else:
+            while start < len(ordered) and (sort_key(ordered[start]) >= after if reverse
+                                            else sort_key(ordered[start]) <= after):
+                start += 1
+
+    page = []
+    for index in range(start, len(ordered)):
+        entry = ordered[index]
+        name, is_dir, size, _ = entry
+        if kind == 'file' and is_dir or kind == 'dir' and not is_dir:
+            continue
+        if pattern and not fnmatch.fnmatch(name, pattern):
+            continue
+        if not is_dir and (min_size is not None and size < min_size or max_size is not None and size > max_size):
+            continue
+        page.append(entry)
+        if limit is not None and len(page) == limit:
+            if index + 1 < len(ordered):
+                return page, encode_cursor(sort, reverse, sort_key(entry))
+            break
+    return page, None
+
+
+def parse_options(tokens):
+    """Parse `key=value` words typed after `ls` into a listing options dict"""
+    options = {}
+    for token in tokens:
+        key, sep, value = token.partition('=')
+        if not sep or key not in OPTION_TYPES:
+            raise ValueError(f'Unknown ls option: {token} (expected one of {", ".join(OPTION_TYPES)} as key=value)')
+        options[key] = OPTION_TYPES[key](value)
+    return options
+
+
+def page_with_options(entries, options):
+    """page_entries driven by the options dict of an ls request"""
+    options = dict(options or {})
+    unknown = set(options) - set(OPTION_TYPES)
+    if unknown:
+        raise ValueError(f'Unknown ls option: {", ".join(sorted(unknown))}')
+    kind = options.pop('type', None)
+    return page_entries(entries, kind=kind, **options)
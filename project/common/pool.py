@@ -0,0 +1,214 @@
+"""Pool of framed connections shared by the threads of a scripted client.
+
+Opening a connection costs a TCP handshake plus the hello exchange that
+picks the codecs, which dominates short operations such as `ls` or a
+delete. A ConnectionPool keeps connections that finished their handshake
+and hands them out one caller at a time, so scripts running many
+operations, from one thread or many, reuse warm connections.
+
+Idle connections have TCP keepalive on and are dropped after
+`idle_timeout`. Before one is handed out again it is checked without a
+round trip: a connection with anything to read has been closed by the
+server (or is out of sync) and is replaced. Connections idle for longer
+than `check_after` are also sent a cheap request through `ping`. New
+connections are opened with exponential backoff between attempts, which
+also covers a server answering 'busy' to the hello.
+"""
+import random
+import select
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from common.protocol import Connection
+
+# Connections kept per pool
+POOL_SIZE = 8
+
+# Seconds an idle connection is kept, and idle seconds after which it is
+# pinged before being reused
+IDLE_TIMEOUT = 60.0
+CHECK_AFTER = 5.0
+
+# Attempts at opening a connection, and the first and longest wait between
+# them; each wait doubles the previous one
+CONNECT_ATTEMPTS = 5
+BACKOFF = 0.1
+MAX_BACKOFF = 5.0
+
+# Seconds to wait for the TCP connection itself
+CONNECT_TIMEOUT = 10.0
+
+
+def open_connection(host, port, compression=None, codecs=None, timeout=CONNECT_TIMEOUT):
+    """Connect to a server, with TCP keepalive on, and run the hello
+    handshake offering `compression` and `codecs` (see Connection.hello)"""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    sock.settimeout(None)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    conn = Connection(sock)
+    try:
+        conn.hello(compression, codecs)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+def quiet(conn):
+    """True if nothing is waiting to be read on an idle connection. Between
+    requests the server sends nothing, so anything readable is either the
+    end of the stream or a leftover of an interrupted exchange"""
+    if conn.buffer:
+        return False
+    readable, _, _ = select.select([conn.sock], [], [], 0)
+    return not readable
+
+
+class ConnectionPool:
+    """Thread-safe pool of at most `max_size` connections made by `connect`.
+
+    Use connection() as a context manager around one exchange: the
+    connection goes back to the pool when the block ends, and is closed
+    instead when the block raises, as the exchange may have been cut
+    halfway. acquire() waits up to `timeout` seconds for a connection
+    when all of them are in use. `ping(conn)`, if given, sends a cheap
+    request and raises if the connection is unusable.
+    """
+
+    def __init__(self, connect, max_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, check_after=CHECK_AFTER, ping=None,
+                 attempts=CONNECT_ATTEMPTS, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.ping = ping
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cond = threading.Condition()
+        # Idle connections with the time they were released, newest last
+        self.idle = deque()
+        # Connections in use or idle
+        self.size = 0
+        self.closed = False
+        # Connections opened and replaced so far
+        self.opened = 0
+        self.replaced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, broken=True)
+            raise
+        self.release(conn)
+
+    def acquire(self, timeout=None):
+        """Take an idle connection, or open one if the pool is not full"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.cond:
+                conn = None
+                while True:
+                    if self.closed:
+                        raise ConnectionError('Connection pool is closed')
+                    self.expire()
+                    if self.idle:
+                        # The most recently used connection is the least likely to be stale
+                        conn, released = self.idle.pop()
+                        break
+                    if self.size < self.max_size:
+                        self.size += 1
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError('No free connection in the pool')
+                    self.cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self.open()
+                except BaseException:
+                    self.forget()
+                    raise
+            if self.usable(conn, time.monotonic() - released):
+                return conn
+            conn.close()
+            self.forget()
+            with self.cond:
+                self.replaced += 1
+
+    def release(self, conn, broken=False):
+        """Give a connection back, closing it if `broken` or the pool is closed"""
+        with self.cond:
+            if not broken and not self.closed:
+                self.idle.append((conn, time.monotonic()))
+                self.cond.notify()
+                return
+        conn.close()
+        self.forget()
+
+    def close(self):
+        """Close the idle connections; those in use are closed when released"""
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+            self.size -= len(idle)
+            self.cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+
+    def forget(self):
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def expire(self):
+        # Close connections idle for too long, the oldest are first; called
+        # with the condition held
+        limit = time.monotonic() - self.idle_timeout
+        while self.idle and self.idle[0][1] < limit:
+            conn, _ = self.idle.popleft()
+            conn.close()
+            self.size -= 1
+
+    def usable(self, conn, idle_seconds):
+        """Health check of a connection leaving the pool"""
+        try:
+            if not quiet(conn):
+                return False
+            if self.ping and idle_seconds >= self.check_after:
+                self.ping(conn)
+            return True
+        except Exception:
+            return False
+
+    def open(self):
+        """Open a connection, retrying with exponential backoff and jitter"""
+        delay = self.backoff
+        for attempt in range(self.attempts):
+            try:
+                conn = self.connect()
+                with self.cond:
+                    self.opened += 1
+                return conn
+            except OSError:
+                if attempt == self.attempts - 1:
+                    raise
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, self.max_backoff)
@@ -0,0 +1,191 @@
+"""Per-request profiling of the file servers.
+
+A server with a RequestProfiler traces every request through its phases:
+
+- decode: turning the request frame into a message
+- lock: waiting for path locks (NFS only)
+- fs: running the command, less its lock waits
+- encode: turning the response into a frame
+- send: writing the response and any file data to the socket
+
+Phase times go to the `request_phase_seconds` histogram of the server's
+metrics. One request in `sample_every` also runs its command under
+cProfile, saved to `dump_dir` for pstats or snakeviz, and requests taking
+`slow_seconds` or more are logged with their phases and appended to
+`dump_dir/slow_requests.jsonl`.
+
+Servers without a profiler keep `profiler = None` and only test it, so the
+hooks cost nothing unless enabled.
+"""
+import cProfile
+import datetime
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+PHASES = ('decode', 'lock', 'fs', 'encode', 'send')
+
+# Profiles kept in the dump directory; the oldest are removed beyond that
+MAX_PROFILES = 100
+
+SLOW_LOG = 'slow_requests.jsonl'
+
+
+def request_summary(request):
+    """The fields of a request naming what it works on"""
+    return {key: request[key] for key in ('args', 'path', 'source', 'destination') if key in request}
+
+
+class Trace:
+    """Phase timings of one request, from its decoding to its last byte sent"""
+
+    def __init__(self, command, client, request, phases, decode_seconds, sampled):
+        self.command = command
+        self.client = client
+        self.request = request
+        self.started = time.perf_counter() - decode_seconds
+        self.phases = dict.fromkeys(phases, 0.0)
+        self.phases['decode'] = decode_seconds
+        self.sampled = sampled
+        self.profile = None
+
+    def add(self, phase, seconds):
+        if phase in self.phases:
+            self.phases[phase] += seconds
+
+    def send_message(self, conn, message):
+        """conn.send_message(), timing the encode and send phases"""
+        started = time.perf_counter()
+        payload = conn.codec.encode(message)
+        encoded = time.perf_counter()
+        conn.send_frame(payload)
+        self.add('encode', encoded - started)
+        self.add('send', time.perf_counter() - encoded)
+
+    async def send_message_async(self, conn, message):
+        """send_message() for an AsyncConnection"""
+        started = time.perf_counter()
+        payload = conn.codec.encode(message)
+        encoded = time.perf_counter()
+        await conn.send_frame(payload)
+        self.add('encode', encoded - started)
+        self.add('send', time.perf_counter() - encoded)
+
+
+class RequestProfiler:
+    """Traces requests, samples cProfile profiles and reports slow requests.
+
+    Servers call begin() once a request is decoded, run its command with
+    call(), report lock waits with lock_wait() and call finish() after the
+    response is sent. `phases` are the phases the server has, `log` takes
+    one line per slow request.
+    """
+
+    def __init__(self, sample_every=0, slow_seconds=None, dump_dir='profiles', metrics=None, log=print,
+                 phases=PHASES, max_profiles=MAX_PROFILES):
+        self.sample_every = sample_every
+        self.slow_seconds = slow_seconds
+        self.dump_dir = dump_dir
+        self.metrics = metrics
+        self.log = log
+        self.phases = phases
+        self.counter = itertools.count(1)
+        # The trace of the request each thread is running, for lock_wait()
+        self.local = threading.local()
+        # One profile at a time: a profiler only sees its own thread, and
+        # newer Pythons refuse to enable a second one
+        self.profiling = threading.Lock()
+        self.profiles = deque()
+        self.max_profiles = max_profiles
+        self.slow_lock = threading.Lock()
+        if sample_every or slow_seconds is not None:
+            os.makedirs(dump_dir, exist_ok=True)
+        if metrics:
+            metrics.describe('request_phase_seconds', 'histogram', 'Time requests spent in each phase, by command')
+
+    def begin(self, command, client, request, decode_seconds=0.0):
+        """Start tracing a request decoded in `decode_seconds`"""
+        sampled = bool(self.sample_every) and next(self.counter) % self.sample_every == 0
+        return Trace(command, client, request_summary(request), self.phases, decode_seconds, sampled)
+
+    def call(self, trace, function, *args):
+        """Run the command of a request in this thread as its fs phase,
+        under cProfile if the request is sampled"""
+        self.local.trace = trace
+        profile = None
+        if trace.sampled and self.profiling.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiling tool is active
+                profile = None
+                self.profiling.release()
+        lock_before = trace.phases.get('lock', 0.0)
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile:
+                profile.disable()
+                self.profiling.release()
+                trace.profile = profile
+            self.local.trace = None
+            trace.add('fs', elapsed - (trace.phases.get('lock', 0.0) - lock_before))
+
+    def lock_wait(self, seconds):
+        """Count a lock wait of the request running in this thread"""
+        trace = getattr(self.local, 'trace', None)
+        if trace:
+            trace.add('lock', seconds)
+
+    def finish(self, trace, status):
+        """Record the phases of a request whose response has been sent"""
+        seconds = time.perf_counter() - trace.started
+        if self.metrics:
+            for phase, spent in trace.phases.items():
+                self.metrics.observe('request_phase_seconds', spent, command=trace.command, phase=phase)
+        profile_file = self.save_profile(trace) if trace.profile else None
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self.report_slow(trace, status, seconds, profile_file)
+
+    def save_profile(self, trace):
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        path = os.path.join(self.dump_dir, f'{stamp}-{trace.command}.prof')
+        try:
+            trace.profile.dump_stats(path)
+        except OSError as e:
+            self.log(f'Error saving profile {path}: {str(e)}')
+            return None
+        with self.slow_lock:
+            self.profiles.append(path)
+            expired = self.profiles.popleft() if len(self.profiles) > self.max_profiles else None
+        if expired:
+            try:
+                os.remove(expired)
+            except OSError:
+                pass
+        return path
+
+    def report_slow(self, trace, status, seconds, profile_file):
+        phases = ', '.join(f'{phase} {spent * 1000:.1f} ms' for phase, spent in trace.phases.items())
+        self.log(f'Slow request {trace.command} from {trace.client}: {seconds * 1000:.1f} ms ({phases})')
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'command': trace.command,
+            'client': trace.client,
+            'request': trace.request,
+            'status': status,
+            'seconds': round(seconds, 6),
+            'phases': {phase: round(spent, 6) for phase, spent in trace.phases.items()},
+            'profile': profile_file,
+        }
+        try:
+            with self.slow_lock, open(os.path.join(self.dump_dir, SLOW_LOG), 'a') as f:
+                f.write(json.dumps(entry, default=str) + '\n')
+        except OSError as e:
+            self.log(f'Error writing the slow request log: {str(e)}')
@@ -0,0 +1,234 @@
+"""Length-prefixed message framing shared by the BigFS and NFS clients and servers.
+
+Every message is a frame: a 4-byte big-endian length followed by a body
+encoded with the connection's codec, JSON unless another was agreed (see
+serialization.py). File contents travel as a run of raw data frames terminated by an
+empty frame (see transfer.py). Reads go through a buffer, so a message split
+across several segments is reassembled and several pipelined messages that
+arrive in one segment are returned one at a time.
+
+A connection starts with a 'hello' exchange, always in JSON, in which the
+client offers message codecs and compression codecs and the server picks
+one of each (see compression.py).
+"""
+import struct
+import threading
+import time
+
+from common import serialization
+from common.compression import COMPRESSED, LENGTH_MASK, Compressor, available, decompress, negotiate
+from common.transfer import send_file, send_file_checked, send_frame, verify_chunk
+
+# Reads smaller than this go through the buffer; larger payloads are
+# received directly into their destination
+RECV_SIZE = 64 * 1024
+
+# Refuse frames that could only come from a corrupt or hostile stream
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+
+def hello_response(request, **fields):
+    """The server's answer to a hello `request`, picking both codecs.
+    `fields` are extra entries telling the client about the server."""
+    response = {
+        'status': 'success',
+        'compression': negotiate(request.get('compression') or []),
+        'codec': serialization.negotiate(request.get('codecs') or []),
+        **fields,
+    }
+    if 'id' in request:
+        response['id'] = request['id']
+    return response
+
+
+class Connection:
+    """A socket that sends and receives framed messages"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        # Held while writing a message or a whole file stream, so threads
+        # answering pipelined requests never interleave their frames. It is
+        # re-entrant so a header and the file after it can be sent atomically
+        self.send_lock = threading.RLock()
+        # Message codec and compression agreed in the hello handshake, and
+        # the compressor of outgoing messages
+        self.codec = serialization.DEFAULT
+        self.compression = None
+        self.compressor = None
+        # Registry counting the bytes moved, set by servers (see metrics.py)
+        self.metrics = None
+        # When set, recv_message() keeps the time it spent decoding the
+        # last message, for request profiling (see profiling.py)
+        self.time_decode = False
+        self.decode_seconds = 0.0
+
+    def close(self):
+        self.sock.close()
+
+    def set_compression(self, codec):
+        self.compression = codec
+        self.compressor = Compressor(codec) if codec else None
+
+    def set_codec(self, name):
+        self.codec = serialization.CODECS[name]
+
+    def hello(self, compression=None, codecs=None):
+        """Offer `compression` and message `codecs` (all available ones by
+        default) and switch to those the server picks. Must be the first
+        request on the connection; returns the server's answer."""
+        self.send_message({
+            'command': 'hello',
+            'compression': available() if compression is None else compression,
+            'codecs': serialization.available() if codecs is None else codecs,
+        })
+        response = self.recv_message()
+        if response is None:
+            raise ConnectionError('Connection closed by server')
+        if response.get('status') != 'success':
+            raise ConnectionError(response.get('message', 'Handshake refused'))
+        # Servers from before codec negotiation do not answer one
+        codec = response.get('codec', serialization.DEFAULT.name)
+        if codec not in serialization.CODECS:
+            raise ConnectionError(f'Server picked an unknown codec {codec!r}')
+        self.set_compression(response.get('compression'))
+        self.set_codec(codec)
+        return response
+
+    def accept_hello(self, request, **fields):
+        """Answer a client's hello and switch to the codecs chosen for it"""
+        response = hello_response(request, **fields)
+        with self.send_lock:
+            self.send_message(response)
+            self.set_compression(response['compression'])
+            self.set_codec(response['codec'])
+        return response
+
+    def _fill(self):
+        packet = self.sock.recv(RECV_SIZE)
+        if not packet:
+            return False
+        self.buffer.extend(packet)
+        if self.metrics:
+            self.metrics.inc('received_bytes_total', len(packet))
+        return True
+
+    def recv_exact(self, size):
+        """Read exactly `size` bytes or raise ConnectionError"""
+        if size <= RECV_SIZE:
+            while len(self.buffer) < size:
+                if not self._fill():
+                    raise ConnectionError('Connection closed by peer')
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+        data = bytearray(size)
+        view = memoryview(data)
+        have = len(self.buffer)
+        view[:have] = self.buffer
+        self.buffer.clear()
+        buffered = have
+        while have < size:
+            n = self.sock.recv_into(view[have:])
+            if not n:
+                raise ConnectionError('Connection closed by peer')
+            have += n
+        if self.metrics:
+            self.metrics.inc('received_bytes_total', size - buffered)
+        return data
+
+    def recv_frame(self):
+        """Read one frame and return its payload"""
+        (header,) = struct.unpack('!I', self.recv_exact(4))
+        length = header & LENGTH_MASK
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f'Frame of {length} bytes exceeds the limit')
+        if header & COMPRESSED:
+            return decompress(self.compression, self.recv_exact(length), MAX_FRAME_SIZE)
+        return self.recv_exact(length) if length else b''
+
+    def recv_message(self):
+        """Read one message, or return None if the peer closed the connection
+        cleanly between messages. Raises ValueError for undecodable bodies
+        after consuming them, so the stream stays usable."""
+        if not self.buffer and not self._fill():
+            return None
+        frame = self.recv_frame()
+        if not self.time_decode:
+            return self.codec.decode(frame)
+        started = time.perf_counter()
+        try:
+            return self.codec.decode(frame)
+        finally:
+            self.decode_seconds = time.perf_counter() - started
+
+    def send_frame(self, payload):
+        compressed = False
+        with self.send_lock:
+            if self.compressor:
+                payload, compressed = self.compressor.compress(payload)
+            send_frame(self.sock, payload, compressed)
+        if self.metrics:
+            self.metrics.inc('sent_bytes_total', 4 + len(payload))
+
+    def send_message(self, message):
+        self.send_frame(self.codec.encode(message))
+
+    def stream_compressor(self):
+        """A compressor for one file stream, or None without compression"""
+        return self.compressor.fork() if self.compressor else None
+
+    def send_file(self, file, offset=0, count=None, use_sendfile=True, end=True, compressor=None):
+        """Stream an open file as data frames, see transfer.send_file.
+        Files sent as one stream share a `compressor` from stream_compressor;
+        by default each file gets its own."""
+        compressor = compressor or self.stream_compressor()
+        with self.send_lock:
+            sent = send_file(self.sock, file, offset, count, use_sendfile, compressor=compressor, end=end)
+        if self.metrics:
+            self.metrics.inc('sent_bytes_total', sent)
+        return sent
+
+    def send_file_checked(self, file, offset=0, count=None, digest=None, end=True, compressor=None):
+        """Stream an open file as CRC32-checked data frames, see transfer.send_file_checked"""
+        compressor = compressor or self.stream_compressor()
+        with self.send_lock:
+            sent = send_file_checked(self.sock, file, offset, count, digest, compressor=compressor, end=end)
+        if self.metrics:
+            self.metrics.inc('sent_bytes_total', sent)
+        return sent
+
+    def receive_file_checked(self, file, digest=None):
+        """Write incoming checked data frames to an open binary file.
+
+        Writing stops at the first frame whose CRC32 does not match, so the
+        file only ever holds verified data; the rest of the stream is still
+        drained. Returns the bytes written and whether every frame was intact.
+        """
+        received = 0
+        intact = True
+        while True:
+            frame = self.recv_frame()
+            if not frame:
+                return received, intact
+            if not intact:
+                continue
+            data = verify_chunk(frame)
+            if data is None:
+                intact = False
+                continue
+            file.write(data)
+            if digest is not None:
+                digest.update(data)
+            received += len(data)
+
+    def receive_file(self, file):
+        """Write incoming data frames to an open binary file until the empty frame"""
+        received = 0
+        while True:
+            chunk = self.recv_frame()
+            if not chunk:
+                return received
+            file.write(chunk)
+            received += len(chunk)
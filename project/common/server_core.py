@@ -0,0 +1,145 @@
+"""Thread-pool connection serving with admission control.
+
+Instead of starting one thread per accepted connection, connections are
+handed to a fixed number of worker threads through a bounded queue. When
+every worker is busy and the queue is full, new connections are answered
+right away through a `reject` callback (an explicit "busy" reply) and
+closed, so an overloaded server keeps its latency predictable instead of
+thrashing. A worker serves its client for the whole session, so a queued
+connection could wait for as long as the longest session; connections
+still queued after `queue_timeout` seconds are turned away the same way.
+"""
+import socket
+import threading
+import time
+from collections import deque
+
+# Seconds a connection may wait for a free worker before it is answered busy
+QUEUE_TIMEOUT = 10
+
+
+class PooledServer:
+    """Serves connections accepted on `server_socket` with `workers` threads.
+
+    `handler(client_socket, address)` runs on a worker and owns the socket
+    for the whole session. At most `queue_size` further connections wait
+    for a free worker, each for at most `queue_timeout` seconds; beyond
+    that `reject(client_socket, address)` is called before the socket is
+    closed.
+    """
+
+    def __init__(self, server_socket, handler, workers=64, queue_size=128, reject=None,
+                 queue_timeout=QUEUE_TIMEOUT):
+        self.server_socket = server_socket
+        self.handler = handler
+        self.workers = workers
+        self.reject = reject
+        self.queue_size = max(1, queue_size)
+        self.queue_timeout = queue_timeout
+        # (client_socket, address, deadline) in arrival order, so the oldest
+        # deadline is always first
+        self.queue = deque()
+        self.ready = threading.Condition()
+        self.stopping = False
+        self.threads = []
+        self.active = set()
+        self.active_lock = threading.Lock()
+        self.draining = threading.Event()
+
+    def serve_forever(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        threading.Thread(target=self.expire_forever, daemon=True).start()
+
+        while not self.draining.is_set():
+            try:
+                client_socket, address = self.server_socket.accept()
+            except OSError:
+                if self.draining.is_set():
+                    break
+                raise
+            with self.ready:
+                queued = len(self.queue) < self.queue_size
+                if queued:
+                    self.queue.append((client_socket, address, time.monotonic() + self.queue_timeout))
+                    self.ready.notify()
+            if not queued:
+                self.turn_away(client_socket, address)
+
+    def work(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.stopping:
+                    self.ready.wait()
+                if not self.queue:
+                    return
+                client_socket, address, _ = self.queue.popleft()
+            with self.active_lock:
+                self.active.add(client_socket)
+            try:
+                self.handler(client_socket, address)
+            except Exception as e:
+                print(f"Error handling client {address}: {e}")
+            finally:
+                with self.active_lock:
+                    self.active.discard(client_socket)
+                client_socket.close()
+
+    def expire_forever(self):
+        # Checks a few times per timeout, so a connection waits at most a
+        # quarter of it longer than queue_timeout
+        interval = min(1.0, self.queue_timeout / 4)
+        while not self.draining.wait(interval):
+            now = time.monotonic()
+            expired = []
+            with self.ready:
+                while self.queue and self.queue[0][2] <= now:
+                    expired.append(self.queue.popleft())
+            for client_socket, address, _ in expired:
+                self.turn_away(client_socket, address)
+
+    def turn_away(self, client_socket, address):
+        try:
+            if self.reject:
+                client_socket.settimeout(1)
+                self.reject(client_socket, address)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def shutdown(self, timeout=30):
+        """Stop accepting, turn away queued connections and give active
+        sessions up to `timeout` seconds to finish their current request.
+
+        Idle sessions are ended by shutting down the read side of their
+        sockets: handlers see end-of-stream after the request they are
+        processing, whose response can still be sent.
+        """
+        self.draining.set()
+        try:
+            self.server_socket.close()
+        except OSError:
+            pass
+
+        with self.ready:
+            queued = list(self.queue)
+            self.queue.clear()
+            self.stopping = True
+            self.ready.notify_all()
+        for client_socket, address, _ in queued:
+            self.turn_away(client_socket, address)
+
+        with self.active_lock:
+            active = list(self.active)
+        for client_socket in active:
+            try:
+                client_socket.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
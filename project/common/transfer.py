@@ -0,0 +1,188 @@
+"""Helpers for streaming file contents over a socket as length-prefixed frames.
+
+A frame is a 4-byte big-endian length followed by that many bytes. A file is
+sent as a sequence of data frames terminated by an empty frame. In a checked
+stream every data frame starts with the CRC32 of the data that follows it.
+When the connection negotiated compression, the top bit of the length marks
+a compressed payload (see compression.py).
+"""
+import os
+import socket
+import struct
+import zlib
+
+from common.compression import COMPRESSED, MIN_SIZE
+
+CHUNK_SIZE = 1024 * 1024
+
+# Linux lets us hold the frame header back until the data that follows it is
+# queued, so headers and sendfile payloads leave in the same segments
+_MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+
+# Frames up to this size are sent with a single write; separate writes for
+# the header and a small body would trip Nagle's algorithm against delayed
+# ACKs and stall every response for tens of milliseconds
+COALESCE_SIZE = 64 * 1024
+
+# Bytes of CRC32 ahead of the data in each frame of a checked stream
+CRC_SIZE = 4
+
+
+def send_frame(sock, payload, compressed=False):
+    """Send a single frame"""
+    header = struct.pack('!I', len(payload) | (COMPRESSED if compressed else 0))
+    if len(payload) <= COALESCE_SIZE:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header, _MSG_MORE)
+        sock.sendall(payload)
+
+
+def sendfile_supported(sock):
+    """Whether zero-copy transfers can be used on this socket"""
+    return hasattr(os, 'sendfile') and sock.family in (socket.AF_INET, socket.AF_INET6, socket.AF_UNIX)
+
+
+def send_file(sock, file, offset=0, count=None, use_sendfile=True, chunk_size=CHUNK_SIZE, compressor=None,
+              end=True):
+    """Stream `count` bytes of an open binary file starting at `offset`.
+
+    With `use_sendfile` the data goes from the page cache to the socket via
+    os.sendfile and never enters user space; otherwise it is copied through
+    one reusable buffer. Both modes produce the same frames on the wire.
+    With a `compressor` the chunks are compressed, unless the first one
+    does not shrink, in which case the rest goes out as without one.
+    Without `end` the terminating empty frame is left to the caller, so
+    several files can be sent as one stream. Returns the number of payload
+    bytes sent.
+    """
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - offset
+    if compressor is not None:
+        sent = _send_file_compressed(sock, file, offset, count, use_sendfile, chunk_size, compressor)
+    elif use_sendfile and sendfile_supported(sock):
+        sent = _send_file_zero_copy(sock, file, offset, count, chunk_size)
+    else:
+        sent = _send_file_buffered(sock, file, offset, count, chunk_size)
+    if end:
+        send_frame(sock, b'')
+    return sent
+
+
+def _send_file_zero_copy(sock, file, offset, count, chunk_size):
+    sent = 0
+    in_fd = file.fileno()
+    out_fd = sock.fileno()
+    while sent < count:
+        size = min(chunk_size, count - sent)
+        sock.sendall(struct.pack('!I', size), _MSG_MORE)
+        remaining = size
+        while remaining:
+            n = os.sendfile(out_fd, in_fd, offset + sent, remaining)
+            if n == 0:
+                # The file shrank after the frame header went out; the
+                # stream can no longer be kept in sync
+                raise ConnectionError('File truncated during transfer')
+            sent += n
+            remaining -= n
+    return sent
+
+
+def _send_file_compressed(sock, file, offset, count, use_sendfile, chunk_size, compressor):
+    sent = 0
+    while sent < count:
+        chunk = os.pread(file.fileno(), min(chunk_size, count - sent), offset + sent)
+        if not chunk:
+            break
+        payload, compressed = compressor.compress(chunk)
+        send_frame(sock, payload, compressed)
+        sent += len(chunk)
+        if sent == len(chunk) and not compressed and len(chunk) >= MIN_SIZE:
+            # Archives, media and the like: don't spend CPU on the rest
+            if use_sendfile and sendfile_supported(sock):
+                return sent + _send_file_zero_copy(sock, file, offset + sent, count - sent, chunk_size)
+            return sent + _send_file_buffered(sock, file, offset + sent, count - sent, chunk_size)
+    return sent
+
+
+def _send_file_buffered(sock, file, offset, count, chunk_size):
+    sent = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    file.seek(offset)
+    while sent < count:
+        n = file.readinto(view[:min(chunk_size, count - sent)])
+        if not n:
+            break
+        sock.sendall(struct.pack('!I', n), _MSG_MORE)
+        sock.sendall(view[:n])
+        sent += n
+    return sent
+
+
+def send_file_checked(sock, file, offset=0, count=None, digest=None, chunk_size=CHUNK_SIZE, compressor=None,
+                      end=True):
+    """Stream a byte range like send_file, each chunk led by its CRC32.
+
+    Checksumming needs the data in user space, so this always takes the
+    buffered path. `digest`, if given, is a hashlib object updated with
+    every chunk sent; `compressor` compresses the frames. Returns the
+    number of payload bytes sent.
+    """
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - offset
+    sent = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    file.seek(offset)
+    while sent < count:
+        n = file.readinto(view[:min(chunk_size, count - sent)])
+        if not n:
+            break
+        chunk = view[:n]
+        if digest is not None:
+            digest.update(chunk)
+        if compressor is not None:
+            payload, compressed = compressor.compress(struct.pack('!I', zlib.crc32(chunk)) + chunk)
+            send_frame(sock, payload, compressed)
+        else:
+            sock.sendall(struct.pack('!II', CRC_SIZE + n, zlib.crc32(chunk)), _MSG_MORE)
+            sock.sendall(chunk)
+        sent += n
+    if end:
+        send_frame(sock, b'')
+    return sent
+
+
+def read_checked_chunk(file, size, offset, digest=None):
+    """Read one chunk with os.pread and return it as the payload of a checked frame"""
+    chunk = os.pread(file.fileno(), size, offset)
+    if not chunk:
+        return b''
+    if digest is not None:
+        digest.update(chunk)
+    return struct.pack('!I', zlib.crc32(chunk)) + chunk
+
+
+def verify_chunk(frame):
+    """Return the data of a checked frame, or None when its CRC32 does not match"""
+    if len(frame) < CRC_SIZE:
+        return None
+    (crc,) = struct.unpack_from('!I', frame)
+    data = memoryview(frame)[CRC_SIZE:]
+    return data if zlib.crc32(data) == crc else None
+
+
+def hash_file(file, digest, offset=0, count=None, chunk_size=CHUNK_SIZE):
+    """Update a hashlib object with `count` bytes of an open file from `offset`"""
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - offset
+    done = 0
+    while done < count:
+        chunk = os.pread(file.fileno(), min(chunk_size, count - done), offset + done)
+        if not chunk:
+            break
+        digest.update(chunk)
+        done += len(chunk)
+    return done
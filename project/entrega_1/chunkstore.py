@@ -0,0 +1,271 @@
+"""Content-addressed chunk store behind the BigFS root directory.
+
+Files are split into variable-size, content-defined chunks, and every chunk
+is stored once under the SHA-256 of its data. The namespace stays a normal
+directory tree under the server root, but each file in it is a small
+manifest listing the chunks of the file instead of the data itself. So
+copying a file only copies its manifest, and data shared by many files,
+such as near-duplicate build artifacts, is kept on disk once.
+
+Chunk boundaries depend only on the bytes around them, so an insertion or
+deletion in a file only changes the chunks it touches. Each position gets a
+one-byte hash of the 8 bytes ending there, and a boundary is placed after
+the first two consecutive zero hashes at least MIN_CHUNK and at most
+MAX_CHUNK bytes after the previous one. Per-byte rolling hashes are too
+slow in Python, so the hashes of a whole block are computed at once: its
+bytes go through a random substitution table (bytes.translate), are read
+as one big integer and multiplied by a random 64-bit constant, which adds
+up every byte with the 7 before it under different weights.
+
+Removing a manifest does not free its chunks. `collect_garbage` deletes the
+chunks no manifest references anymore:
+
+    python chunkstore.py gc --root data --store data.chunks
+
+and `ingest` turns the plain files of an existing tree into manifests:
+
+    python chunkstore.py ingest --root data --store data.chunks
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+
+# A manifest is this magic, the size of the file and a newline, followed
+# by the JSON list of its [sha256, length] chunks
+MANIFEST_MAGIC = b"BIGFS-MANIFEST 1 "
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+
+# Hashes ending a chunk; on random data they appear every 64 KB
+_ANCHOR = b"\x00\x00"
+
+# Bytes before a block that the hashes of its first bytes depend on: the 7
+# in the window plus a few more whose carries may reach it
+WINDOW = 16
+
+READ_SIZE = 4 * 1024 * 1024
+
+# Unreferenced chunks younger than this are kept by garbage collection, so
+# a file being written while it runs does not lose chunks it just stored
+GC_GRACE = 3600
+
+_random = random.Random(0x42494746)
+_TABLE = list(range(256))
+_random.shuffle(_TABLE)
+_TABLE = bytes(_TABLE)
+_MULTIPLIER = _random.getrandbits(64) | 1
+
+
+def _hashes(before, block):
+    # One hash byte per byte of block; before holds the bytes preceding it
+    data = before + block
+    value = int.from_bytes(data.translate(_TABLE), "little") * _MULTIPLIER
+    return value.to_bytes(len(data) + 8, "little")[len(before):len(data)]
+
+
+def split(file):
+    # Yield the content-defined chunks of an open binary file
+    data = bytearray()
+    hashes = bytearray()
+    before = b""
+    start = 0
+    eof = False
+    while not eof:
+        block = file.read(READ_SIZE)
+        if block:
+            hashes += _hashes(before, block)
+            before = (before + block)[-WINDOW:]
+            data += block
+        else:
+            eof = True
+        # Cut while a whole search window is buffered, everything at the end
+        while start < len(data) and (eof or len(data) - start >= MAX_CHUNK):
+            anchor = hashes.find(_ANCHOR, start + MIN_CHUNK - len(_ANCHOR), start + MAX_CHUNK)
+            end = min(anchor + len(_ANCHOR) if anchor >= 0 else start + MAX_CHUNK, len(data))
+            yield bytes(data[start:end])
+            start = end
+        del data[:start]
+        del hashes[:start]
+        start = 0
+
+
+def read_manifest(path):
+    # Return the manifest stored at path as {"size", "chunks"}, or None for
+    # a plain file
+    with open(path, "rb") as f:
+        if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+            return None
+        size = int(f.readline())
+        return {"size": size, "chunks": json.loads(f.read())}
+
+
+def logical_size(path, stat):
+    # Size of the file a namespace entry stands for, reading only the
+    # header of a manifest
+    if stat.st_size < len(MANIFEST_MAGIC):
+        return stat.st_size
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                return stat.st_size
+            return int(f.readline())
+    except (OSError, ValueError):
+        return stat.st_size
+
+
+def write_manifest(path, manifest):
+    # Replace path atomically, so readers see the old or the new manifest
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(MANIFEST_MAGIC + b"%d\n" % manifest["size"])
+        f.write(json.dumps(manifest["chunks"]).encode("utf-8"))
+    os.replace(temp_path, path)
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def put_chunk(self, data):
+        # Store one chunk unless it is already there and return its digest.
+        # A chunk that exists is touched so garbage collection sees it in use
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        try:
+            os.utime(path)
+            return digest
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return digest
+
+    def ingest(self, source, manifest_path):
+        # Chunk the plain file source into the store and write its manifest
+        # at manifest_path, which may be source itself. Returns the manifest
+        chunks = []
+        size = 0
+        with open(source, "rb") as f:
+            for chunk in split(f):
+                chunks.append([self.put_chunk(chunk), len(chunk)])
+                size += len(chunk)
+        manifest = {"size": size, "chunks": chunks}
+        stat = os.stat(source)
+        write_manifest(manifest_path, manifest)
+        os.utime(manifest_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return manifest
+
+    def copy(self, source, destination):
+        # Copy a file of the namespace: only its manifest if it is already
+        # in the store, otherwise its data is chunked into the store. Like
+        # treecopy.copy_file, returns the size of the file copied, the one
+        # recorded in its manifest rather than the manifest's own
+        stat = os.stat(source)
+        manifest = read_manifest(source)
+        if manifest is None:
+            self.ingest(source, destination)
+            return stat.st_size
+        write_manifest(destination, manifest)
+        os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return manifest["size"]
+
+    def ranges(self, manifest, offset, length):
+        # Yield (chunk path, offset in chunk, count) covering a byte range
+        position = 0
+        end = offset + length
+        for digest, size in manifest["chunks"]:
+            if position >= end:
+                return
+            if position + size > offset:
+                start = max(offset - position, 0)
+                yield self.chunk_path(digest), start, min(size, end - position) - start
+            position += size
+
+    def collect_garbage(self, root, grace=GC_GRACE):
+        # Delete the chunks no manifest under root references, except those
+        # touched within the last grace seconds. Returns (chunks, bytes) freed
+        live = set()
+        for directory, _, files in os.walk(root):
+            for name in files:
+                try:
+                    manifest = read_manifest(os.path.join(directory, name))
+                except (OSError, ValueError):
+                    continue
+                if manifest:
+                    live.update(digest for digest, _ in manifest["chunks"])
+
+        freed = freed_bytes = 0
+        cutoff = time.time() - grace
+        for directory, _, files in os.walk(self.path):
+            prefix = os.path.basename(directory)
+            for name in files:
+                path = os.path.join(directory, name)
+                if prefix + name in live:
+                    continue
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime >= cutoff:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                freed += 1
+                freed_bytes += stat.st_size
+        return freed, freed_bytes
+
+    def usage(self, root):
+        # Bytes of the files under root versus bytes of chunks they use
+        logical = 0
+        stored = {}
+        for directory, _, files in os.walk(root):
+            for name in files:
+                manifest = read_manifest(os.path.join(directory, name))
+                if manifest:
+                    logical += manifest["size"]
+                    stored.update(manifest["chunks"])
+        return {"logical_bytes": logical, "stored_bytes": sum(stored.values()), "chunks": len(stored)}
+
+
+def ingest_tree(store, root):
+    # Turn every plain file under root into a manifest. Returns the number
+    # of files converted
+    converted = 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            if os.path.islink(path) or read_manifest(path) is not None:
+                continue
+            store.ingest(path, path)
+            converted += 1
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BigFS chunk store maintenance")
+    parser.add_argument("action", choices=["ingest", "gc", "usage"])
+    parser.add_argument("--root", default="data", help="Root directory of the file system")
+    parser.add_argument("--store", default="data.chunks", help="Chunk store directory")
+    parser.add_argument("--grace", type=int, default=GC_GRACE, help="Keep unreferenced chunks younger than this (seconds)")
+    args = parser.parse_args()
+
+    store = ChunkStore(args.store)
+    if args.action == "ingest":
+        print(f"Converted {ingest_tree(store, args.root)} files")
+    elif args.action == "gc":
+        chunks, size = store.collect_garbage(args.root, args.grace)
+        print(f"Freed {chunks} chunks, {size} bytes")
+    else:
+        usage = store.usage(args.root)
+        print(f"{usage['logical_bytes']} bytes in files, {usage['stored_bytes']} bytes in {usage['chunks']} chunks")
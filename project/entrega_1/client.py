@@ -1,14 +1,72 @@
+import argparse
 import socket
-import json
 import os
-import binascii
+import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.pagination import parse_options
+from common.pool import POOL_SIZE, ConnectionPool, open_connection
+from common.protocol import Connection
+from common.transfer import hash_file
+
+# Entries requested per ls round trip
+PAGE_SIZE = 1000
+
+# Tries at downloading a file whose chunks arrived corrupt or whose
+# partial local copy no longer matches the server
+GET_ATTEMPTS = 3
+
+# Connections a get uses at once; files of at least PARALLEL_MIN_SIZE are
+# split into that many byte ranges, directories fetch that many files at once
+STREAMS = 4
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# Requests PooledFileClient sends again on a new connection when the
+# connection fails, as they change nothing on the server
+RETRIED_COMMANDS = ("ls", "get", "stats")
+
+
+class RangeWriter:
+    # File-like sink writing a byte range of a shared descriptor with
+    # os.pwrite, so parallel streams need no seek or lock. position follows
+    # every write, so it tells how far the range got even if its stream
+    # fails; once closed, writes raise
+    def __init__(self, fd, position):
+        self.fd = fd
+        self.position = position
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+    
+    def write(self, data):
+        if self.closed:
+            raise ValueError("Download stopped")
+        data = memoryview(data)
+        while data:
+            n = os.pwrite(self.fd, data, self.position)
+            self.position += n
+            data = data[n:]
 
 class FileClient:
-    def __init__(self, host='127.0.0.1', port=9999):
+    def __init__(self, host='127.0.0.1', port=9999, streams=STREAMS, compression=None, codecs=None):
         self.host = host
         self.port = port
+        # Compression and message codecs offered to the server, all
+        # available ones when None
+        self.compression = compression
+        self.codecs = codecs
         self.client_socket = None
+        self.conn = None
         self.download_dir = "downloads"
+        self.streams = streams
+        # Set when the server is the metadata server of a cluster
+        self.cluster = False
+        # Other storage nodes of a cluster holding the same file, the
+        # parallel streams of a get are spread over them
+        self.replicas = []
         
         # Create download directory if it doesn't exist
         if not os.path.exists(self.download_dir):
@@ -18,7 +76,12 @@ class FileClient:
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((self.host, self.port))
-            print(f"Connected to server at {self.host}:{self.port}")
+            self.conn = Connection(self.client_socket)
+            hello = self.conn.hello(self.compression, self.codecs)
+            # A cluster's metadata server only says where files are, their
+            # data is fetched from the storage nodes
+            self.cluster = hello.get("role") == "metadata"
+            print(f"Connected to {'cluster' if self.cluster else 'server'} at {self.host}:{self.port}")
             return True
         except Exception as e:
             print(f"Failed to connect to server: {e}")
@@ -31,9 +94,14 @@ class FileClient:
     
     def send_command(self, command_data):
         try:
-            self.client_socket.send(json.dumps(command_data).encode('utf-8'))
-            response = self.client_socket.recv(1024 * 1024).decode('utf-8')  # Allow for larger responses
-            return json.loads(response)
+            self.conn.send_message(command_data)
+            while True:
+                response = self.conn.recv_message()
+                if response is None:
+                    raise ConnectionError("Connection closed by server")
+                if response.get("status") != "progress":
+                    return response
+                self.show_progress(response)
         except Exception as e:
             print(f"Error communicating with server: {e}")
             return {"status": "error", "message": "Communication error with server"}
@@ -49,8 +117,14 @@ class FileClient:
             return None  # Signal to exit
         
         if command == "ls":
-            path = parts[1] if len(parts) > 1 else ""
-            return self.handle_list(path)
+            # ls [path] [key=value ...]
+            args = parts[1:]
+            path = args.pop(0) if args and "=" not in args[0] else ""
+            try:
+                options = parse_options(args)
+            except ValueError as e:
+                return str(e)
+            return self.handle_list(path, options)
         
         elif command == "rm":
             if len(parts) < 2:
@@ -66,10 +140,20 @@ class FileClient:
             return self.handle_copy(source, destination)
         
         elif command == "get":
+            # get <path> [streams=N]
             if len(parts) < 2:
-                return "Usage: get <file/directory path>"
+                return "Usage: get <file/directory path> [streams=N]"
             path = parts[1]
-            return self.handle_get(path)
+            streams = None
+            for option in parts[2:]:
+                key, _, value = option.partition("=")
+                if key != "streams" or not value.isdigit() or int(value) < 1:
+                    return f"Unknown get option: {option} (expected streams=N)"
+                streams = int(value)
+            return self.handle_get(path, streams)
+        
+        elif command == "stats":
+            return self.handle_stats()
         
         elif command == "help":
             return self.show_help()
@@ -77,22 +161,31 @@ class FileClient:
         else:
             return f"Unknown command: {command}\nType 'help' to see available commands"
     
-    def handle_list(self, path):
-        response = self.send_command({"command": "ls", "path": path})
-        
-        if response["status"] == "success":
+    def handle_list(self, path, options=None):
+        # Print each page of the listing as it arrives
+        options = dict(options or {})
+        options.setdefault("limit", PAGE_SIZE)
+        count = 0
+        while True:
+            response = self.send_command({"command": "ls", "path": path, "options": options})
+            
+            if response["status"] != "success":
+                return f"Error: {response['message']}"
             if response["type"] == "file":
                 return response["message"]
             
-            result = response["message"] + "\n"
+            if count == 0:
+                print(response["message"])
             for file in response["files"]:
                 if file["type"] == "file":
-                    result += f"{file['name']} ({file['size']} bytes)\n"
+                    print(f"{file['name']} ({file['size']} bytes)")
                 else:
-                    result += f"{file['name']}/\n"
-            return result
-        else:
-            return f"Error: {response['message']}"
+                    print(f"{file['name']}/")
+            count += len(response["files"])
+            
+            if not response.get("next_cursor"):
+                return f"{count} entries"
+            options["cursor"] = response["next_cursor"]
     
     def handle_remove(self, path):
         response = self.send_command({"command": "rm", "path": path})
@@ -102,52 +195,338 @@ class FileClient:
         response = self.send_command({
             "command": "cp", 
             "source": source, 
-            "destination": destination
+            "destination": destination,
+            "progress": True
         })
         return response["message"]
     
-    def handle_get(self, path):
-        response = self.send_command({"command": "get", "path": path})
-        
-        if response["status"] == "success":
-            if response["type"] == "file":
-                file_name = response["name"]
-                local_path = os.path.join(self.download_dir, file_name)
+    def handle_stats(self):
+        response = self.send_command({"command": "stats"})
+        if response["status"] != "success":
+            return f"Error: {response['message']}"
+        lines = []
+        for name, value in response["stats"].items():
+            if isinstance(value, dict):
+                # Latency histogram, in seconds
+                value = " ".join(f"{key}={value[key]}" for key in ("count", "p50", "p99", "p999", "max"))
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+    
+    def show_progress(self, state):
+        # Interim status of a long-running command, sent before its response
+        print(f"  {state['files_done']}/{state['files_total']} files, "
+              f"{state['bytes_done']}/{state['bytes_total']} bytes")
+    
+    def handle_get(self, path, streams=None):
+        streams = streams or self.streams
+        if self.cluster:
+            return self.get_from_cluster(path, streams)
+        try:
+            # A partial file left by an interrupted download is resumed from
+            # its current size
+            local_path = os.path.join(self.download_dir, os.path.basename(os.path.normpath(path)))
+            if streams > 1:
+                for _ in range(GET_ATTEMPTS):
+                    header = self.send_command({"command": "get", "path": path, "data": False})
+                    if header["status"] != "success":
+                        return f"Error: {header['message']}"
+                    if header["type"] == "directory":
+                        return self.get_directory_parallel(header, streams)
+                    offset = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+                    # A local file as long as the remote one is verified below
+                    if header["size"] - offset < PARALLEL_MIN_SIZE:
+                        break
+                    result = self.get_file_parallel(path, local_path, offset, header["size"], streams)
+                    if result is not None:
+                        return result
+                    print(f"Checksum mismatch for {local_path}, retrying")
+                else:
+                    return f"Error: could not download {path} after {GET_ATTEMPTS} attempts"
+            
+            for _ in range(GET_ATTEMPTS):
+                offset = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+                response = self.send_command({"command": "get", "path": path, "offset": offset, "checksum": True})
                 
-                # Create directory structure if needed
-                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                if response["status"] != "success":
+                    if offset and "size" in response:
+                        # The local file is longer than the remote one
+                        os.remove(local_path)
+                        continue
+                    return f"Error: {response['message']}"
                 
-                # Write the file content
-                content = binascii.unhexlify(response["content"])
-                with open(local_path, 'wb') as f:
-                    f.write(content)
+                if response["type"] == "directory":
+                    return self.receive_directory(response)
                 
-                return f"Downloaded file to {local_path}"
+                error = self.receive_range(local_path, response)
+                if error is None:
+                    resumed = f" (resumed at {offset} bytes)" if offset else ""
+                    return f"Downloaded file to {local_path}{resumed}"
+                print(f"{error}, retrying")
+            return f"Error: could not download {path} after {GET_ATTEMPTS} attempts"
+        except Exception as e:
+            print(f"Error communicating with server: {e}")
+            return "Error: Communication error with server, run get again to resume"
+    
+    def receive_range(self, local_path, response):
+        # Append the checked byte range announced in response to local_path.
+        # Returns None once the whole file matches the server's digest,
+        # otherwise the reason it does not
+        offset = response["offset"]
+        digest = hashlib.sha256()
+        with open(local_path, 'r+b' if offset else 'wb') as f:
+            hash_file(f, digest, 0, offset)
+            f.seek(offset)
+            received, intact = self.conn.receive_file_checked(f, digest)
+        trailer = self.read_trailer()
+        
+        if not intact:
+            # Only verified chunks were written, the next attempt resumes after them
+            return f"Corrupt chunk after {offset + received} bytes of {local_path}"
+        if trailer["status"] != "success":
+            return f"Error reading {local_path} on the server: {trailer['message']}"
+        if trailer["sha256"] != digest.hexdigest():
+            # The remote file changed since the partial download, start over
+            os.remove(local_path)
+            return f"Checksum mismatch for {local_path}"
+        if offset + received != response["size"]:
+            return f"Incomplete download of {local_path} ({offset + received} of {response['size']} bytes)"
+        return None
+    
+    def receive_directory(self, response):
+        failed = []
+        for entry in response["files"]:
+            local_path = os.path.join(self.download_dir, entry["path"])
             
-            elif response["type"] == "directory":
-                files = response["files"]
-                for rel_path, content_hex in files.items():
-                    local_path = os.path.join(self.download_dir, rel_path)
-                    
-                    # Create directory structure if needed
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                    
-                    # Write the file content
-                    content = binascii.unhexlify(content_hex)
-                    with open(local_path, 'wb') as f:
-                        f.write(content)
-                
-                return f"Downloaded {len(files)} files from directory to {self.download_dir}"
+            # Create directory structure if needed
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            
+            digest = hashlib.sha256()
+            with open(local_path, 'wb') as f:
+                received, intact = self.conn.receive_file_checked(f, digest)
+            trailer = self.read_trailer()
+            if not intact or received != entry["size"] or trailer.get("sha256") != digest.hexdigest():
+                failed.append(entry["path"])
+        
+        if failed:
+            return f"Error: incomplete or corrupt download of {', '.join(failed)}"
+        return f"Downloaded {len(response['files'])} files from directory to {self.download_dir}"
+    
+    def open_stream(self, index=0):
+        # Extra connection for a parallel transfer. Streams are spread over
+        # the server and the replicas, skipping those that do not answer
+        nodes = [(self.host, self.port), *self.replicas]
+        for attempt in range(len(nodes)):
+            try:
+                conn = Connection(socket.create_connection(nodes[(index + attempt) % len(nodes)]))
+                break
+            except OSError:
+                if attempt == len(nodes) - 1:
+                    raise
+        try:
+            conn.hello(self.compression, self.codecs)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+    
+    def fetch(self, conn, request, sink, digest=None):
+        # Run one checked get on conn into sink. Returns the bytes written
+        # and None on success, otherwise the reason the transfer failed
+        request = dict(request, command="get", checksum=True, digest=digest is not None)
+        conn.send_message(request)
+        header = conn.recv_message()
+        if header is None:
+            raise ConnectionError("Connection closed by server")
+        if header["status"] != "success":
+            return 0, header["message"]
+        
+        received, intact = conn.receive_file_checked(sink, digest)
+        trailer = conn.recv_message()
+        if trailer is None:
+            raise ConnectionError("Connection closed by server")
+        if not intact:
+            return received, f"Corrupt chunk in {request['path']}"
+        if trailer["status"] != "success":
+            return received, trailer["message"]
+        if digest is not None and trailer.get("sha256") != digest.hexdigest():
+            return received, f"Checksum mismatch for {request['path']}"
+        if received != header.get("length", header["size"]):
+            return received, f"Incomplete download of {request['path']}"
+        return received, None
+    
+    def get_file_parallel(self, path, local_path, offset, size, streams):
+        # Fetch bytes offset..size of one file as byte ranges over parallel
+        # connections, each written in place into the preallocated local file.
+        # The ranges skip the server's digest, so the whole file is checked
+        # against it at the end; returns None when it does not match, after
+        # removing the local file so the caller starts over
+        step = -(-(size - offset) // streams)
+        ranges = [(start, min(step, size - start)) for start in range(offset, size, step)]
+        
+        def fetch_range(index):
+            start, length = ranges[index]
+            try:
+                conn = self.open_stream(index)
+            except OSError as e:
+                return str(e)
+            try:
+                _, error = self.fetch(conn, {"path": path, "offset": start, "length": length}, writers[index])
+                return error
+            except Exception as e:
+                return str(e)
+            finally:
+                conn.close()
+        
+        fd = os.open(local_path, os.O_RDWR | os.O_CREAT, 0o644)
+        writers = [RangeWriter(fd, start) for start, _ in ranges]
+        executor = ThreadPoolExecutor(max_workers=len(ranges))
+        complete = False
+        try:
+            try:
+                os.posix_fallocate(fd, offset, size - offset)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)
+            
+            errors = [error for error in executor.map(fetch_range, range(len(ranges))) if error]
+            if errors:
+                return f"Error: {errors[0]}, run get again to resume"
+            complete = True
+        finally:
+            # Also on Ctrl+C: stop the streams still running, then keep only
+            # the verified prefix, which a later get resumes from, instead of
+            # a full-size file with holes
+            for writer in writers:
+                writer.close()
+            executor.shutdown()
+            if not complete:
+                valid = offset
+                for (start, length), writer in zip(ranges, writers):
+                    valid = writer.position
+                    if writer.position < start + length:
+                        break
+                os.ftruncate(fd, valid)
+            os.close(fd)
+        
+        # A digest-only get, an empty range at the end of the file, returns
+        # the digest of the whole file. It also covers the resumed prefix,
+        # which was never compared with the server
+        digest = hashlib.sha256()
+        with open(local_path, 'rb') as f:
+            hash_file(f, digest)
+        _, error = self.fetch(self.conn, {"path": path, "offset": size, "length": 0}, None, digest)
+        if error:
+            # The remote file changed since the partial download, start over
+            os.remove(local_path)
+            return None
+        
+        resumed = f", resumed at {offset} bytes" if offset else ""
+        return f"Downloaded file to {local_path} ({len(ranges)} streams{resumed})"
+    
+    def get_directory_parallel(self, header, streams):
+        # Fetch the files of a directory over parallel connections, each
+        # taking the next file from a shared list, largest files first
+        entries = sorted(header["files"], key=lambda entry: entry["size"], reverse=True)
+        pending = iter(entries)
+        completed = set()
+        
+        for entry in entries:
+            os.makedirs(os.path.dirname(os.path.join(self.download_dir, entry["path"])), exist_ok=True)
+        
+        def worker(index):
+            try:
+                conn = self.open_stream(index)
+            except OSError as e:
+                print(f"Failed to connect to server: {e}")
+                return
+            try:
+                for entry in pending:
+                    with open(os.path.join(self.download_dir, entry["path"]), 'wb') as f:
+                        _, error = self.fetch(conn, {"path": entry["path"]}, f, hashlib.sha256())
+                    if not error:
+                        completed.add(entry["path"])
+            except Exception as e:
+                # The other connections pick up the remaining files
+                print(f"Error communicating with server: {e}")
+            finally:
+                conn.close()
+        
+        with ThreadPoolExecutor(max_workers=streams) as executor:
+            for index in range(min(streams, len(entries))):
+                executor.submit(worker, index)
+        
+        failed = [entry["path"] for entry in entries if entry["path"] not in completed]
+        if failed:
+            return f"Error: incomplete or corrupt download of {', '.join(failed)}"
+        return f"Downloaded {len(entries)} files from directory to {self.download_dir}"
+    
+    def node_client(self, node):
+        # Client for one storage node of the cluster, saving to the same folder
+        client = FileClient(node[0], node[1], self.streams, self.compression, self.codecs)
+        client.download_dir = self.download_dir
+        return client
+    
+    def get_from_cluster(self, path, streams):
+        # Ask the metadata server where path is stored, then fetch a file
+        # from its replicas, or the files of a directory from all their
+        # nodes at once, streams connections to each
+        location = self.send_command({"command": "locate", "path": path})
+        if location["status"] != "success":
+            return f"Error: {location['message']}"
+        
+        if location["type"] == "file":
+            # The fastest replica first; when one fails the next resumes the
+            # download, they all hold the same version
+            replicas = [tuple(node) for node in location.get("replicas") or [location["node"]]]
+            result = f"Error: no replica of {path} reachable"
+            for index, node in enumerate(replicas):
+                client = self.node_client(node)
+                client.replicas = replicas[index + 1:] + replicas[:index]
+                if not client.connect():
+                    continue
+                try:
+                    result = client.handle_get(path, streams)
+                finally:
+                    client.close()
+                if not result.startswith("Error"):
+                    break
+            return result
+        
+        if location.get("unreachable"):
+            print(f"Storage nodes unreachable, files they alone hold are missing: {', '.join(location['unreachable'])}")
+        by_node = {}
+        for entry in location["files"]:
+            by_node.setdefault(tuple(entry["node"]), []).append(entry)
         
-        return f"Error: {response['message']}"
+        def fetch_node(item):
+            node, entries = item
+            return self.node_client(node).get_directory_parallel({"files": entries}, streams)
+        
+        with ThreadPoolExecutor(max_workers=len(by_node) or 1) as executor:
+            errors = [result for result in executor.map(fetch_node, by_node.items()) if result.startswith("Error")]
+        if errors:
+            return "\n".join(errors)
+        return f"Downloaded {len(location['files'])} files from {len(by_node)} nodes to {self.download_dir}"
+    
+    def read_trailer(self):
+        # Status message following each checked file stream
+        trailer = self.conn.recv_message()
+        if trailer is None:
+            raise ConnectionError("Connection closed by server")
+        return trailer
     
     def show_help(self):
         return """
 Available commands:
-  ls [path]               - List contents of a directory or file details
+  ls [path] [key=value]   - List contents of a directory or file details
+                            options: sort=name|size|mtime reverse=true pattern=<glob>
+                            type=file|dir min_size=<bytes> max_size=<bytes>
   rm <path>               - Remove a file or directory
   cp <source> <dest>      - Copy a file or directory
-  get <path>              - Download a file or directory to 'downloads' folder
+  get <path> [streams=N]  - Download a file or directory to 'downloads' folder,
+                            resuming a partial file and verifying checksums;
+                            large files and directories use N connections (default 4)
+  stats                   - Show the server's request counts, latency percentiles
+                            (in seconds), traffic, connections and cache hits
   exit                    - Exit the client
         """
     
@@ -160,7 +539,7 @@ Available commands:
         
         try:
             while True:
-                command = input("\nEnter command (ls, rm, cp, get, help, exit): ")
+                command = input("\nEnter command (ls, rm, cp, get, stats, help, exit): ")
                 result = self.handle_command(command)
                 
                 if result is None:  # Exit command
@@ -172,6 +551,126 @@ Available commands:
         finally:
             self.close()
 
+class PooledFileClient:
+    # BigFS client library for scripts, safe to share between threads.
+    # Each call takes a connection from a pool (see common/pool.py), runs
+    # one command on it and gives it back, so many operations reuse a few
+    # warm connections instead of connecting and shaking hands each time:
+    #
+    #     with PooledFileClient("127.0.0.1", 9999) as fs:
+    #         fs.copy("a.txt", "backup/a.txt")
+    #
+    # Calls return their results and raise RuntimeError when the server
+    # refuses a command, ConnectionError when it cannot be reached;
+    # read-only commands are sent again once on a new connection if theirs
+    # fails. It talks to one server, not to the metadata server of a
+    # cluster. pool_options go to ConnectionPool (idle_timeout,
+    # check_after, attempts, backoff, max_backoff)
+    def __init__(self, host='127.0.0.1', port=9999, pool_size=POOL_SIZE, compression=None, codecs=None,
+                 **pool_options):
+        self.pool = ConnectionPool(lambda: open_connection(host, port, compression, codecs), pool_size,
+                                   ping=self.ping, **pool_options)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.pool.close()
+    
+    @staticmethod
+    def ping(conn):
+        conn.send_message({"command": "ls", "path": "", "options": {"limit": 1}})
+        if conn.recv_message() is None:
+            raise ConnectionError("Connection closed by server")
+    
+    def request(self, command_data, receive=None):
+        # Run one command and return its response, whatever its status.
+        # receive(conn, response), if given, reads the file streams that
+        # follow a successful response and its result is returned instead
+        attempts = 2 if command_data.get("command") in RETRIED_COMMANDS else 1
+        for attempt in range(attempts):
+            try:
+                with self.pool.connection() as conn:
+                    conn.send_message(command_data)
+                    response = conn.recv_message()
+                    if response is None:
+                        raise ConnectionError("Connection closed by server")
+                    if receive and response["status"] == "success":
+                        return receive(conn, response)
+                    return response
+            except OSError:
+                if attempt == attempts - 1:
+                    raise
+    
+    def call(self, command_data, receive=None):
+        response = self.request(command_data, receive)
+        if isinstance(response, dict) and response.get("status") == "error":
+            raise RuntimeError(response["message"])
+        return response
+    
+    def ls(self, path="", page_size=PAGE_SIZE, **options):
+        # All the entries of a directory, fetched page by page, as dicts of
+        # name, type ("file" or "directory") and, for files, size and mtime
+        options.setdefault("limit", page_size)
+        files = []
+        while True:
+            response = self.call({"command": "ls", "path": path, "options": options})
+            if response["type"] == "file":
+                return [{"name": response["name"], "type": "file", "size": response["size"]}]
+            files.extend(response["files"])
+            if not response.get("next_cursor"):
+                return files
+            options["cursor"] = response["next_cursor"]
+    
+    def remove(self, path):
+        return self.call({"command": "rm", "path": path})["message"]
+    
+    def copy(self, source, destination):
+        return self.call({"command": "cp", "source": source, "destination": destination})["message"]
+    
+    def get(self, path, local_path):
+        # Download a file to local_path, or the files of a directory into
+        # the local_path directory, checking every chunk and file digest.
+        # Returns the bytes received
+        return self.call({"command": "get", "path": path, "checksum": True},
+                         lambda conn, response: self.receive(conn, response, path, local_path))
+    
+    def receive(self, conn, response, path, local_path):
+        if response["type"] == "file":
+            targets = [(local_path, response["size"])]
+        else:
+            # The server names the files of a directory from its root
+            targets = [(os.path.join(local_path, os.path.relpath(entry["path"], os.path.normpath(path))),
+                        entry["size"]) for entry in response["files"]]
+        total = 0
+        failed = []
+        for target, size in targets:
+            if os.path.dirname(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            digest = hashlib.sha256()
+            with open(target, 'wb') as f:
+                received, intact = conn.receive_file_checked(f, digest)
+            trailer = conn.recv_message()
+            if trailer is None:
+                raise ConnectionError("Connection closed by server")
+            if not intact or received != size or trailer.get("sha256") != digest.hexdigest():
+                failed.append(target)
+            total += received
+        if failed:
+            raise RuntimeError(f"Incomplete or corrupt download of {', '.join(failed)}")
+        return total
+    
+    def stats(self):
+        return self.call({"command": "stats"})["stats"]
+
 if __name__ == "__main__":
-    client = FileClient()
+    parser = argparse.ArgumentParser(description="BigFS client")
+    parser.add_argument("--host", default="127.0.0.1", help="Server or cluster metadata server address")
+    parser.add_argument("--port", type=int, default=9999, help="Server port")
+    args = parser.parse_args()
+    
+    client = FileClient(args.host, args.port)
     client.run() 
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""Run a sharded BigFS cluster as local processes, for testing.
+
+Starts one storage node (server.py) per root directory, on the ports after
+the metadata server's, and the metadata server (metadata.py) in front of
+them. With --import the files of an existing tree are first spread over
+the node roots as the ring assigns them:
+
+    python cluster.py --nodes 3 --port 9999 --root cluster --import data
+    python client.py --port 9999
+
+Each file is kept on --replicas nodes, so killing one of them leaves its
+files readable. Starting again with more or fewer nodes changes the ring;
+--rebalance then moves every file to its new nodes once the cluster is up.
+Ctrl+C or SIGTERM stops all the processes.
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.protocol import Connection
+from hashring import HashRing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_tree(source, ring, roots, replicas=1):
+    # Copy every file under source into the roots of the nodes holding its
+    # replicas. Returns the number of files per node
+    counts = dict.fromkeys(roots, 0)
+    for directory, _, files in os.walk(source):
+        for name in files:
+            path = os.path.relpath(os.path.join(directory, name), source)
+            for node in ring.nodes_for(path, replicas):
+                destination = os.path.join(roots[node], path)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                # copy2 keeps the mtime, so all replicas have the same version
+                shutil.copy2(os.path.join(directory, name), destination)
+                counts[node] += 1
+    return counts
+
+
+def wait_for(host, port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def rebalance(host, port):
+    conn = Connection(socket.create_connection((host, port)))
+    try:
+        conn.hello()
+        conn.send_message({"command": "rebalance", "progress": True})
+        while True:
+            response = conn.recv_message()
+            if response is None or response["status"] != "progress":
+                return response
+            print(f"  {response['files_done']}/{response['files_total']} files moved")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a BigFS cluster as local processes")
+    parser.add_argument("--nodes", type=int, default=3, help="Number of storage nodes")
+    parser.add_argument("--host", default="127.0.0.1", help="Address every process listens on")
+    parser.add_argument("--port", type=int, default=9999, help="Port of the metadata server, nodes use the next ones")
+    parser.add_argument("--root", default="cluster", help="Directory holding the root of each node")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread", help="Engine of the storage nodes")
+    parser.add_argument("--import", dest="source", help="Spread the files of this tree over the nodes first")
+    parser.add_argument("--rebalance", action="store_true", help="Move files to the nodes the ring assigns them")
+    parser.add_argument("--replicas", type=int, default=3, help="Copies of each file")
+    parser.add_argument("--write-quorum", type=int, default=2, help="Replicas written before a write is acknowledged")
+    parser.add_argument("--read-quorum", type=int, default=2, help="Replicas asked for the newest version of a file")
+    args = parser.parse_args()
+
+    roots = {f"{args.host}:{args.port + i}": os.path.join(args.root, f"node{i}") for i in range(1, args.nodes + 1)}
+    ring = HashRing(roots)
+    for root in roots.values():
+        os.makedirs(root, exist_ok=True)
+    if args.source:
+        for node, count in import_tree(args.source, ring, roots, args.replicas).items():
+            print(f"Imported {count} files into {node}")
+
+    # Stopped by a signal, the cluster still takes its processes down
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    processes = []
+    try:
+        for node, root in roots.items():
+            port = int(node.rpartition(":")[2])
+            processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, "server.py"), "--host", args.host,
+                                               "--port", str(port), "--root", root, "--engine", args.engine,
+                                               "--cluster", f"{args.host}:{args.port}", *roots]))
+        processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, "metadata.py"), "--host", args.host,
+                                           "--port", str(args.port), "--nodes", *roots,
+                                           "--replicas", str(args.replicas), "--write-quorum", str(args.write_quorum),
+                                           "--read-quorum", str(args.read_quorum)]))
+        for port in [args.port, *(int(node.rpartition(":")[2]) for node in roots)]:
+            wait_for(args.host, port)
+        if args.rebalance:
+            print(rebalance(args.host, args.port)["message"])
+        print(f"Cluster of {args.nodes} nodes running, metadata server on {args.host}:{args.port}")
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        print("Stopping the cluster...")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
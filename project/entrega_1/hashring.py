@@ -0,0 +1,62 @@
+"""Consistent hashing of BigFS paths onto storage nodes.
+
+Every node is placed on a ring of 64-bit hashes at VNODES points, and a
+path belongs to the first node found walking clockwise from the hash of
+the path. Adding or removing a node only moves the paths next to its
+points, about 1/N of them, and the virtual points keep the share of each
+node close to even.
+"""
+import bisect
+import hashlib
+import posixpath
+
+VNODES = 128
+
+
+def normalize_path(path):
+    # The same file must hash the same however its path is written
+    path = posixpath.normpath(path.replace("\\", "/")).lstrip("/")
+    return "" if path == "." else path
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes=(), vnodes=VNODES):
+        self.vnodes = vnodes
+        self.nodes = []
+        # Sorted (hash, node) points of every node
+        self.points = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for replica in range(self.vnodes):
+            bisect.insort(self.points, (_hash(f"{node}#{replica}"), node))
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self.points = [point for point in self.points if point[1] != node]
+
+    def nodes_for(self, path, count=1):
+        # The first count distinct nodes clockwise from the hash of path
+        if not self.points:
+            raise ValueError("The ring has no nodes")
+        count = min(count, len(self.nodes))
+        start = bisect.bisect(self.points, (_hash(normalize_path(path)),))
+        found = []
+        for index in range(start, start + len(self.points)):
+            node = self.points[index % len(self.points)][1]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
+
+    def node_for(self, path):
+        return self.nodes_for(path)[0]
@@ -0,0 +1,601 @@
+"""Metadata server of a sharded, replicated BigFS cluster.
+
+Files are spread over several storage nodes, each an ordinary FileServer
+with its own root directory. The metadata server keeps no per-file state:
+a file is stored on the first `replicas` nodes found by consistent hashing
+of its path (see hashring.py), and directories exist on every node that
+holds a file below them. Every write stamps all the copies it makes with
+the same new mtime, which serves as the version of the file. It answers:
+
+- `locate`: the replicas of a file holding its newest version among the
+  first `read_quorum` to answer, fastest first, or every file of a
+  directory with its replicas, so clients fetch the data from the storage
+  nodes directly and spread over the replicas
+- `ls` and `rm`: sent to every node at once and the results merged
+- `cp`: every replica of the destination copies the file locally or pulls
+  it from a replica of the source; the answer comes once `write_quorum`
+  replicas have it. A replica that is down is written to the next node on
+  the ring instead, with a hint to hand the file over when it is back
+  (hinted handoff); an `rm` it missed is handed over the same way
+- `rebalance`: brings every file to the replicas the ring assigns it,
+  after nodes were added or removed or a replica was lost
+
+Clients recognize it by the "role" in its hello answer.
+"""
+import argparse
+import os
+import posixpath
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.pagination import page_with_options
+from common.protocol import Connection
+from common.server_core import PooledServer
+from hashring import HashRing, normalize_path
+
+BUSY_RESPONSE = {"status": "busy", "message": "Server busy, try again later"}
+
+# Idle connections kept open to each storage node
+IDLE_CONNECTIONS = 8
+
+# Seconds to wait for a storage node to accept a connection
+CONNECT_TIMEOUT = 5
+
+# Copies of each file, and how many of them a write and a read wait for.
+# With write and read quorums adding up to more than the replicas, a read
+# always hears from a replica that has the last acknowledged write
+REPLICAS = 3
+WRITE_QUORUM = 2
+READ_QUORUM = 2
+
+# Seconds between attempts at delivering hints to nodes that were down
+HANDOFF_INTERVAL = 5
+
+
+def node_address(node):
+    # "host:port" -> [host, port], as sent to clients and nodes
+    host, _, port = node.rpartition(":")
+    return [host, int(port)]
+
+
+def node_name(address):
+    # [host, port] -> "host:port"
+    return f"{address[0]}:{address[1]}"
+
+
+class NodeConnections:
+    # Connections to the storage nodes, reused across requests
+    def __init__(self, idle_limit=IDLE_CONNECTIONS):
+        self.idle_limit = idle_limit
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def call(self, node, message):
+        # Send one command to node and return its final response, skipping
+        # progress messages. Raises OSError when the node is unreachable
+        with self.lock:
+            idle = self.idle.get(node)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            try:
+                return self.exchange(node, conn, message)
+            except (OSError, ValueError):
+                # The node restarted since: its other idle connections are
+                # dead too, retry on a new one
+                self.discard(node)
+        return self.exchange(node, self.connect(node), message)
+
+    def connect(self, node):
+        sock = socket.create_connection(tuple(node_address(node)), timeout=CONNECT_TIMEOUT)
+        # Copies between nodes may take long, only connecting is bounded
+        sock.settimeout(None)
+        conn = Connection(sock)
+        try:
+            conn.hello()
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def exchange(self, node, conn, message):
+        try:
+            conn.send_message(message)
+            while True:
+                response = conn.recv_message()
+                if response is None:
+                    raise ConnectionError(f"Connection closed by node {node}")
+                if response.get("status") != "progress":
+                    break
+        except Exception:
+            conn.close()
+            raise
+        with self.lock:
+            idle = self.idle.setdefault(node, [])
+            if len(idle) < self.idle_limit:
+                idle.append(conn)
+                conn = None
+        if conn:
+            conn.close()
+        return response
+
+    def discard(self, node):
+        with self.lock:
+            idle = self.idle.pop(node, [])
+        for conn in idle:
+            conn.close()
+
+
+class MetadataServer:
+    def __init__(self, host='127.0.0.1', port=9999, nodes=(), workers=16, copy_workers=8,
+                 replicas=REPLICAS, write_quorum=WRITE_QUORUM, read_quorum=READ_QUORUM):
+        self.host = host
+        self.port = port
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ring = HashRing(nodes)
+        self.replicas = max(1, min(replicas, len(self.ring.nodes)))
+        self.write_quorum = max(1, min(write_quorum, self.replicas))
+        self.read_quorum = max(1, min(read_quorum, self.replicas))
+        # Writes missed by nodes that were down, see add_hint
+        self.hints = []
+        self.hints_lock = threading.Lock()
+        self.nodes = NodeConnections()
+        # Threads sending one request to several nodes at once
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Files copied in parallel by a cp of a directory
+        self.copy_workers = copy_workers
+        self.pool = None
+
+    def start(self, max_connections=256, accept_queue=128):
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(socket.SOMAXCONN)
+        print(f"BigFS metadata server started on {self.host}:{self.port}")
+        print(f"Storage nodes: {', '.join(self.ring.nodes)}")
+        print(f"Replicas: {self.replicas}, write quorum: {self.write_quorum}, read quorum: {self.read_quorum}")
+        threading.Thread(target=self.hand_off_forever, daemon=True).start()
+
+        try:
+            self.pool = PooledServer(self.server_socket, self.handle_client, max_connections, accept_queue,
+                                     reject=self.reject_client)
+            self.pool.serve_forever()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+            if self.pool:
+                self.pool.shutdown()
+        finally:
+            self.server_socket.close()
+
+    def reject_client(self, client_socket, address):
+        print(f"Server busy, turning away {address}")
+        Connection(client_socket).send_message(BUSY_RESPONSE)
+
+    def handle_client(self, client_socket, address):
+        print(f"Client connected from {address}")
+        conn = Connection(client_socket)
+        try:
+            while True:
+                try:
+                    command_data = conn.recv_message()
+                except ValueError:
+                    conn.send_message({"status": "error", "message": "Invalid command format"})
+                    continue
+
+                if command_data is None:
+                    break
+                if command_data.get('command') == 'hello':
+                    conn.accept_hello(command_data, role="metadata")
+                    continue
+
+                progress = None
+                if command_data.get('progress'):
+                    progress = lambda state: conn.send_message(dict(state, status="progress"))
+                conn.send_message(self.dispatch(command_data, progress))
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            conn.close()
+            print("Client disconnected")
+
+    def dispatch(self, command_data, progress=None):
+        command = command_data.get('command')
+        try:
+            if command == 'locate':
+                return self.locate(command_data.get('path', ''))
+            elif command == 'ls':
+                return self.list_files(command_data.get('path', ''), command_data.get('options'))
+            elif command == 'rm':
+                return self.remove_file(command_data.get('path', ''))
+            elif command == 'cp':
+                return self.copy_file(command_data.get('source', ''), command_data.get('destination', ''), progress)
+            elif command == 'rebalance':
+                return self.rebalance(progress)
+            elif command == 'get':
+                return {"status": "error", "message": "File data is served by the storage nodes, use locate"}
+            return {"status": "error", "message": f"Unknown command: {command}"}
+        except Exception as e:
+            return {"status": "error", "message": f"Error running {command}: {str(e)}"}
+
+    def call(self, node, message):
+        # node's response, or an error response if it cannot be reached
+        try:
+            return self.nodes.call(node, message)
+        except (OSError, ValueError) as e:
+            return {"status": "error", "message": f"Node {node} unreachable: {e}", "unreachable": True}
+
+    def broadcast(self, message):
+        # Send message to every node at once, returns {node: response}
+        nodes = list(self.ring.nodes)
+        return dict(zip(nodes, self.executor.map(lambda node: self.call(node, message), nodes)))
+
+    def homes(self, path):
+        # The nodes path is replicated on, and after them the nodes standing
+        # in for those that are down
+        preference = self.ring.nodes_for(path, len(self.ring.nodes))
+        return preference[:self.replicas], preference[self.replicas:]
+
+    def scan(self, path):
+        # Every file at or under path on every node, as {file path: {node:
+        # entry}}, plus the nodes that could not be asked
+        files = {}
+        unreachable = []
+        found = False
+        # Storage nodes take "." for their root directory
+        for node, response in self.broadcast({"command": "get", "path": path or ".", "data": False}).items():
+            if response["status"] != "success":
+                if response.get("unreachable"):
+                    unreachable.append(node)
+                continue
+            found = True
+            if response["type"] == "file":
+                files.setdefault(path, {})[node] = dict(response, path=path)
+            else:
+                for entry in response["files"]:
+                    files.setdefault(entry["path"], {})[node] = entry
+        return (files if found else None), unreachable
+
+    def read_replicas(self, path):
+        # Ask the replicas of a file for its header at once and return the
+        # newest version among the first read_quorum answers, listing the
+        # replicas that hold it fastest first. With fewer replicas alive the
+        # newest one found is served. None when no replica has the file
+        homes, _ = self.homes(path)
+        futures = {self.executor.submit(self.call, node, {"command": "get", "path": path, "data": False}): node
+                   for node in homes}
+        answered = 0
+        found = []
+        for future in as_completed(futures):
+            response = future.result()
+            if not response.get("unreachable"):
+                answered += 1
+            if response["status"] == "success" and response["type"] == "file":
+                found.append((futures[future], response))
+            if found and answered >= self.read_quorum:
+                break
+        if not found:
+            return None
+        newest = max(response["mtime_ns"] for _, response in found)
+        current = [(node, response) for node, response in found if response["mtime_ns"] == newest]
+        replicas = [node_address(node) for node, _ in current]
+        return dict(current[0][1], node=replicas[0], replicas=replicas)
+
+    def locate(self, path):
+        # Where the data of path lives: the replicas of a file, or the files
+        # of a directory each with its replicas
+        path = normalize_path(path)
+        if path:
+            response = self.read_replicas(path)
+            if response:
+                return response
+
+        # A directory, or a file not yet moved to the nodes the ring assigns it
+        files, unreachable = self.scan(path)
+        if files is None:
+            return {"status": "error", "message": f"File not found: {path}"}
+        if path in files:
+            node, entry = max(files[path].items(), key=lambda item: item[1]["mtime_ns"])
+            return {"status": "success", "type": "file", "name": posixpath.basename(path), "size": entry["size"],
+                    "mtime_ns": entry["mtime_ns"], "node": node_address(node), "replicas": [node_address(node)],
+                    "message": f"File located: {path}"}
+
+        # Each file is read from the least loaded of the replicas holding its
+        # newest version, so a directory is fetched from all nodes at once
+        load = dict.fromkeys(self.ring.nodes, 0)
+        entries = []
+        for file_path, holders in sorted(files.items()):
+            newest = max(entry["mtime_ns"] for entry in holders.values())
+            current = [node for node, entry in holders.items() if entry["mtime_ns"] == newest]
+            node = min(current, key=load.get)
+            load[node] += holders[node]["size"]
+            entries.append(dict(holders[node], node=node_address(node),
+                                replicas=[node_address(replica) for replica in current]))
+        response = {
+            "status": "success",
+            "type": "directory",
+            "name": posixpath.basename(path),
+            "files": entries,
+            "message": f"Directory contents located: {path}"
+        }
+        if unreachable:
+            response["unreachable"] = unreachable
+        return response
+
+    def list_files(self, path, options=None):
+        # Merge the listings of every node, then sort, filter and page them
+        # like a single server would
+        entries = {}
+        unreachable = []
+        found = False
+        for node, response in self.broadcast({"command": "ls", "path": path}).items():
+            if response["status"] != "success":
+                if response.get("unreachable"):
+                    unreachable.append(node)
+                continue
+            found = True
+            if response["type"] == "file":
+                return response
+            for entry in response["files"]:
+                if entry["type"] == "directory":
+                    entries[entry["name"]] = (entry["name"], True, 0, 0)
+                elif entry["name"] not in entries or entries[entry["name"]][3] < entry.get("mtime", 0):
+                    # Replicas may be behind, the newest version is listed
+                    entries[entry["name"]] = (entry["name"], False, entry["size"], entry.get("mtime", 0))
+        if not found:
+            return {"status": "error", "message": f"Path does not exist: {path}"}
+
+        try:
+            page, next_cursor = page_with_options(sorted(entries.values()), options)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        message = f"Contents of {path if path else 'root directory'}:"
+        if unreachable:
+            message = f"{message} (nodes unreachable, their files may be missing: {', '.join(unreachable)})"
+        files = []
+        for name, is_dir, size, mtime in page:
+            if is_dir:
+                files.append({"name": name, "type": "directory"})
+            else:
+                files.append({"name": name, "type": "file", "size": size, "mtime": mtime})
+        return {
+            "status": "success",
+            "type": "directory",
+            "files": files,
+            "next_cursor": next_cursor,
+            "message": message
+        }
+
+    def remove_file(self, path):
+        if not normalize_path(path):
+            return {"status": "error", "message": "No file path provided"}
+        # Like a write, the removal gets a version: files written after it
+        # are kept, even when a node only learns of it from a hint
+        version = time.time_ns()
+        responses = self.broadcast({"command": "rm", "path": path, "mtime_ns": version})
+        removed = [node for node, response in responses.items() if response["status"] == "success"]
+        unreachable = [node for node, response in responses.items() if response.get("unreachable")]
+        # Nodes that are down remove their copies once they are back
+        for node in unreachable:
+            self.add_hint(node, path, version=version)
+        if not removed:
+            return {"status": "error", "message": f"File not found: {path}"}
+        message = f"Removed {path} from {len(removed)} node(s)"
+        if unreachable:
+            message += f", nodes unreachable, removing it when they are back: {', '.join(unreachable)}"
+        return {"status": "success", "message": message}
+
+    def store_copy(self, node, sources, path, destination, version=None):
+        # Have node store the file path held by the sources nodes as
+        # destination: a local cp if it holds the file, otherwise a pull from
+        # the first source that serves it. version, if given, is the mtime
+        # the copy gets, otherwise it keeps the source's. The node refuses
+        # the copy as "stale" if it holds a newer version
+        if node in sources:
+            return self.call(node, {"command": "cp", "source": path, "destination": destination, "mtime_ns": version})
+        response = {"status": "error", "message": f"No source for {path}"}
+        for source in sources:
+            response = self.call(node, {"command": "pull", "source": node_address(source), "path": path,
+                                        "destination": destination, "mtime_ns": version})
+            if response["status"] == "success" or response.get("unreachable") or response.get("stale"):
+                break
+        return response
+
+    def write(self, sources, path, destination):
+        # Copy the file path held by sources to destination on each of its
+        # replicas, all stamped with the same new version. Returns once
+        # write_quorum replicas have it, the others finish in the
+        # background. A replica that is down is written to the next node
+        # standing in for it, which hands the file over once it is back. A
+        # replica refusing it as stale already has a later write, which
+        # supersedes this one, so it counts as written
+        version = time.time_ns()
+        homes, standby = self.homes(destination)
+        standby = iter(standby)
+        lock = threading.Lock()
+
+        def write_replica(home):
+            response = self.store_copy(home, sources, path, destination, version)
+            while response.get("unreachable"):
+                with lock:
+                    stand_in = next(standby, None)
+                if stand_in is None:
+                    break
+                response = self.store_copy(stand_in, sources, path, destination, version)
+                if response["status"] == "success":
+                    self.add_hint(home, destination, stand_in, version)
+            return response
+
+        written = 0
+        errors = []
+        for future in as_completed([self.executor.submit(write_replica, home) for home in homes]):
+            response = future.result()
+            if response["status"] == "success" or response.get("stale"):
+                written += 1
+                if written == self.write_quorum:
+                    return {"status": "success", "message": f"{destination} written to {written} replicas"}
+            else:
+                errors.append(response["message"])
+        return {"status": "error",
+                "message": f"Only {written} of {self.write_quorum} replicas of {destination} written: "
+                           f"{'; '.join(errors)}"}
+
+    def add_hint(self, node, path, holder=None, version=None):
+        # Remember a write node missed while it was down: the stand-in node
+        # holder has its copy of path, or with no holder path was removed.
+        # version is the one of the write or removal, so it doesn't undo a
+        # later write when handed over
+        with self.hints_lock:
+            self.hints.append({"node": node, "path": path, "holder": holder, "version": version})
+
+    def hand_off(self):
+        # Deliver the hints of nodes that are back, in the order they came
+        with self.hints_lock:
+            hints, self.hints = self.hints, []
+        pending = []
+        for hint in hints:
+            node, path, holder, version = hint["node"], hint["path"], hint["holder"], hint["version"]
+            if any(node == other["node"] for other in pending):
+                # Still down, the hints for it keep their order
+                pending.append(hint)
+                continue
+            if holder is None:
+                response = self.call(node, {"command": "rm", "path": path, "mtime_ns": version})
+            else:
+                response = self.store_copy(node, [holder], path, path, version)
+                if (response["status"] == "success" or response.get("stale")) and holder not in self.homes(path)[0]:
+                    self.call(holder, {"command": "rm", "path": path, "mtime_ns": version})
+            if response.get("unreachable"):
+                pending.append(hint)
+            elif response.get("stale"):
+                print(f"Skipped hint for {path} on {node}: it holds a newer version")
+            elif response["status"] == "success" or holder is None:
+                print(f"Handed off {path} to {node}")
+            else:
+                # The stand-in lost its copy, rebalance repairs the replica
+                print(f"Dropped hint for {path} on {node}: {response['message']}")
+        with self.hints_lock:
+            self.hints[:0] = pending
+
+    def hand_off_forever(self):
+        while True:
+            time.sleep(HANDOFF_INTERVAL)
+            try:
+                self.hand_off()
+            except Exception as e:
+                print(f"Error handing off hints: {e}")
+
+    def copy_file(self, source, destination, progress=None):
+        source = normalize_path(source)
+        destination = normalize_path(destination)
+        if not source or not destination:
+            return {"status": "error", "message": "Source and destination paths are required"}
+
+        location = self.locate(source)
+        if location["status"] != "success":
+            return {"status": "error", "message": f"Source not found: {source}"}
+        target = self.locate(destination)
+
+        if location["type"] == "file":
+            if target["status"] == "success" and target["type"] == "directory":
+                destination = posixpath.join(destination, posixpath.basename(source))
+            response = self.write([node_name(node) for node in location["replicas"]], source, destination)
+            if response["status"] != "success":
+                return response
+            return {"status": "success", "message": f"File copied from {source} to {destination}"}
+
+        if target["status"] == "success":
+            return {"status": "error", "message": f"Destination directory already exists: {destination}"}
+        state = {"files_done": 0, "files_total": len(location["files"]), "bytes_done": 0,
+                 "bytes_total": sum(entry["size"] for entry in location["files"])}
+        lock = threading.Lock()
+        last_report = [time.monotonic()]
+
+        def copy_entry(entry):
+            relative = posixpath.relpath(entry["path"], source)
+            response = self.write([node_name(node) for node in entry["replicas"]], entry["path"],
+                                  posixpath.join(destination, relative))
+            with lock:
+                state["files_done"] += 1
+                state["bytes_done"] += entry["size"]
+                report = progress and time.monotonic() - last_report[0] >= 0.5
+                if report:
+                    last_report[0] = time.monotonic()
+                    snapshot = dict(state)
+            if report:
+                progress(snapshot)
+            return None if response["status"] == "success" else f"{entry['path']}: {response['message']}"
+
+        with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+            errors = [error for error in executor.map(copy_entry, location["files"]) if error]
+        if errors:
+            return {"status": "error", "message": f"Error copying {len(errors)} files: {'; '.join(errors[:5])}"}
+        return {
+            "status": "success",
+            "message": f"Directory copied from {source} to {destination} "
+                       f"({state['files_done']} files, {state['bytes_done']} bytes)"
+        }
+
+    def rebalance(self, progress=None):
+        # Bring every file to the replicas the ring assigns it: those lacking
+        # its newest version pull it, then it is removed from other nodes
+        files, unreachable = self.scan("")
+        if unreachable:
+            return {"status": "error", "message": f"Nodes unreachable, not rebalancing: {', '.join(unreachable)}"}
+        repairs = []
+        for path, holders in (files or {}).items():
+            newest = max(entry["mtime_ns"] for entry in holders.values())
+            current = [node for node, entry in holders.items() if entry["mtime_ns"] == newest]
+            homes, _ = self.homes(path)
+            missing = [node for node in homes if node not in current]
+            extra = [node for node in holders if node not in homes]
+            if missing or extra:
+                repairs.append((path, holders[current[0]]["size"], newest, current, missing, extra))
+        state = {"files_done": 0, "files_total": len(repairs), "bytes_done": 0,
+                 "bytes_total": sum(repair[1] for repair in repairs)}
+        lock = threading.Lock()
+
+        def repair(item):
+            path, size, version, current, missing, extra = item
+            errors = []
+            for node in missing:
+                response = self.store_copy(node, current, path, path)
+                if response["status"] != "success" and not response.get("stale"):
+                    errors.append(response["message"])
+            if not errors:
+                for node in extra:
+                    response = self.call(node, {"command": "rm", "path": path, "mtime_ns": version})
+                    if response["status"] != "success" and not response.get("stale"):
+                        errors.append(response["message"])
+            with lock:
+                state["files_done"] += 1
+                state["bytes_done"] += size
+                snapshot = dict(state)
+            if progress:
+                progress(snapshot)
+            return f"{path}: {'; '.join(errors)}" if errors else None
+
+        with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+            errors = [error for error in executor.map(repair, repairs) if error]
+        if errors:
+            return {"status": "error", "message": f"Error moving {len(errors)} files: {'; '.join(errors[:5])}"}
+        return {"status": "success", "moved": len(repairs),
+                "message": f"Moved or re-replicated {len(repairs)} files ({state['bytes_done']} bytes)"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BigFS cluster metadata server')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=9999, help='Port to listen on')
+    parser.add_argument('--nodes', nargs='+', required=True, metavar='HOST:PORT', help='Storage nodes')
+    parser.add_argument('--max-connections', type=int, default=256, help='Clients served at once')
+    parser.add_argument('--accept-queue', type=int, default=128, help='Clients waiting for a thread before the server answers busy')
+    parser.add_argument('--copy-workers', type=int, default=8, help='Files copied at once by cp of a directory')
+    parser.add_argument('--replicas', type=int, default=REPLICAS, help='Copies of each file')
+    parser.add_argument('--write-quorum', type=int, default=WRITE_QUORUM, help='Replicas written before a write is acknowledged')
+    parser.add_argument('--read-quorum', type=int, default=READ_QUORUM, help='Replicas asked for the newest version of a file')
+    args = parser.parse_args()
+
+    server = MetadataServer(args.host, args.port, args.nodes, copy_workers=args.copy_workers, replicas=args.replicas,
+                            write_quorum=args.write_quorum, read_quorum=args.read_quorum)
+    server.start(args.max_connections, args.accept_queue)
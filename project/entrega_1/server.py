@@ -1,121 +1,333 @@
 import socket
 import os
 import shutil
-import json
+import sys
+import argparse
+import hashlib
 import threading
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chunkstore import ChunkStore, logical_size, read_manifest
+from common.aio import AsyncServer
+from common.digest_cache import DigestCache
+from common.listing_cache import ListingCache
+from common.metrics import server_metrics
+from common.outbox import AsyncOutbox
+from common.pagination import page_with_options
+from common.profiling import RequestProfiler
+from common.protocol import Connection
+from common.server_core import PooledServer
+from common.transfer import hash_file
+from common.treecopy import copy_file, copy_tree
+
+BUSY_RESPONSE = {"status": "busy", "message": "Server busy, try again later"}
+
+# Commands counted under their own name in the metrics, others as "other"
+COMMANDS = ("ls", "rm", "cp", "get", "pull", "stats")
+
+# Seconds a pull waits to connect to its source node, or for data from it
+PULL_TIMEOUT = 30
 
 class FileServer:
-    def __init__(self, host='127.0.0.1', port=9999):
+    def __init__(self, host='127.0.0.1', port=9999, root_dir="data", use_sendfile=True, copy_workers=8,
+                 chunk_store=None, cluster=()):
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.root_dir = "data"
+        self.root_dir = root_dir
+        # Zero-copy os.sendfile for downloads, falling back to buffered reads
+        self.use_sendfile = use_sendfile
+        # Threads copying the files of one directory tree in parallel
+        self.copy_workers = copy_workers
+        # With a chunk store directory, files under root_dir are manifests of
+        # deduplicated chunks kept there (see chunkstore.py); plain files
+        # are still served as they are
+        self.store = ChunkStore(chunk_store) if chunk_store else None
+        # Directory listings, revalidated by mtime and dropped on our own mutations
+        self.listing_cache = ListingCache(file_size=logical_size if self.store else None)
+        # SHA-256 of whole files, sent at the end of checked gets without
+        # reading back the part of the file a resumed download already has
+        self.digests = DigestCache()
+        # Files being pulled from another server are received next to the
+        # root, so they never show up in it half written
+        self.incoming_dir = f"{os.path.abspath(self.root_dir)}.incoming"
+        # Held while a received file replaces the one at its path, so the
+        # version check and the rename happen as one (see install)
+        self.install_lock = threading.Lock()
+        # The metadata server and storage nodes ("host:port") of the cluster
+        # this node belongs to. A pull makes the node connect out, so only
+        # their hosts may ask for one, and only from one of them
+        self.cluster = set()
+        self.cluster_hosts = set()
+        for member in cluster:
+            member_host, _, member_port = member.rpartition(":")
+            self.cluster.add((member_host, int(member_port)))
+            self.cluster_hosts.update(info[4][0] for info in socket.getaddrinfo(member_host, member_port))
+        self.async_server = None
+        self.pool = None
+        # Request counts and latencies, bytes and connections, read with the
+        # stats command or over HTTP (see common/metrics.py)
+        self.metrics = server_metrics("bigfs", self.active_connections, self.listing_cache)
+        # Phase timings, sampled profiles and slow request dumps, when
+        # enabled (see common/profiling.py)
+        self.profiler = None
         
         # Create the root directory if it doesn't exist
         if not os.path.exists(self.root_dir):
             os.makedirs(self.root_dir)
     
-    def start(self):
+    def start(self, engine='thread', max_connections=256, workers=32, accept_queue=128):
+        # Both engines serve at most max_connections clients at once. 'thread'
+        # uses one pooled thread per client and answers "busy" once
+        # accept_queue more are waiting; 'asyncio' uses one event loop and
+        # runs blocking calls on `workers` threads
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"BigFS Server started on {self.host}:{self.port}")
+        self.server_socket.listen(socket.SOMAXCONN)
+        print(f"BigFS Server started on {self.host}:{self.port} ({engine} engine)")
         print(f"Root directory: {os.path.abspath(self.root_dir)}")
         
         try:
-            while True:
-                client_socket, address = self.server_socket.accept()
-                print(f"Client connected from {address}")
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
-                client_thread.daemon = True
-                client_thread.start()
+            if engine == 'asyncio':
+                self.server_socket.setblocking(False)
+                self.async_server = AsyncServer(self.server_socket, self.handle_client_async, max_connections, workers)
+                self.async_server.run()
+                return
+            
+            self.pool = PooledServer(self.server_socket, self.handle_client, max_connections, accept_queue,
+                                     reject=self.reject_client)
+            self.pool.serve_forever()
         except KeyboardInterrupt:
             print("Server shutting down...")
+            if self.pool:
+                self.pool.shutdown()
         finally:
             self.server_socket.close()
     
-    def handle_client(self, client_socket):
+    def active_connections(self):
+        if self.pool:
+            return len(self.pool.active)
+        return self.async_server.active if self.async_server else 0
+    
+    def record_request(self, command, status, started):
+        command = command if command in COMMANDS else "other"
+        self.metrics.inc("requests_total", command=command, status=status)
+        self.metrics.observe("request_seconds", time.perf_counter() - started, command=command)
+    
+    def begin_trace(self, conn, command_data, address):
+        # Start profiling a request just received, None unless profiling is on
+        if not self.profiler:
+            return None
+        command = command_data.get('command')
+        return self.profiler.begin(command if command in COMMANDS else "other", f"{address[0]}:{address[1]}",
+                                   command_data, conn.decode_seconds)
+    
+    def run_traced(self, trace, function, *args):
+        if trace:
+            return self.profiler.call(trace, function, *args)
+        return function(*args)
+    
+    def reject_client(self, client_socket, address):
+        self.metrics.inc("connections_rejected_total")
+        print(f"Server busy, turning away {address}")
+        Connection(client_socket).send_message(BUSY_RESPONSE)
+    
+    def dispatch(self, command_data, progress=None, address=None):
+        # Run one command sent from address and return its response plus the
+        # files to stream after it. progress, if given, sends interim status
+        # messages
+        command = command_data.get('command')
+        
+        if command == 'ls':
+            return self.list_files(command_data.get('path', ''), command_data.get('options')), []
+        elif command == 'rm':
+            return self.remove_file(command_data.get('path', ''), command_data.get('mtime_ns')), []
+        elif command == 'cp':
+            return self.copy_file(
+                command_data.get('source', ''),
+                command_data.get('destination', ''),
+                progress,
+                command_data.get('mtime_ns')
+            ), []
+        elif command == 'get':
+            return self.get_file(
+                command_data.get('path', ''),
+                command_data.get('offset', 0),
+                command_data.get('length'),
+                command_data.get('data', True)
+            )
+        elif command == 'pull':
+            if not self.pull_allowed(address, command_data.get('source')):
+                return {"status": "error", "message": "Pulls are only accepted from the cluster"}, []
+            return self.pull_file(
+                command_data.get('source'),
+                command_data.get('path', ''),
+                command_data.get('destination'),
+                command_data.get('mtime_ns')
+            ), []
+        elif command == 'stats':
+            return {"status": "success", "stats": self.metrics.snapshot()}, []
+        else:
+            return {"status": "error", "message": f"Unknown command: {command}"}, []
+    
+    def handle_client(self, client_socket, address):
+        print(f"Client connected from {address}")
+        conn = Connection(client_socket)
+        conn.metrics = self.metrics
+        conn.time_decode = self.profiler is not None
+        self.metrics.inc("connections_total")
         try:
             while True:
-                data = client_socket.recv(4096).decode('utf-8')
-                if not data:
+                try:
+                    command_data = conn.recv_message()
+                except ValueError:
+                    conn.send_message({
+                        "status": "error", 
+                        "message": "Invalid command format"
+                    })
+                    continue
+                
+                if command_data is None:
                     break
+                if command_data.get('command') == 'hello':
+                    conn.accept_hello(command_data)
+                    continue
                 
+                started = time.perf_counter()
+                trace = self.begin_trace(conn, command_data, address)
+                progress = None
+                if command_data.get('progress'):
+                    progress = lambda state: conn.send_message(dict(state, status="progress"))
+                
+                response, files = self.run_traced(trace, self.dispatch, command_data, progress, address)
+                if trace:
+                    trace.send_message(conn, response)
+                else:
+                    conn.send_message(response)
+                sending = time.perf_counter()
+                checksum = command_data.get('checksum', False)
+                digest = command_data.get('digest', True)
+                for file_path, offset, length in files:
+                    self.stream_file(conn, file_path, offset, length, checksum, digest)
+                if trace:
+                    trace.add("send", time.perf_counter() - sending)
+                    self.profiler.finish(trace, response.get('status'))
+                self.record_request(command_data.get('command'), response.get('status'), started)
+        except Exception as e:
+            print(f"Error handling client: {e}")
+        finally:
+            conn.close()
+            print("Client disconnected")
+    
+    async def handle_client_async(self, conn, address):
+        print(f"Client connected from {address}")
+        run_blocking = self.async_server.run_blocking
+        conn.metrics = self.metrics
+        conn.time_decode = self.profiler is not None
+        self.metrics.inc("connections_total")
+        # Progress reports, written without holding the worker that copies
+        outbox = AsyncOutbox(conn)
+        try:
+            while True:
                 try:
-                    command_data = json.loads(data)
-                    command = command_data.get('command')
-                    
-                    if command == 'ls':
-                        response = self.list_files(command_data.get('path', ''))
-                    elif command == 'rm':
-                        response = self.remove_file(command_data.get('path', ''))
-                    elif command == 'cp':
-                        response = self.copy_file(
-                            command_data.get('source', ''),
-                            command_data.get('destination', '')
-                        )
-                    elif command == 'get':
-                        response = self.get_file(command_data.get('path', ''))
-                    else:
-                        response = {"status": "error", "message": f"Unknown command: {command}"}
-                    
-                    client_socket.send(json.dumps(response).encode('utf-8'))
-                except json.JSONDecodeError:
-                    client_socket.send(json.dumps({
+                    command_data = await conn.recv_message()
+                except ValueError:
+                    await conn.send_message({
                         "status": "error", 
                         "message": "Invalid command format"
-                    }).encode('utf-8'))
+                    })
+                    continue
+                
+                if command_data is None:
+                    break
+                if command_data.get('command') == 'hello':
+                    await conn.accept_hello(command_data)
+                    continue
+                
+                started = time.perf_counter()
+                trace = self.begin_trace(conn, command_data, address)
+                progress = None
+                if command_data.get('progress'):
+                    # Called from the worker thread, which must not wait for
+                    # the client to read; reports are dropped if it falls far behind
+                    progress = lambda state: outbox.put(dict(state, status="progress"), droppable=True)
+                
+                response, files = await run_blocking(self.run_traced, trace, self.dispatch, command_data, progress,
+                                                     address)
+                if progress:
+                    # The response goes after the reports
+                    await outbox.flush()
+                if trace:
+                    await trace.send_message_async(conn, response)
+                else:
+                    await conn.send_message(response)
+                sending = time.perf_counter()
+                checksum = command_data.get('checksum', False)
+                digest = command_data.get('digest', True)
+                for file_path, offset, length in files:
+                    await self.stream_file_async(conn, file_path, offset, length, checksum, digest)
+                if trace:
+                    trace.add("send", time.perf_counter() - sending)
+                    self.profiler.finish(trace, response.get('status'))
+                self.record_request(command_data.get('command'), response.get('status'), started)
         except Exception as e:
             print(f"Error handling client: {e}")
         finally:
-            client_socket.close()
+            await outbox.close()
             print("Client disconnected")
     
-    def list_files(self, path):
+    def list_files(self, path, options=None):
+        # options select one page of a sorted, filtered listing (see
+        # common/pagination.py); next_cursor fetches the page after it
         full_path = os.path.join(self.root_dir, path)
         
         if not os.path.exists(full_path):
             return {"status": "error", "message": f"Path does not exist: {path}"}
         
         if os.path.isfile(full_path):
-            file_stat = os.stat(full_path)
+            size = self.file_size(full_path)
             return {
                 "status": "success",
                 "type": "file",
                 "name": os.path.basename(full_path),
-                "size": file_stat.st_size,
-                "message": f"File: {os.path.basename(full_path)}, Size: {file_stat.st_size} bytes"
+                "size": size,
+                "message": f"File: {os.path.basename(full_path)}, Size: {size} bytes"
             }
         
         try:
-            files = os.listdir(full_path)
             file_details = []
+            page, next_cursor = page_with_options(self.listing_cache.get(os.path.abspath(full_path)), options)
             
-            for file in files:
-                file_path = os.path.join(full_path, file)
-                if os.path.isfile(file_path):
-                    file_stat = os.stat(file_path)
+            for name, is_dir, size, mtime in page:
+                if is_dir:
                     file_details.append({
-                        "name": file,
-                        "type": "file",
-                        "size": file_stat.st_size
+                        "name": name,
+                        "type": "directory"
                     })
                 else:
                     file_details.append({
-                        "name": file,
-                        "type": "directory"
+                        "name": name,
+                        "type": "file",
+                        "size": size,
+                        "mtime": mtime
                     })
             
             return {
                 "status": "success",
                 "type": "directory",
                 "files": file_details,
+                "next_cursor": next_cursor,
                 "message": f"Contents of {path if path else 'root directory'}:"
             }
         except Exception as e:
             return {"status": "error", "message": f"Error listing files: {str(e)}"}
     
-    def remove_file(self, path):
+    def remove_file(self, path, mtime_ns=None):
+        # mtime_ns, if given, is the version of the removal: files written
+        # with a newer one since are kept, so a late removal handed over by
+        # the metadata server can't undo a later write
         if not path:
             return {"status": "error", "message": "No file path provided"}
         
@@ -126,15 +338,76 @@ class FileServer:
         
         try:
             if os.path.isfile(full_path):
-                os.remove(full_path)
+                with self.install_lock:
+                    if mtime_ns is not None and os.stat(full_path).st_mtime_ns > mtime_ns:
+                        return {"status": "error", "stale": True, "message": f"{path} is newer than the removal"}
+                    os.remove(full_path)
                 return {"status": "success", "message": f"File removed successfully: {path}"}
             elif os.path.isdir(full_path):
-                shutil.rmtree(full_path)
+                if mtime_ns is None:
+                    shutil.rmtree(full_path)
+                    return {"status": "success", "message": f"Directory and all contents removed: {path}"}
+                kept = self.remove_older(full_path, mtime_ns)
+                if kept:
+                    return {"status": "success",
+                            "message": f"Directory contents removed: {path}, {kept} newer files kept"}
                 return {"status": "success", "message": f"Directory and all contents removed: {path}"}
         except Exception as e:
             return {"status": "error", "message": f"Error removing file: {str(e)}"}
+        finally:
+            self.listing_cache.invalidate(os.path.abspath(full_path))
     
-    def copy_file(self, source, destination):
+    def remove_older(self, directory, mtime_ns):
+        # Remove the files under directory no newer than mtime_ns and the
+        # directories left empty. Returns the number of files kept
+        kept = 0
+        for root, _, files in os.walk(directory, topdown=False):
+            for name in files:
+                file_path = os.path.join(root, name)
+                with self.install_lock:
+                    try:
+                        if os.lstat(file_path).st_mtime_ns > mtime_ns:
+                            kept += 1
+                        else:
+                            os.remove(file_path)
+                    except FileNotFoundError:
+                        pass
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+        return kept
+    
+    def install(self, staged_path, dest_path, mtime_ns=None):
+        # Move a file received into incoming_dir to dest_path. With mtime_ns
+        # it is that version of the file, and it is dropped instead if the
+        # file at dest_path is newer, so replicas never go back in time.
+        # Returns whether it was installed
+        with self.install_lock:
+            if mtime_ns is not None:
+                try:
+                    if os.stat(dest_path).st_mtime_ns > mtime_ns:
+                        return False
+                except FileNotFoundError:
+                    pass
+            os.replace(staged_path, dest_path)
+        return True
+    
+    def file_size(self, path, stat=None):
+        # Size of a file, taken from its manifest when it is in the chunk store
+        stat = stat or os.stat(path)
+        return logical_size(path, stat) if self.store else stat.st_size
+    
+    @property
+    def copy_function(self):
+        # With a chunk store, copying a file only copies its manifest
+        return self.store.copy if self.store else copy_file
+    
+    def copy_file(self, source, destination, progress=None, mtime_ns=None):
+        # mtime_ns, if given, is set as the mtime of a copied file. The
+        # metadata server of a replicated cluster stamps every replica of a
+        # write with the same one, which then tells versions apart; a copy
+        # older than the file it would replace is refused as stale
         if not source or not destination:
             return {"status": "error", "message": "Source and destination paths are required"}
         
@@ -151,57 +424,348 @@ class FileServer:
         
         try:
             if os.path.isfile(source_path):
-                shutil.copy2(source_path, dest_path)
+                if os.path.isdir(dest_path):
+                    dest_path = os.path.join(dest_path, os.path.basename(source_path))
+                os.makedirs(self.incoming_dir, exist_ok=True)
+                temp_path = os.path.join(self.incoming_dir, uuid.uuid4().hex)
+                try:
+                    self.copy_function(source_path, temp_path)
+                    if mtime_ns is not None:
+                        os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+                    if not self.install(temp_path, dest_path, mtime_ns):
+                        return {"status": "error", "stale": True,
+                                "message": f"{destination} already holds a newer version"}
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
                 return {"status": "success", "message": f"File copied from {source} to {destination}"}
             elif os.path.isdir(source_path):
                 if os.path.exists(dest_path):
                     return {"status": "error", "message": f"Destination directory already exists: {destination}"}
-                shutil.copytree(source_path, dest_path)
-                return {"status": "success", "message": f"Directory copied from {source} to {destination}"}
+                result = copy_tree(source_path, dest_path, self.copy_workers, progress,
+                                   copy_function=self.copy_function, file_size=self.file_size)
+                return {
+                    "status": "success",
+                    "message": f"Directory copied from {source} to {destination} "
+                               f"({result['files_done']} files, {result['bytes_done']} bytes)"
+                }
         except Exception as e:
             return {"status": "error", "message": f"Error copying file: {str(e)}"}
+        finally:
+            self.listing_cache.invalidate(os.path.abspath(dest_path))
     
-    def get_file(self, path):
+    def get_file(self, path, offset=0, length=None, data=True):
+        # Returns the response header plus the (path, offset, length) of the
+        # files whose contents are streamed after it, in the same order as
+        # announced in the header. offset and length select a byte range of
+        # a single file, so an interrupted download can be resumed or split
+        # across connections. Without data only the header is sent
         if not path:
-            return {"status": "error", "message": "No file path provided"}
+            return {"status": "error", "message": "No file path provided"}, []
         
         full_path = os.path.join(self.root_dir, path)
         
         if not os.path.exists(full_path):
-            return {"status": "error", "message": f"File not found: {path}"}
+            return {"status": "error", "message": f"File not found: {path}"}, []
         
         try:
             if os.path.isfile(full_path):
-                with open(full_path, 'rb') as file:
-                    file_content = file.read()
-                
+                stat = os.stat(full_path)
+                size = self.file_size(full_path, stat)
+                if not isinstance(offset, int) or offset < 0 or offset > size:
+                    return {"status": "error", "message": f"Invalid offset {offset} for {path}", "size": size}, []
+                if length is None or not isinstance(length, int) or length < 0:
+                    length = size - offset
+                length = min(length, size - offset)
                 return {
                     "status": "success",
                     "type": "file",
                     "name": os.path.basename(full_path),
-                    "content": file_content.hex(),  # Send binary data as hex string
+                    "size": size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "offset": offset,
+                    "length": length,
                     "message": f"File retrieved: {path}"
-                }
+                }, [(full_path, offset, length)] if data else []
             elif os.path.isdir(full_path):
-                # For directories, we'll create a dictionary of files and their contents
-                files_dict = {}
+                file_entries = []
+                file_paths = []
                 for root, _, files in os.walk(full_path):
                     for file in files:
                         file_path = os.path.join(root, file)
-                        rel_path = os.path.relpath(file_path, self.root_dir)
-                        with open(file_path, 'rb') as f:
-                            files_dict[rel_path] = f.read().hex()
+                        stat = os.stat(file_path)
+                        file_entries.append({
+                            "path": os.path.relpath(file_path, self.root_dir),
+                            "size": self.file_size(file_path, stat),
+                            "mtime_ns": stat.st_mtime_ns
+                        })
+                        file_paths.append((file_path, 0, None))
                 
                 return {
                     "status": "success",
                     "type": "directory",
                     "name": os.path.basename(full_path),
-                    "files": files_dict,
+                    "files": file_entries,
                     "message": f"Directory contents retrieved: {path}"
-                }
+                }, file_paths if data else []
         except Exception as e:
-            return {"status": "error", "message": f"Error retrieving file: {str(e)}"}
+            return {"status": "error", "message": f"Error retrieving file: {str(e)}"}, []
+    
+    def pull_allowed(self, address, source):
+        # A pull must come from a host of the cluster and name one of its nodes
+        if not address or not source or len(source) != 2:
+            return False
+        try:
+            return address[0] in self.cluster_hosts and (source[0], int(source[1])) in self.cluster
+        except (TypeError, ValueError):
+            return False
+    
+    def pull_file(self, source, path, destination=None, mtime_ns=None):
+        # Fetch file path from the server at source ([host, port]) and store
+        # it here as destination (by default the same path), keeping its
+        # mtime unless mtime_ns is given. Like copy_file, it is refused if
+        # destination is newer. The metadata server of a cluster uses it to
+        # copy, move and replicate files between nodes
+        if not source or not path:
+            return {"status": "error", "message": "Source node and path are required"}
+        destination = destination or path
+        dest_path = os.path.join(self.root_dir, destination)
+        temp_path = os.path.join(self.incoming_dir, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(dest_path) or self.root_dir, exist_ok=True)
+            os.makedirs(self.incoming_dir, exist_ok=True)
+            conn = Connection(socket.create_connection(tuple(source), timeout=PULL_TIMEOUT))
+            try:
+                conn.hello()
+                conn.send_message({"command": "get", "path": path, "checksum": True})
+                header = conn.recv_message()
+                if header is None:
+                    raise ConnectionError("Connection closed by source node")
+                if header["status"] != "success":
+                    return {"status": "error", "message": header["message"]}
+                if header["type"] != "file":
+                    return {"status": "error", "message": f"Not a file: {path}"}
+                sha256 = hashlib.sha256()
+                with open(temp_path, 'wb') as f:
+                    received, intact = conn.receive_file_checked(f, sha256)
+                trailer = conn.recv_message()
+            finally:
+                conn.close()
+            if not intact or received != header["size"] or not trailer or trailer.get("sha256") != sha256.hexdigest():
+                return {"status": "error", "message": f"Corrupt or incomplete transfer of {path}"}
+            if self.store:
+                self.store.ingest(temp_path, temp_path)
+            mtime_ns = header["mtime_ns"] if mtime_ns is None else mtime_ns
+            os.utime(temp_path, ns=(mtime_ns, mtime_ns))
+            if not self.install(temp_path, dest_path, mtime_ns):
+                return {"status": "error", "stale": True, "message": f"{destination} already holds a newer version"}
+            return {"status": "success", "size": received,
+                    "message": f"File {path} pulled from {source[0]}:{source[1]} to {destination}"}
+        except Exception as e:
+            return {"status": "error", "message": f"Error pulling file: {str(e)}"}
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.listing_cache.invalidate(os.path.abspath(dest_path))
+    
+    def stream_file(self, conn, file_path, offset=0, length=None, checksum=False, digest=True):
+        # Send the file as data frames terminated by an empty frame, so only
+        # one chunk (or none, with sendfile) is ever held in memory. With
+        # checksum every frame carries the CRC32 of its data and the stream
+        # is followed by a trailer, holding the SHA-256 of the file up to its
+        # end unless digest is off (ranges fetched in parallel skip it). The
+        # digest of a range running to the end of the file comes from the
+        # digest cache when it can
+        try:
+            stat = os.stat(file_path) if checksum and digest else None
+            manifest = read_manifest(file_path) if self.store else None
+            file = open(file_path, 'rb') if manifest is None else None
+        except (OSError, ValueError) as e:
+            print(f"Error streaming {file_path}: {e}")
+            conn.send_frame(b"")
+            if checksum:
+                conn.send_message({"status": "error", "message": str(e)})
+            return
+        if manifest is not None:
+            self.stream_chunks(conn, manifest, offset, length, checksum, digest, file_path, stat)
+            return
+        with file:
+            if not checksum:
+                conn.send_file(file, offset, length, use_sendfile=self.use_sendfile)
+                return
+            cached = self.cached_digest(file_path, stat, stat.st_size, offset, length) if digest else None
+            if not digest or cached:
+                sent = conn.send_file_checked(file, offset, length)
+                trailer = {"status": "success", "length": sent}
+                if cached:
+                    trailer["sha256"] = cached
+                conn.send_message(trailer)
+                return
+            sha256 = hashlib.sha256()
+            hash_file(file, sha256, 0, offset)
+            sent = conn.send_file_checked(file, offset, length, sha256)
+            if offset + sent == stat.st_size:
+                self.digests.store(file_path, stat, sha256.hexdigest())
+            conn.send_message({"status": "success", "length": sent, "sha256": sha256.hexdigest()})
+    
+    def cached_digest(self, file_path, stat, size, offset, length):
+        # The cached SHA-256 of the whole file of stat, when the range runs
+        # to the end of the file and so ends with that digest
+        if length is not None and offset + length < size:
+            return None
+        return self.digests.get(file_path, stat)
+    
+    def stream_chunks(self, conn, manifest, offset=0, length=None, checksum=False, digest=True, file_path=None,
+                      stat=None):
+        # stream_file for a file of the chunk store: the chunks covering the
+        # range are sent one after the other as a single stream, each from
+        # its own file so sendfile still applies. file_path and stat are the
+        # manifest's, for the digest cache
+        if length is None:
+            length = manifest["size"] - offset
+        sha256 = hashlib.sha256() if checksum and digest else None
+        cached = self.cached_digest(file_path, stat, manifest["size"], offset, length) if sha256 is not None else None
+        if cached:
+            sha256 = None
+        sent = 0
+        try:
+            if sha256 is not None:
+                for chunk_path, start, count in self.store.ranges(manifest, 0, offset):
+                    with open(chunk_path, 'rb') as f:
+                        hash_file(f, sha256, start, count)
+            compressor = conn.stream_compressor()
+            with conn.send_lock:
+                for chunk_path, start, count in self.store.ranges(manifest, offset, length):
+                    with open(chunk_path, 'rb') as f:
+                        if checksum:
+                            sent += conn.send_file_checked(f, start, count, sha256, end=False, compressor=compressor)
+                        else:
+                            sent += conn.send_file(f, start, count, use_sendfile=self.use_sendfile, end=False,
+                                                   compressor=compressor)
+        except OSError as e:
+            # A missing chunk ends the stream early, the client sees it short
+            print(f"Error streaming chunk: {e}")
+            conn.send_frame(b"")
+            if checksum:
+                conn.send_message({"status": "error", "message": str(e)})
+            return
+        conn.send_frame(b"")
+        if checksum:
+            trailer = {"status": "success", "length": sent}
+            if cached:
+                trailer["sha256"] = cached
+            elif sha256 is not None:
+                trailer["sha256"] = sha256.hexdigest()
+                if offset + sent == manifest["size"]:
+                    self.digests.store(file_path, stat, trailer["sha256"])
+            conn.send_message(trailer)
+    
+    async def stream_file_async(self, conn, file_path, offset=0, length=None, checksum=False, digest=True):
+        run_blocking = self.async_server.run_blocking
+        try:
+            stat = await run_blocking(os.stat, file_path) if checksum and digest else None
+            manifest = await run_blocking(read_manifest, file_path) if self.store else None
+            file = await run_blocking(open, file_path, 'rb') if manifest is None else None
+        except (OSError, ValueError) as e:
+            print(f"Error streaming {file_path}: {e}")
+            await conn.send_frame(b"")
+            if checksum:
+                await conn.send_message({"status": "error", "message": str(e)})
+            return
+        if manifest is not None:
+            await self.stream_chunks_async(conn, manifest, offset, length, checksum, digest, file_path, stat)
+            return
+        with file:
+            if not checksum:
+                await conn.send_file(file, offset, length, use_sendfile=self.use_sendfile,
+                                     executor=self.async_server.executor)
+                return
+            cached = self.cached_digest(file_path, stat, stat.st_size, offset, length) if digest else None
+            if not digest or cached:
+                sent = await conn.send_file_checked(file, offset, length, executor=self.async_server.executor)
+                trailer = {"status": "success", "length": sent}
+                if cached:
+                    trailer["sha256"] = cached
+                await conn.send_message(trailer)
+                return
+            sha256 = hashlib.sha256()
+            await run_blocking(hash_file, file, sha256, 0, offset)
+            sent = await conn.send_file_checked(file, offset, length, sha256, self.async_server.executor)
+            if offset + sent == stat.st_size:
+                await run_blocking(self.digests.store, file_path, stat, sha256.hexdigest())
+            await conn.send_message({"status": "success", "length": sent, "sha256": sha256.hexdigest()})
+    
+    async def stream_chunks_async(self, conn, manifest, offset=0, length=None, checksum=False, digest=True,
+                                  file_path=None, stat=None):
+        run_blocking = self.async_server.run_blocking
+        executor = self.async_server.executor
+        if length is None:
+            length = manifest["size"] - offset
+        sha256 = hashlib.sha256() if checksum and digest else None
+        cached = self.cached_digest(file_path, stat, manifest["size"], offset, length) if sha256 is not None else None
+        if cached:
+            sha256 = None
+        sent = 0
+        try:
+            if sha256 is not None:
+                for chunk_path, start, count in self.store.ranges(manifest, 0, offset):
+                    with await run_blocking(open, chunk_path, 'rb') as f:
+                        await run_blocking(hash_file, f, sha256, start, count)
+            compressor = conn.stream_compressor()
+            for chunk_path, start, count in self.store.ranges(manifest, offset, length):
+                with await run_blocking(open, chunk_path, 'rb') as f:
+                    if checksum:
+                        sent += await conn.send_file_checked(f, start, count, sha256, executor, end=False,
+                                                             compressor=compressor)
+                    else:
+                        sent += await conn.send_file(f, start, count, use_sendfile=self.use_sendfile,
+                                                     executor=executor, end=False, compressor=compressor)
+        except OSError as e:
+            print(f"Error streaming chunk: {e}")
+            await conn.send_frame(b"")
+            if checksum:
+                await conn.send_message({"status": "error", "message": str(e)})
+            return
+        await conn.send_frame(b"")
+        if checksum:
+            trailer = {"status": "success", "length": sent}
+            if cached:
+                trailer["sha256"] = cached
+            elif sha256 is not None:
+                trailer["sha256"] = sha256.hexdigest()
+                if offset + sent == manifest["size"]:
+                    await run_blocking(self.digests.store, file_path, stat, trailer["sha256"])
+            await conn.send_message(trailer)
 
 if __name__ == "__main__":
-    server = FileServer()
-    server.start() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='BigFS Server')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=9999, help='Port to listen on')
+    parser.add_argument('--root', default='data', help='Root directory of the file system')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread', help='Connection handling engine')
+    parser.add_argument('--max-connections', type=int, default=256, help='Clients served at once')
+    parser.add_argument('--accept-queue', type=int, default=128, help='Clients waiting for the thread engine before it answers busy')
+    parser.add_argument('--workers', type=int, default=32, help='Threads for blocking calls in the asyncio engine')
+    parser.add_argument('--copy-workers', type=int, default=8, help='Threads copying the files of a directory in parallel')
+    parser.add_argument('--chunk-store', help='Keep file data deduplicated in this directory (see chunkstore.py)')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this localhost port')
+    parser.add_argument('--profile-sample', type=int, default=0, metavar='N',
+                        help='Profile one request in N with cProfile (see common/profiling.py)')
+    parser.add_argument('--slow-request', type=float, metavar='SECONDS',
+                        help='Log requests taking this long with the time of each phase')
+    parser.add_argument('--profile-dir', default='profiles', help='Directory for profiles and slow request traces')
+    parser.add_argument('--cluster', nargs='+', default=[], metavar='HOST:PORT',
+                        help='Metadata server and storage nodes allowed to have this node pull files')
+    args = parser.parse_args()
+    
+    server = FileServer(args.host, args.port, args.root, copy_workers=args.copy_workers,
+                        chunk_store=args.chunk_store, cluster=args.cluster)
+    if args.profile_sample or args.slow_request is not None:
+        # BigFS has no path locks, so requests have no lock phase
+        server.profiler = RequestProfiler(args.profile_sample, args.slow_request, args.profile_dir, server.metrics,
+                                          phases=("decode", "fs", "encode", "send"))
+        print(f"Profiling requests into {args.profile_dir}")
+    if args.metrics_port:
+        server.metrics.serve(args.metrics_port)
+        print(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+    server.start(args.engine, args.max_connections, args.workers, args.accept_queue) 
\ No newline at end of file
@@ -0,0 +1,186 @@
+import datetime
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler
+
+LOG_FILE = 'nfs_server.log'
+TEXT_FORMAT = '[%(asctime)s] %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# The log file is rotated past this size, keeping this many old files
+MAX_BYTES = 64 * 1024 * 1024
+BACKUP_COUNT = 5
+
+# Records written and flushed at once, and how long the writer waits for
+# more records before writing a batch that is not full
+BATCH_RECORDS = 1024
+FLUSH_INTERVAL = 0.1
+
+# Records waiting for the writer; beyond that new records are dropped
+QUEUE_SIZE = 100000
+
+
+def log_operation(client_id, operation, message, **fields):
+    """Log an operation of a client. JSON-lines logs also get the client,
+    the operation and `fields` as separate keys"""
+    logging.info(message, extra={'audit': dict(client=client_id, operation=operation, **fields)})
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: time, level, message and the fields of
+    log_operation()"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'audit', None) or {})
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records when the queue is full instead of
+    blocking the thread logging them"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The writer runs in this process, so the record needs neither the
+        # copy nor the early formatting QueueHandler makes for pickling
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RotatingFile:
+    """Log file rotated once it would grow past `max_bytes` or is older than
+    `interval` seconds (0 turns either off). Old files are kept as
+    path.1, the newest, up to path.<backup_count>"""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT, interval=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.interval = interval
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        # An existing file counts from its last write
+        self.opened = os.path.getmtime(self.path) if self.size else time.time()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        if self.size and ((self.max_bytes and self.size + len(data) > self.max_bytes)
+                          or (self.interval and time.time() - self.opened >= self.interval)):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        if self.backup_count:
+            for index in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{index}'):
+                    os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        self.file.close()
+
+
+class AuditLog:
+    """Log pipeline that keeps disk and terminal I/O off the request path.
+
+    Logging calls only put their record on a bounded queue. A background
+    thread takes records off it in batches of up to `batch_records`,
+    waiting at most `flush_interval` seconds to fill one, formats them and
+    writes each batch to the log file and the console with one write and
+    flush. Records that find the queue full are dropped and counted, and
+    the count is logged once the writer catches up.
+    """
+
+    def __init__(self, path=LOG_FILE, json_lines=False, console=True, max_bytes=MAX_BYTES,
+                 backup_count=BACKUP_COUNT, rotate_interval=0, batch_records=BATCH_RECORDS,
+                 flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.queue = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.batch_records = batch_records
+        self.flush_interval = flush_interval
+        self.file = RotatingFile(path, max_bytes, backup_count, rotate_interval) if path else None
+        text = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+        self.outputs = []
+        if self.file:
+            self.outputs.append((self.file.write, JSONFormatter() if json_lines else text))
+        if console:
+            self.outputs.append((self.write_console, text))
+        self.reported_drops = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self, level=logging.INFO):
+        """Send the records of the root logger through this pipeline"""
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.handler)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Write the records still queued and close the log file"""
+        logging.getLogger().removeHandler(self.handler)
+        self.queue.put(None)
+        self.thread.join()
+        if self.file:
+            self.file.close()
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while records[-1] is not None and len(records) < self.batch_records:
+                try:
+                    records.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            stopping = records[-1] is None
+            if stopping:
+                records.pop()
+            self.write(records)
+            if stopping:
+                return
+
+    def write(self, records):
+        dropped = self.handler.dropped
+        if dropped != self.reported_drops:
+            records.append(logging.makeLogRecord({
+                'msg': f'{dropped - self.reported_drops} log records dropped, the log writer fell behind',
+                'levelname': 'WARNING', 'levelno': logging.WARNING}))
+            self.reported_drops = dropped
+        for write, formatter in self.outputs:
+            try:
+                write(''.join(formatter.format(record) + '\n' for record in records))
+            except Exception as e:
+                sys.stderr.write(f'Error writing the log: {str(e)}\n')
+
+    @staticmethod
+    def write_console(text):
+        sys.stderr.write(text)
+        sys.stderr.flush()
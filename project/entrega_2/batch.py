@@ -0,0 +1,81 @@
+import os
+import shutil
+
+# Commands a batch request may carry
+BATCH_COMMANDS = ('copy', 'delete')
+
+
+class Rollback:
+    """Journal of the changes made by an atomic batch, undone in reverse
+    order when one of its operations fails.
+
+    Paths the batch removes or overwrites are renamed next to themselves
+    instead of deleted, which keeps them on the same filesystem, and only
+    removed for good by commit().
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.steps = []
+
+    def stash(self, path):
+        """Move an existing path out of the way, put back on rollback"""
+        kept = os.path.join(os.path.dirname(path), f'.batch-{self.token}-{len(self.steps)}')
+        os.rename(path, kept)
+        self.steps.append(('stash', path, kept))
+
+    def created(self, path):
+        """Record a path the batch is about to create, removed on rollback"""
+        self.steps.append(('created', path, None))
+
+    def makedirs(self, path):
+        """os.makedirs recording the directories it creates, which are
+        removed on rollback if still empty"""
+        missing = []
+        while not os.path.exists(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            os.mkdir(directory)
+            self.steps.append(('mkdir', directory, None))
+
+    def rollback(self):
+        """Undo every recorded change, returns the paths that could not be restored"""
+        failed = []
+        for kind, path, kept in reversed(self.steps):
+            try:
+                if kind == 'mkdir':
+                    try:
+                        os.rmdir(path)
+                    except OSError:
+                        # Another client put something in it meanwhile
+                        pass
+                else:
+                    remove(path)
+                    if kind == 'stash':
+                        os.rename(kept, path)
+            except OSError:
+                failed.append(path)
+        self.steps = []
+        return failed
+
+    def commit(self):
+        """Drop the stashed paths"""
+        for kind, _, kept in self.steps:
+            if kind == 'stash':
+                try:
+                    remove(kept)
+                except OSError:
+                    pass
+        self.steps = []
+
+
+def remove(path):
+    """Remove a file, link or directory tree, if it exists"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import posixpath
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a cached listing or attribute is used without a lease
+CACHE_TTL = 3
+
+# Bytes of file contents kept in the cache directory
+CACHE_DATA_BYTES = 256 * 1024 * 1024
+
+# Cached paths above which expired entries are swept out
+PRUNE_ENTRIES = 10000
+
+
+def cache_key(path):
+    """Normalized form of a 'remoto:' path, None for paths that are not cached.
+
+    Other paths name files on the server machine that the server does not
+    lease, so they are always asked for."""
+    if not path.startswith('remoto:'):
+        return None
+    return 'remoto:' + posixpath.normpath('/' + path[7:].lstrip('/'))
+
+
+class ClientCache:
+    """Listings, attributes and file contents of remote paths kept by NFSClient.
+
+    Entries expire after `ttl` seconds, or at the end of the lease the
+    server granted for them; until then the server recalls a lease before
+    acknowledging a change to its path, so leased entries stay current.
+    File contents are kept in `data_dir`, if given, and reused while the
+    attributes of their file are cached and unchanged.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, data_dir=None, max_data_bytes=CACHE_DATA_BYTES):
+        self.ttl = ttl
+        self.data_dir = data_dir
+        self.max_data_bytes = max_data_bytes
+        # key -> {(kind, extra): (expiry, value)}
+        self.entries = {}
+        # key -> (file in data_dir, size, mtime), least recently used first
+        self.data = OrderedDict()
+        self.data_bytes = 0
+        # Bumped by every invalidation, so a response that was in flight
+        # while its path changed is not cached
+        self.generation = 0
+        self.lock = threading.Lock()
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, kind, path, extra=None):
+        """The cached value of a request, or None"""
+        key = cache_key(path)
+        if not self.enabled or key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key, {}).get((kind, extra))
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key][(kind, extra)]
+                return None
+            return entry[1]
+
+    def put(self, kind, path, value, since, lease=None, extra=None):
+        """Cache the value of a request; `since` is what start() returned
+        when it was sent, and a lease runs from then"""
+        key = cache_key(path)
+        if not self.enabled or key is None:
+            return
+        sent, generation = since
+        with self.lock:
+            if generation != self.generation:
+                return
+            now = time.monotonic()
+            if len(self.entries) > PRUNE_ENTRIES:
+                self.prune(now)
+            expiry = sent + lease if lease else now + self.ttl
+            self.entries.setdefault(key, {})[(kind, extra)] = (expiry, value)
+
+    def start(self):
+        """Mark the sending of a request whose response may be cached"""
+        with self.lock:
+            return time.monotonic(), self.generation
+
+    def invalidate(self, path, tree=False):
+        """Drop what is cached for `path` and, with `tree`, below it"""
+        key = cache_key(path)
+        if key is None:
+            return
+        with self.lock:
+            self.generation += 1
+            keys = [key]
+            if tree:
+                prefix = key.rstrip('/') + '/'
+                keys += [cached for cached in self.entries if cached.startswith(prefix)]
+                keys += [cached for cached in self.data if cached.startswith(prefix)]
+            for cached in keys:
+                self.entries.pop(cached, None)
+                self.drop_data(cached)
+
+    def changed(self, path):
+        """Drop what a change of `path` by this client makes stale: the
+        path, anything below it and the listing of its parent"""
+        self.invalidate(path, tree=True)
+        key = cache_key(path)
+        if key is not None:
+            self.invalidate(posixpath.dirname(key))
+
+    def get_data(self, path, size, mtime):
+        """A local file with the contents of `path` at that size and mtime, or None"""
+        key = cache_key(path)
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[1:] != (size, mtime):
+                return None
+            self.data.move_to_end(key)
+            return entry[0]
+
+    def put_data(self, path, source, size, mtime, since):
+        """Keep a copy of the local file `source` as the contents of `path`,
+        read by a request sent at `since`"""
+        key = cache_key(path)
+        if not self.enabled or not self.data_dir or key is None or size > self.max_data_bytes:
+            return
+        file = os.path.join(self.data_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+        temp = f'{file}.{threading.get_ident()}.tmp'
+        shutil.copyfile(source, temp)
+        with self.lock:
+            if since[1] != self.generation:
+                os.remove(temp)
+                return
+            self.drop_data(key)
+            os.replace(temp, file)
+            self.data[key] = (file, size, mtime)
+            self.data_bytes += size
+            while self.data_bytes > self.max_data_bytes:
+                self.drop_data(next(iter(self.data)))
+
+    def prune(self, now):
+        # Called with the lock held
+        for key in list(self.entries):
+            requests = self.entries[key]
+            for request in [request for request, (expiry, _) in requests.items() if expiry <= now]:
+                del requests[request]
+            if not requests:
+                del self.entries[key]
+
+    def drop_data(self, key):
+        # Called with the lock held
+        entry = self.data.pop(key, None)
+        if entry is None:
+            return
+        self.data_bytes -= entry[1]
+        try:
+            os.remove(entry[0])
+        except FileNotFoundError:
+            pass
@@ -1,20 +1,63 @@
 import socket
-import json
 import os
 import sys
 import argparse
+import base64
+import hashlib
+import itertools
+import json
+import mmap
+import shutil
+import threading
+from concurrent.futures import Future
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.pagination import parse_options
+from common.pool import POOL_SIZE, ConnectionPool, open_connection
+from common.protocol import Connection
+from cache import CACHE_TTL, ClientCache
+from delta import delta
+
+# Literal bytes and operations sent per sync_chunk request
+SYNC_CHUNK_BYTES = 1024 * 1024
+SYNC_CHUNK_OPS = 4096
+
+# Requests whose answers are cached, under a lease when the server grants one
+LEASED_COMMANDS = ('ls', 'stat', 'read')
+
+# Requests PooledNFSClient sends again on a new connection when the
+# connection fails, as they change nothing on the server
+RETRIED_COMMANDS = ('ls', 'stat', 'read', 'stats')
 
 class NFSClient:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, compression=None, codecs=None, cache_ttl=CACHE_TTL,
+                 cache_dir=None):
         self.host = host
         self.port = port
+        # Compression and message codecs offered to the server, all
+        # available ones when None
+        self.compression = compression
+        self.codecs = codecs
+        # Listings and attributes of remote paths, and file contents when
+        # cache_dir is given; cache_ttl=0 turns caching off
+        self.cache = ClientCache(cache_ttl, cache_dir)
         self.socket = None
+        self.conn = None
+        # Requests in flight, by id: (future, file receiving streamed data)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.receiver = None
         
     def connect(self):
         """Connect to the NFS server"""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
+            self.conn = Connection(self.socket)
+            self.conn.hello(self.compression, self.codecs)
+            self.receiver = threading.Thread(target=self.receive_responses, args=(self.conn,), daemon=True)
+            self.receiver.start()
             print(f"Connected to NFS server at {self.host}:{self.port}")
             return True
         except Exception as e:
@@ -24,80 +67,429 @@ class NFSClient:
     def disconnect(self):
         """Disconnect from the NFS server"""
         if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.socket.close()
+            self.receiver.join()
             self.socket = None
+            self.conn = None
             
+    def receive_responses(self, conn):
+        """Resolve pending requests as their responses arrive, in any order"""
+        error = ConnectionError('Connection closed by server')
+        try:
+            while True:
+                response = conn.recv_message()
+                if response is None:
+                    break
+                if response.get('status') == 'invalidate':
+                    # Another client changed paths this one holds leases on
+                    for path in response['paths']:
+                        self.cache.invalidate(path)
+                    continue
+                if 'id' not in response:
+                    # Connection-level answer such as 'busy'
+                    error = ConnectionError(response.get('message', 'Unexpected response'))
+                    break
+                if response.get('status') == 'progress':
+                    # Interim report of a long request, which stays pending
+                    with self.pending_lock:
+                        entry = self.pending.get(response.pop('id'))
+                    if entry and entry[2]:
+                        entry[2](response)
+                    continue
+                with self.pending_lock:
+                    future, sink, _ = self.pending.pop(response.pop('id'))
+                if sink is not None and response['status'] == 'success':
+                    response['received'] = conn.receive_file(sink)
+                future.set_result(response)
+        except Exception as e:
+            error = e
+        finally:
+            with self.pending_lock:
+                pending, self.pending = self.pending, {}
+            for future, _, _ in pending.values():
+                future.set_exception(error)
+                
+    def submit(self, command, args, callback=None, sink=None, options=None, progress=None):
+        """Send a request without waiting for its response.
+        
+        Returns a Future resolved with the response dict; `callback`, if
+        given, is called with that future once it completes. Requests in
+        flight may complete in any order, so wait for a request before
+        submitting another one that depends on its result. `sink` is an open
+        binary file receiving the data of a 'read' request; `options` are
+        extra command options such as the paging options of 'ls'.
+        `progress`, if given, is called from the receiver thread with the
+        interim status dicts of a long 'copy'.
+        """
+        if not self.conn:
+            raise ConnectionError('Not connected to server')
+            
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        request_id = next(self.request_ids)
+        with self.pending_lock:
+            self.pending[request_id] = (future, sink, progress)
+        try:
+            request = {'id': request_id, 'command': command, 'args': args}
+            if options:
+                request['options'] = options
+            if self.cache.enabled and command in LEASED_COMMANDS:
+                request['lease'] = True
+            if progress:
+                request['progress'] = True
+            self.conn.send_message(request)
+        except Exception as e:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            future.set_exception(e)
+        return future
+        
+    def run_many(self, requests, window=256):
+        """Pipeline a list of (command, args) requests over this connection.
+        
+        At most `window` requests are in flight at once. Returns the
+        responses in the same order as `requests`.
+        """
+        slots = threading.BoundedSemaphore(window)
+        futures = []
+        for command, args in requests:
+            slots.acquire()
+            futures.append(self.submit(command, args, callback=lambda _: slots.release()))
+            
+        responses = []
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except Exception as e:
+                responses.append({'status': 'error', 'message': str(e)})
+        return responses
+        
     def send_request(self, command, args):
-        """Send a request to the server"""
+        """Send a request to the server and wait for its response"""
         if not self.socket:
             print("Not connected to server")
             return None
             
-        request = {
-            'command': command,
-            'args': args
-        }
-        
         try:
-            self.socket.send(json.dumps(request).encode())
-            response = self.socket.recv(4096)
-            return json.loads(response.decode())
+            return self.submit(command, args).result()
         except Exception as e:
             print(f"Error sending request: {str(e)}")
             return None
             
-    def ls(self, path):
-        """List files in a directory"""
-        response = self.send_request('ls', [path])
-        if response and response['status'] == 'success':
-            files = response['files']
-            print(f"\nContents of {path}:")
-            print("-" * 50)
-            for file in files:
-                type_str = "DIR" if file['is_dir'] else "FILE"
-                size_str = f"{file['size']} bytes" if not file['is_dir'] else ""
-                print(f"{type_str:<6} {file['name']} {size_str}")
+    def iter_ls(self, path, page_size=1000, **options):
+        """Yield a directory listing page by page as it arrives.
+        
+        `options` are the listing options of the server: sort ('name',
+        'size' or 'mtime'), reverse, pattern (glob), type ('file' or 'dir'),
+        min_size and max_size. Raises RuntimeError if the server refuses.
+        """
+        options['limit'] = options.get('limit', page_size)
+        while True:
+            page = json.dumps(options, sort_keys=True)
+            response = self.cache.get('ls', path, page)
+            if response is None:
+                since = self.cache.start()
+                response = self.submit('ls', [path], options=options).result()
+                if response['status'] != 'success':
+                    raise RuntimeError(response['message'])
+                self.cache.put('ls', path, response, since, response.get('lease'), page)
+            yield response['files']
+            if not response.get('next_cursor'):
+                return
+            options['cursor'] = response['next_cursor']
+            
+    def stat(self, path):
+        """Return the attributes of a path as a dict of is_dir, size and
+        mtime (in nanoseconds). Raises RuntimeError if the server refuses"""
+        attributes = self.cache.get('stat', path)
+        if attributes is None:
+            since = self.cache.start()
+            response = self.submit('stat', [path]).result()
+            if response['status'] != 'success':
+                raise RuntimeError(response['message'])
+            attributes = {key: response[key] for key in ('is_dir', 'size', 'mtime')}
+            self.cache.put('stat', path, attributes, since, response.get('lease'))
+        return attributes
+        
+    def ls(self, path, **options):
+        """List files in a directory, printing each page as it arrives"""
+        if not self.socket:
+            print("Not connected to server")
+            return
+            
+        try:
+            header_shown = False
+            for files in self.iter_ls(path, **options):
+                if not header_shown:
+                    print(f"\nContents of {path}:")
+                    print("-" * 50)
+                    header_shown = True
+                for file in files:
+                    type_str = "DIR" if file['is_dir'] else "FILE"
+                    size_str = f"{file['size']} bytes" if not file['is_dir'] else ""
+                    print(f"{type_str:<6} {file['name']} {size_str}")
             print("-" * 50)
-        else:
-            print(f"Error: {response['message'] if response else 'Unknown error'}")
+        except Exception as e:
+            print(f"Error: {str(e)}")
             
     def copy(self, src, dst):
-        """Copy a file"""
-        response = self.send_request('copy', [src, dst])
+        """Copy a file or a directory tree"""
+        try:
+            response = self.submit('copy', [src, dst], progress=self.show_progress).result()
+        except Exception as e:
+            print(f"Error sending request: {str(e)}")
+            response = None
+        self.cache.changed(dst)
         if response and response['status'] == 'success':
             print(f"Successfully copied {src} to {dst}")
         else:
             print(f"Error: {response['message'] if response else 'Unknown error'}")
             
+    def show_progress(self, state):
+        """Print the interim status of a copy"""
+        print(f"  {state['files_done']}/{state['files_total']} files, "
+              f"{state['bytes_done']}/{state['bytes_total']} bytes")
+            
+    def read(self, src, dst):
+        """Download a remote file to a local path"""
+        if not self.socket:
+            print("Not connected to server")
+            return
+            
+        try:
+            if os.path.dirname(dst):
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+            # Attributes still cached mean the file has not changed since
+            # its contents were cached
+            attributes = self.cache.get('stat', src)
+            cached = attributes and self.cache.get_data(src, attributes['size'], attributes['mtime'])
+            if cached:
+                shutil.copyfile(cached, dst)
+                print(f"Successfully read {src} to {dst} ({attributes['size']} bytes, from cache)")
+                return
+                
+            since = self.cache.start()
+            with open(dst, 'wb') as f:
+                response = self.submit('read', [src], sink=f).result()
+                
+            if response['status'] != 'success':
+                os.remove(dst)
+                print(f"Error: {response['message']}")
+            elif response['received'] == response['size']:
+                if 'mtime' in response:
+                    self.cache.put('stat', src, {'is_dir': False, 'size': response['size'], 'mtime': response['mtime']},
+                                   since, response.get('lease'))
+                    self.cache.put_data(src, dst, response['size'], response['mtime'], since)
+                print(f"Successfully read {src} to {dst} ({response['received']} bytes)")
+            else:
+                print(f"Error: incomplete read of {src} ({response['received']} of {response['size']} bytes)")
+        except Exception as e:
+            print(f"Error sending request: {str(e)}")
+            
+    def sync_file(self, local_path, remote_path, window=16):
+        """Bring one remote file up to date with a local file.
+        
+        Files whose size and mtime already match are skipped. Otherwise the
+        server signs the blocks of its copy and only the blocks it lacks are
+        sent, in up to `window` pipelined chunks. Returns the number of
+        literal bytes sent, or None for an unchanged file. Raises
+        RuntimeError when the server refuses the sync.
+        """
+        st = os.stat(local_path)
+        self.cache.changed(remote_path)
+        start = self.submit('sync_start', [remote_path],
+                            options={'size': st.st_size, 'mtime': st.st_mtime_ns}).result()
+        if start['status'] != 'success':
+            raise RuntimeError(start['message'])
+        if start.get('unchanged'):
+            return None
+            
+        token = start['token']
+        slots = threading.BoundedSemaphore(window)
+        chunks = []
+        
+        def send(ops):
+            slots.acquire()
+            chunks.append(self.submit('sync_chunk', [remote_path], callback=lambda _: slots.release(),
+                                      options={'token': token, 'ops': ops}))
+            
+        try:
+            literal = 0
+            digest = hashlib.sha256()
+            with open(local_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+                try:
+                    digest.update(data)
+                    ops, pending_bytes = [], 0
+                    for op in delta(data, start['blocks'], start['block_size'], start['base_size']):
+                        if op[0] == 'data':
+                            ops.append(['data', op[1], base64.b64encode(op[2]).decode('ascii')])
+                            pending_bytes += len(op[2])
+                            literal += len(op[2])
+                        else:
+                            ops.append(list(op))
+                        if pending_bytes >= SYNC_CHUNK_BYTES or len(ops) >= SYNC_CHUNK_OPS:
+                            send(ops)
+                            ops, pending_bytes = [], 0
+                    if ops:
+                        send(ops)
+                finally:
+                    if st.st_size:
+                        data.close()
+                        
+            for chunk in chunks:
+                response = chunk.result()
+                if response['status'] != 'success':
+                    raise RuntimeError(response['message'])
+            commit = self.submit('sync_commit', [remote_path],
+                                 options={'token': token, 'sha256': digest.hexdigest()}).result()
+            if commit['status'] != 'success':
+                raise RuntimeError(commit['message'])
+            return literal
+        except Exception:
+            try:
+                self.submit('sync_abort', [remote_path], options={'token': token})
+            except Exception:
+                pass
+            raise
+            
+    def sync(self, local_path, remote_path):
+        """Mirror a local file or directory tree to a path on the server"""
+        if not self.socket:
+            print("Not connected to server")
+            return
+            
+        if os.path.isdir(local_path):
+            files = []
+            for root, _, names in os.walk(local_path):
+                for name in sorted(names):
+                    relative = os.path.relpath(os.path.join(root, name), local_path)
+                    files.append((os.path.join(root, name),
+                                  remote_path.rstrip('/') + '/' + relative.replace(os.sep, '/')))
+        else:
+            files = [(local_path, remote_path)]
+            
+        updated = unchanged = sent = total = 0
+        failed = []
+        for local_file, remote_file in files:
+            try:
+                literal = self.sync_file(local_file, remote_file)
+            except Exception as e:
+                print(f"Error syncing {local_file}: {str(e)}")
+                failed.append(local_file)
+                continue
+            if literal is None:
+                unchanged += 1
+            else:
+                updated += 1
+                sent += literal
+                total += os.path.getsize(local_file)
+                
+        print(f"Synced {len(files)} files to {remote_path}: {updated} updated, {unchanged} unchanged, "
+              f"{len(failed)} failed; sent {sent} of {total} bytes of changed files")
+            
     def delete(self, path):
         """Delete a file"""
         response = self.send_request('delete', [path])
+        self.cache.changed(path)
         if response and response['status'] == 'success':
             print(f"Successfully deleted {path}")
         else:
             print(f"Error: {response['message'] if response else 'Unknown error'}")
             
+    def run_batch(self, ops, atomic=False):
+        """Run (command, args) copy and delete operations in one request.
+        
+        The server takes the locks of all of them at once and answers with
+        one result per operation. With `atomic` the first failure undoes
+        the operations before it and skips the rest.
+        """
+        ops = [{'command': command, 'args': args} for command, args in ops]
+        try:
+            return self.submit('batch', [], options={'ops': ops, 'atomic': atomic}).result()
+        finally:
+            for op in ops:
+                self.cache.changed(op['args'][-1])
+                
+    def batch(self, path, atomic=False):
+        """Run the operations listed in a local file, one 'copy <src> <dst>'
+        or 'delete <path>' per line"""
+        if not self.socket:
+            print("Not connected to server")
+            return
+            
+        try:
+            with open(path) as f:
+                ops = [(parts[0], parts[1:]) for parts in (line.split() for line in f) if parts]
+            response = self.run_batch(ops, atomic)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return
+        for (command, args), result in zip(ops, response.get('results', [])):
+            if result['status'] == 'error':
+                print(f"  {command} {' '.join(args)}: {result['message']}")
+        if response['status'] == 'success':
+            print(f"Successfully ran {len(ops)} operations")
+        else:
+            print(f"Error: {response['message']}")
+            
+    def stats(self):
+        """Print the server's metrics"""
+        response = self.send_request('stats', [])
+        if not response or response['status'] != 'success':
+            print(f"Error: {response['message'] if response else 'Unknown error'}")
+            return
+        for name, value in response['stats'].items():
+            if isinstance(value, dict):
+                value = ' '.join(f"{key}={value[key]}" for key in ('count', 'p50', 'p99', 'p999', 'max'))
+            print(f"{name}: {value}")
+            
     def show_help(self):
         """Display help information for all available commands"""
         help_text = """
 Available Commands:
 ------------------
-1. ls <path>
-   List contents of a directory
-   Example: ls /home/user/documents
+1. ls <path> [key=value ...]
+   List contents of a directory, page by page
+   Options: sort=name|size|mtime reverse=true pattern=<glob>
+            type=file|dir min_size=<bytes> max_size=<bytes>
+            limit=<entries per page>
+   Example: ls remoto:/logs sort=size reverse=true pattern=*.log
 
 2. copy <source_path> <destination_path>
-   Copy a file from source to destination
+   Copy a file or a whole directory from source to destination
    Example: copy /home/user/file.txt /home/user/backup/file.txt
 
 3. delete <path>
    Delete a file
    Example: delete /home/user/old_file.txt
 
-4. help
+4. read <remote_path> <local_path>
+   Download a remote file to this machine
+   Example: read remoto:/documents/report.pdf /home/user/report.pdf
+
+5. sync <local_path> <remote_path>
+   Mirror a local file or directory to the server, sending only changed blocks
+   Example: sync /home/user/mirror remoto:/mirror
+
+6. batch <ops_file> [atomic=true]
+   Run the copy and delete operations listed in a local file, one per
+   line, in a single request; atomic=true undoes them all if one fails
+   Example: batch cleanup.txt atomic=true
+
+7. stats
+   Show the server's request counts, latency percentiles (in seconds),
+   traffic, connections, lock waits and cache hits
+
+8. help
    Show this help message
 
-5. quit
+9. quit
    Exit the client
 
 Note: For remote paths, prefix them with 'remoto:'
@@ -105,20 +497,144 @@ Example: ls remoto:/documents
 """
         print(help_text)
 
+class PooledNFSClient:
+    """NFS client library for scripts, safe to share between threads.
+    
+    Each call takes a connection from a pool (see common/pool.py), runs
+    one request on it and gives it back, so many operations reuse a few
+    warm connections. Calls return their results and raise RuntimeError
+    when the server refuses an operation, ConnectionError when it cannot
+    be reached. Read-only requests are sent again once on a new connection
+    if theirs fails. Nothing is cached, use NFSClient for that.
+    
+        with PooledNFSClient('localhost', 5000) as nfs:
+            for entry in nfs.ls('remoto:/'):
+                ...
+    
+    `pool_options` are passed to ConnectionPool (idle_timeout,
+    check_after, attempts, backoff, max_backoff).
+    """
+    
+    def __init__(self, host='localhost', port=5000, pool_size=POOL_SIZE, compression=None, codecs=None,
+                 **pool_options):
+        self.pool = ConnectionPool(lambda: open_connection(host, port, compression, codecs), pool_size,
+                                   ping=self.ping, **pool_options)
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc):
+        self.close()
+        
+    def close(self):
+        self.pool.close()
+        
+    @staticmethod
+    def ping(conn):
+        conn.send_message({'command': 'stat', 'args': ['remoto:/']})
+        if conn.recv_message() is None:
+            raise ConnectionError('Connection closed by server')
+            
+    def request(self, command, args=(), options=None, sink=None):
+        """Run one request and return its response dict, whatever its
+        status. `sink` is an open binary file receiving the data of a read"""
+        message = {'command': command, 'args': list(args)}
+        if options:
+            message['options'] = options
+        attempts = 2 if command in RETRIED_COMMANDS else 1
+        for attempt in range(attempts):
+            try:
+                with self.pool.connection() as conn:
+                    conn.send_message(message)
+                    response = conn.recv_message()
+                    if response is None:
+                        raise ConnectionError('Connection closed by server')
+                    if sink is not None and response['status'] == 'success':
+                        response['received'] = conn.receive_file(sink)
+                    return response
+            except OSError:
+                if attempt == attempts - 1:
+                    raise
+                if sink is not None:
+                    sink.seek(0)
+                    sink.truncate()
+                    
+    def call(self, command, args=(), options=None):
+        """request() raising RuntimeError unless the request succeeds"""
+        response = self.request(command, args, options)
+        if response['status'] != 'success':
+            raise RuntimeError(response['message'])
+        return response
+        
+    def ls(self, path, page_size=1000, **options):
+        """All the entries of a directory as dicts of name, is_dir and size,
+        fetched page by page. `options` are those of NFSClient.iter_ls"""
+        options['limit'] = options.get('limit', page_size)
+        files = []
+        while True:
+            response = self.call('ls', [path], options)
+            files.extend(response['files'])
+            if not response.get('next_cursor'):
+                return files
+            options['cursor'] = response['next_cursor']
+            
+    def stat(self, path):
+        """The is_dir, size and mtime (in nanoseconds) of a path"""
+        response = self.call('stat', [path])
+        return {key: response[key] for key in ('is_dir', 'size', 'mtime')}
+        
+    def copy(self, src, dst):
+        """Copy a file or a directory tree, returns the server's response"""
+        return self.call('copy', [src, dst])
+        
+    def delete(self, path):
+        self.call('delete', [path])
+        
+    def read(self, src, dst):
+        """Download a remote file to a local path, returns its size"""
+        if os.path.dirname(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with open(dst, 'wb') as f:
+            response = self.request('read', [src], sink=f)
+        if response['status'] != 'success':
+            os.remove(dst)
+            raise RuntimeError(response['message'])
+        if response['received'] != response['size']:
+            raise RuntimeError(f"Incomplete read of {src} ({response['received']} of {response['size']} bytes)")
+        return response['size']
+        
+    def batch(self, ops, atomic=False):
+        """Run (command, args) copy and delete operations in one request
+        (see NFSClient.run_batch). Returns the response, whose 'results'
+        hold one result per operation even when some failed"""
+        ops = [{'command': command, 'args': list(args)} for command, args in ops]
+        return self.request('batch', [], {'ops': ops, 'atomic': atomic})
+        
+    def stats(self):
+        """The server's metrics, see the stats command"""
+        return self.call('stats')['stats']
+
 def main():
     parser = argparse.ArgumentParser(description='NFS Client')
     parser.add_argument('--host', default='localhost', help='Server host')
     parser.add_argument('--port', type=int, default=5000, help='Server port')
+    parser.add_argument('--compression', nargs='*', metavar='CODEC',
+                        help='Compression codecs to offer (default: all available, none to disable)')
+    parser.add_argument('--codec', nargs='+', metavar='CODEC', dest='codecs',
+                        help='Message codecs to offer: compact, msgpack, json (default: all available)')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL,
+                        help='Seconds listings and attributes are cached without a lease (0 disables the cache)')
+    parser.add_argument('--cache-dir', help='Also cache the contents of files read into this directory')
     args = parser.parse_args()
     
-    client = NFSClient(args.host, args.port)
+    client = NFSClient(args.host, args.port, args.compression, args.codecs, args.cache_ttl, args.cache_dir)
     if not client.connect():
         sys.exit(1)
         
     try:
         while True:
             try:
-                command_line = input("\nEnter command (ls/copy/delete/help/quit): ").strip()
+                command_line = input("\nEnter command (ls/copy/delete/read/sync/batch/stats/help/quit): ").strip()
                 
                 if command_line == 'quit':
                     break
@@ -135,10 +651,16 @@ def main():
                 if command == 'help':
                     client.show_help()
                 elif command == 'ls':
-                    if len(args) != 1:
-                        print("Usage: ls <path>")
+                    if len(args) < 1:
+                        print("Usage: ls <path> [sort=name|size|mtime] [reverse=true] [pattern=<glob>] "
+                              "[type=file|dir] [min_size=<bytes>] [max_size=<bytes>] [limit=<page size>]")
+                        continue
+                    try:
+                        options = parse_options(args[1:])
+                    except ValueError as e:
+                        print(str(e))
                         continue
-                    client.ls(args[0])
+                    client.ls(args[0], **options)
                 elif command == 'copy':
                     if len(args) != 2:
                         print("Usage: copy <source_path> <destination_path>")
@@ -149,6 +671,23 @@ def main():
                         print("Usage: delete <path>")
                         continue
                     client.delete(args[0])
+                elif command == 'read':
+                    if len(args) != 2:
+                        print("Usage: read <remote_path> <local_path>")
+                        continue
+                    client.read(args[0], args[1])
+                elif command == 'sync':
+                    if len(args) != 2:
+                        print("Usage: sync <local_path> <remote_path>")
+                        continue
+                    client.sync(args[0], args[1])
+                elif command == 'stats':
+                    client.stats()
+                elif command == 'batch':
+                    if not args or args[1:] not in ([], ['atomic=true']):
+                        print("Usage: batch <ops_file> [atomic=true]")
+                        continue
+                    client.batch(args[0], atomic=args[1:] == ['atomic=true'])
                 else:
                     print("Invalid command. Type 'help' for available commands.")
                     
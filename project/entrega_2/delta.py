@@ -0,0 +1,175 @@
+import hashlib
+import math
+import os
+import zlib
+
+# Blocks are about the square root of the file size, within these bounds
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+
+# Modulus of the Adler-32 sums
+ADLER_BASE = 65521
+
+# Literal data gathered before it is emitted as one operation
+LITERAL_LIMIT = 1024 * 1024
+
+COPY_CHUNK = 1024 * 1024
+
+# Through a stretch without matches, the window skips a block and then rolls
+# over 1/SPARSE_ROLL of one, instead of rolling over every byte; the
+# fraction halves each time a sweep of every offset finds nothing
+SPARSE_ROLL = 8
+
+
+def block_size_for(size):
+    """Block size used to sign a file of `size` bytes"""
+    block = int(math.sqrt(size)) // 1024 * 1024
+    return min(max(block, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def signature(file, block_size):
+    """Return the [weak, strong] checksums of each block of an open binary file.
+
+    The weak checksum is Adler-32, which the sender can roll forward one
+    byte at a time; the strong one confirms a weak match.
+    """
+    blocks = []
+    while True:
+        block = file.read(block_size)
+        if not block:
+            return blocks
+        blocks.append([zlib.adler32(block), strong_checksum(block)])
+
+
+def delta(data, blocks, block_size, base_size):
+    """Yield the operations that turn the receiver's file into `data`.
+
+    `data` is a bytes-like object such as an mmap of the sender's file and
+    `blocks` the signature of the receiver's file of `base_size` bytes.
+    Operations are ('copy', offset, first_block, count) for runs of blocks
+    the receiver already has and ('data', offset, bytes) for literal data,
+    where offset is the position in the new file. Aligned blocks are
+    checked at C speed; the window is only rolled byte by byte through
+    regions that differ.
+
+    Rolling costs a Python step per byte, so it is rationed: after a match
+    the window rolls over one whole block, which finds blocks shifted by
+    an insertion or deletion shorter than a block. If nothing matches, the
+    stretch is taken as new data and the window alternates between
+    skipping a block and rolling over 1/SPARSE_ROLL of one. Each cycle
+    starts at a different offset within a block, so SPARSE_ROLL cycles
+    try every shift, and blocks shifted by a longer insertion are still
+    found. Every sweep that finds nothing halves the fraction rolled, so
+    data with nothing in common with the receiver's file costs little
+    more than its aligned checks, while the data sent as literal past the
+    end of an insertion stays within about the length of the insertion.
+    """
+    index = {}
+    for number, (weak, strong) in enumerate(blocks):
+        index.setdefault(weak, []).append((number, strong))
+    last_length = base_size - (len(blocks) - 1) * block_size if blocks else 0
+
+    def find(weak, start, length):
+        candidates = index.get(weak)
+        if not candidates:
+            return None
+        strong = None
+        for number, expected in candidates:
+            expected_length = last_length if number == len(blocks) - 1 else block_size
+            if expected_length != length:
+                continue
+            if strong is None:
+                strong = strong_checksum(data[start:start + length])
+            if strong == expected:
+                return number
+        return None
+
+    size = len(data)
+    position = 0
+    literal_start = 0
+    run = None
+    weak = None
+    # Bytes left to roll over before skipping a block, the fraction of a
+    # block rolled after a skip and the skips left in the current sweep
+    budget = block_size
+    sparse = cycles = SPARSE_ROLL
+    while position < size:
+        length = min(block_size, size - position)
+        if weak is None:
+            weak = zlib.adler32(data[position:position + length])
+        number = find(weak, position, length) if index else None
+
+        if number is not None:
+            if literal_start < position:
+                if run:
+                    yield run
+                    run = None
+                yield ('data', literal_start, bytes(data[literal_start:position]))
+            if run and run[2] + run[3] == number and run[1] + run[3] * block_size == position:
+                run = ('copy', run[1], run[2], run[3] + 1)
+            else:
+                if run:
+                    yield run
+                run = ('copy', position, number, 1)
+            position += length
+            literal_start = position
+            weak = None
+            budget = block_size
+            sparse = cycles = SPARSE_ROLL
+            continue
+
+        if position + block_size >= size or not index:
+            # No full window left to roll, the rest is literal
+            position = size
+            break
+
+        if budget:
+            # Slide the window one byte: drop data[position], add data[position + block_size]
+            out, new = data[position], data[position + block_size]
+            a = ((weak & 0xffff) - out + new) % ADLER_BASE
+            b = ((weak >> 16) - block_size * out + a - 1) % ADLER_BASE
+            weak = (b << 16) | a
+            position += 1
+            budget -= 1
+        else:
+            position += block_size
+            weak = None
+            cycles -= 1
+            if not cycles:
+                sparse = cycles = min(sparse * 2, block_size)
+            budget = max(block_size // sparse, 1)
+
+        if position - literal_start >= LITERAL_LIMIT:
+            if run:
+                yield run
+                run = None
+            while position - literal_start >= LITERAL_LIMIT:
+                yield ('data', literal_start, bytes(data[literal_start:literal_start + LITERAL_LIMIT]))
+                literal_start += LITERAL_LIMIT
+
+    if run:
+        yield run
+    while literal_start < size:
+        end = min(literal_start + LITERAL_LIMIT, size)
+        yield ('data', literal_start, bytes(data[literal_start:end]))
+        literal_start = end
+
+
+def apply_copy(base_fd, out_fd, offset, first_block, count, block_size, base_size):
+    """Copy a run of the receiver's blocks into the new file at `offset`"""
+    source = first_block * block_size
+    remaining = min(count * block_size, base_size - source)
+    while remaining > 0:
+        try:
+            n = os.copy_file_range(base_fd, out_fd, remaining, source, offset)
+        except (AttributeError, OSError):
+            n = os.pwrite(out_fd, os.pread(base_fd, min(COPY_CHUNK, remaining), source), offset)
+        if n == 0:
+            raise ValueError('Block range beyond the end of the file')
+        source += n
+        offset += n
+        remaining -= n
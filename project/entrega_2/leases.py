@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+# Seconds a client may trust what it cached about a path without asking
+LEASE_TIME = 30
+
+
+class LeaseTable:
+    """Read leases granted to clients on server paths.
+
+    A client holding a lease on a path may answer listings, attributes and
+    reads of it from its cache until the lease expires. A change to the
+    path, to an entry of the directory it names or, for trees, to anything
+    below it recalls the lease first, and the server tells the holder to
+    drop what it cached.
+    """
+
+    def __init__(self, duration=LEASE_TIME):
+        self.duration = duration
+        # path -> {client id: expiry}
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.last_prune = time.monotonic()
+
+    def grant(self, path, client_id):
+        """Lease `path` to a client, returns the lease time in seconds"""
+        now = time.monotonic()
+        with self.lock:
+            self.leases.setdefault(path, {})[client_id] = now + self.duration
+            if now - self.last_prune > self.duration:
+                self.prune(now)
+        return self.duration
+
+    def recall(self, path, tree=False):
+        """Remove the leases a change of `path` breaks: on the path itself,
+        on its parent directory and, with `tree`, on paths below it.
+        Returns the unexpired ones as {client id: [paths]}"""
+        now = time.monotonic()
+        recalled = {}
+        with self.lock:
+            paths = [path, os.path.dirname(path)]
+            if tree:
+                prefix = os.path.join(path, '')
+                paths += [leased for leased in self.leases if leased.startswith(prefix)]
+            for leased in paths:
+                for client_id, expiry in self.leases.pop(leased, {}).items():
+                    if expiry > now:
+                        recalled.setdefault(client_id, []).append(leased)
+        return recalled
+
+    def release(self, client_id):
+        """Drop the leases of a disconnected client"""
+        with self.lock:
+            for path in list(self.leases):
+                holders = self.leases[path]
+                holders.pop(client_id, None)
+                if not holders:
+                    del self.leases[path]
+
+    def prune(self, now):
+        # Forget expired leases; called with the lock held
+        for path in list(self.leases):
+            holders = self.leases[path]
+            for client_id in [client_id for client_id, expiry in holders.items() if expiry <= now]:
+                del holders[client_id]
+            if not holders:
+                del self.leases[path]
+        self.last_prune = now
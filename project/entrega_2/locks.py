@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+READ = 'read'
+WRITE = 'write'
+
+
+class ReadWriteLock:
+    """Shared/exclusive lock. Waiting writers block new readers so a steady
+    stream of `ls` calls cannot starve a copy or delete."""
+    
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        # Number of threads holding or waiting for this lock, used by
+        # PathLockManager to drop locks nobody needs anymore
+        self.users = 0
+        
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+            
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+                
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+            
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class PathLockManager:
+    """Reader/writer locks scoped to filesystem paths.
+    
+    Locking a path also takes shared locks on all of its ancestors, so a
+    writer on a directory excludes everyone working below it while
+    operations on unrelated paths run concurrently. Every operation acquires
+    its whole set of locks in sorted path order, which makes multi-path
+    operations such as copy deadlock-free.
+    
+    `on_wait`, if given, is called with the seconds each operation waited
+    for its locks.
+    """
+    
+    def __init__(self, on_wait=None):
+        self.mutex = threading.Lock()
+        self.locks = {}
+        self.on_wait = on_wait
+        
+    @staticmethod
+    def ancestors(path):
+        parents = []
+        parent = os.path.dirname(path)
+        while parent != path:
+            parents.append(parent)
+            path, parent = parent, os.path.dirname(parent)
+        return parents
+        
+    def plan(self, reads, writes):
+        """Map every path to lock onto the mode it needs"""
+        modes = {}
+        for path in list(reads) + list(writes):
+            for parent in self.ancestors(path):
+                modes.setdefault(parent, READ)
+        for path in reads:
+            modes.setdefault(path, READ)
+        for path in writes:
+            modes[path] = WRITE
+        return sorted(modes.items())
+        
+    def checkout(self, path):
+        with self.mutex:
+            lock = self.locks.get(path)
+            if lock is None:
+                lock = self.locks[path] = ReadWriteLock()
+            lock.users += 1
+            return lock
+            
+    def checkin(self, path, lock):
+        with self.mutex:
+            lock.users -= 1
+            if not lock.users:
+                del self.locks[path]
+                
+    @contextmanager
+    def locked(self, reads=(), writes=()):
+        """Hold shared locks on `reads` and exclusive locks on `writes`.
+        Paths must be absolute and normalized."""
+        held = []
+        started = time.perf_counter() if self.on_wait else None
+        try:
+            for path, mode in self.plan(reads, writes):
+                lock = self.checkout(path)
+                try:
+                    if mode == WRITE:
+                        lock.acquire_write()
+                    else:
+                        lock.acquire_read()
+                except BaseException:
+                    self.checkin(path, lock)
+                    raise
+                held.append((path, mode, lock))
+            if self.on_wait:
+                self.on_wait(time.perf_counter() - started)
+            yield
+        finally:
+            for path, mode, lock in reversed(held):
+                if mode == WRITE:
+                    lock.release_write()
+                else:
+                    lock.release_read()
+                self.checkin(path, lock)
@@ -1,169 +1,874 @@
 import socket
 import threading
 import os
-import json
 import logging
 import datetime
-import shutil
+import sys
+import argparse
+import asyncio
+import base64
+import hashlib
+import stat
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler('nfs_server.log'),
-        logging.StreamHandler()
-    ]
-)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.aio import AsyncServer
+from common.listing_cache import ListingCache
+from common.metrics import server_metrics
+from common.outbox import AsyncOutbox, Outbox
+from common.pagination import page_with_options
+from common.profiling import RequestProfiler
+from common.protocol import Connection
+from common.server_core import PooledServer
+from common.transfer import hash_file
+from common.treecopy import copy_file, copy_tree
+from auditlog import BACKUP_COUNT, LOG_FILE, MAX_BYTES, AuditLog, log_operation
+from batch import BATCH_COMMANDS, Rollback
+from delta import apply_copy, block_size_for, signature
+from leases import LEASE_TIME, LeaseTable
+from locks import PathLockManager
+
+# Commands counted under their own name in the metrics, others as 'other'
+COMMANDS = ('ls', 'stat', 'copy', 'delete', 'batch', 'read', 'stats',
+            'sync_start', 'sync_chunk', 'sync_commit', 'sync_abort')
 
 class NFSServer:
-    def __init__(self, host='localhost', port=5000, export_dir='/tmp/nfs_export'):
+    def __init__(self, host='localhost', port=5000, export_dir='/tmp/nfs_export', use_sendfile=True,
+                 workers=8, max_in_flight=64, copy_workers=8, lease_time=LEASE_TIME):
         self.host = host
         self.port = port
         self.export_dir = export_dir
+        # Files being built by delta syncs are kept next to the export
+        # directory, so they never show up in it half written
+        self.incoming_dir = f"{os.path.abspath(export_dir)}.incoming"
+        self.use_sendfile = use_sendfile
         self.server_socket = None
         self.clients = {}
-        self.lock = threading.Lock()
+        # Directory listings, revalidated by mtime and dropped on our own mutations
+        self.listing_cache = ListingCache()
+        # Request counts and latencies, bytes, connections, lock waits and
+        # cache hits, read with the stats command or over HTTP
+        self.metrics = server_metrics('nfs', lambda: len(self.clients), self.listing_cache)
+        self.metrics.describe('lock_wait_seconds', 'histogram', 'Time requests waited for their path locks')
+        # Phase timings, sampled profiles and slow request dumps, when
+        # enabled (see common/profiling.py)
+        self.profiler = None
+        # Shared locks for reads, exclusive locks for mutations, per path
+        self.locks = PathLockManager(on_wait=self.record_lock_wait)
+        # Leases on 'remoto:' paths cached by clients, and the outbox of each
+        # client, through which they are recalled
+        self.leases = LeaseTable(lease_time)
+        self.outboxes = {}
+        # Requests carrying an 'id' are pipelined: they run on this pool and
+        # are answered as they complete, possibly out of order
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        # Threads copying the files of one directory tree in parallel
+        self.copy_workers = copy_workers
+        # Delta syncs in progress, by token
+        self.syncs = {}
+        self.async_server = None
+        self.pool = None
         
         # Create export directory if it doesn't exist
         os.makedirs(export_dir, exist_ok=True)
         
-    def start(self):
-        """Start the NFS server"""
+    def start(self, engine='thread', max_connections=256, accept_queue=128):
+        """Start the NFS server with the 'thread' or 'asyncio' engine.
+        
+        Both engines serve at most `max_connections` clients at once. The
+        thread engine keeps up to `accept_queue` more waiting and answers
+        'busy' beyond that.
+        """
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(socket.SOMAXCONN)
         
-        logging.info(f"NFS Server started on {self.host}:{self.port}")
+        logging.info(f"NFS Server started on {self.host}:{self.port} ({engine} engine)")
         logging.info(f"Exporting directory: {self.export_dir}")
         
-        while True:
-            client_socket, address = self.server_socket.accept()
-            client_thread = threading.Thread(
-                target=self.handle_client,
-                args=(client_socket, address)
-            )
-            client_thread.start()
+        try:
+            if engine == 'asyncio':
+                # Blocking handlers run on a pool of their own, the
+                # pipelining pool only reads files being streamed
+                self.server_socket.setblocking(False)
+                self.async_server = AsyncServer(self.server_socket, self.handle_client_async,
+                                                max_connections, self.workers)
+                self.async_server.run()
+                return
+                
+            self.pool = PooledServer(self.server_socket, self.handle_client, max_connections, accept_queue,
+                                     reject=self.reject_client)
+            self.pool.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("NFS Server shutting down")
+            if self.pool:
+                self.pool.shutdown()
+        finally:
+            self.server_socket.close()
+            self.executor.shutdown(wait=False)
             
+    def reject_client(self, client_socket, address):
+        """Answer a connection the server has no capacity for"""
+        self.metrics.inc('connections_rejected_total')
+        logging.info(f"Server busy, rejected client: {address[0]}:{address[1]}")
+        Connection(client_socket).send_message({'status': 'busy', 'message': 'Server busy, try again later'})
+        
     def handle_client(self, client_socket, address):
         """Handle client connections"""
         client_id = f"{address[0]}:{address[1]}"
-        self.clients[client_id] = client_socket
+        conn = Connection(client_socket)
+        conn.metrics = self.metrics
+        conn.time_decode = self.profiler is not None
+        self.metrics.inc('connections_total')
+        self.clients[client_id] = conn
+        # Lease recalls and progress reports, written without holding the
+        # thread that sends them
+        outbox = Outbox(conn)
+        self.outboxes[client_id] = outbox
         
         logging.info(f"New client connected: {client_id}")
         
+        # Stop reading new requests while this many are still being processed
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
         try:
             while True:
-                data = client_socket.recv(4096)
-                if not data:
+                request = conn.recv_message()
+                if request is None:
                     break
                     
-                request = json.loads(data.decode())
-                response = self.process_request(request, client_id)
-                client_socket.send(json.dumps(response).encode())
+                if request.get('command') == 'hello':
+                    conn.accept_hello(request)
+                    continue
+                    
+                trace = self.begin_trace(conn, request, client_id)
+                if request.get('command') == 'read':
+                    self.stream_read(conn, request, client_id, trace)
+                elif 'id' in request:
+                    in_flight.acquire()
+                    try:
+                        self.executor.submit(self.answer_request, conn, request, client_id, in_flight, outbox,
+                                             trace)
+                    except Exception:
+                        in_flight.release()
+                        raise
+                else:
+                    self.respond(conn, self.process_request(request, client_id, trace=trace), trace)
                 
         except Exception as e:
             logging.error(f"Error handling client {client_id}: {str(e)}")
         finally:
-            client_socket.close()
+            # Pipelined requests still running answer on this connection and
+            # may use its outbox and leases: wait for all of them to finish
+            for _ in range(self.max_in_flight):
+                in_flight.acquire()
+            del self.outboxes[client_id]
+            outbox.close()
+            conn.close()
+            self.abort_syncs(client_id)
+            self.leases.release(client_id)
             del self.clients[client_id]
             logging.info(f"Client disconnected: {client_id}")
             
-    def process_request(self, request, client_id):
-        """Process client requests"""
+    def process_request(self, request, client_id, progress=None, trace=None):
+        """Process client requests, reporting long copies through `progress`"""
+        started = time.perf_counter()
+        response = self.run_traced(trace, self.dispatch, request, client_id, progress)
+        self.record_request(request.get('command'), response['status'], started)
+        return response
+        
+    def record_request(self, command, status, started):
+        command = command if command in COMMANDS else 'other'
+        self.metrics.inc('requests_total', command=command, status=status)
+        self.metrics.observe('request_seconds', time.perf_counter() - started, command=command)
+        
+    def record_lock_wait(self, seconds):
+        self.metrics.observe('lock_wait_seconds', seconds)
+        if self.profiler:
+            self.profiler.lock_wait(seconds)
+            
+    def begin_trace(self, conn, request, client_id):
+        """Start profiling a request just received, None unless profiling is on"""
+        if not self.profiler:
+            return None
+        command = request.get('command')
+        return self.profiler.begin(command if command in COMMANDS else 'other', client_id, request,
+                                   conn.decode_seconds)
+        
+    def run_traced(self, trace, function, *args):
+        """Run the command of a request, profiled when it has a trace"""
+        if trace:
+            return self.profiler.call(trace, function, *args)
+        return function(*args)
+        
+    def respond(self, conn, response, trace=None):
+        """Send a response and finish the trace of its request"""
+        if not trace:
+            conn.send_message(response)
+            return
+        trace.send_message(conn, response)
+        self.profiler.finish(trace, response['status'])
+        
+    async def respond_async(self, conn, response, trace=None):
+        """respond() on the asyncio engine"""
+        if not trace:
+            await conn.send_message(response)
+            return
+        await trace.send_message_async(conn, response)
+        self.profiler.finish(trace, response['status'])
+        
+    def dispatch(self, request, client_id, progress=None):
+        """Run the command of a request and return its response"""
         command = request.get('command')
         args = request.get('args', [])
         
         try:
             if command == 'ls':
-                return self.handle_ls(args[0], client_id)
+                return self.leased(request, client_id, self.handle_ls, args[0], client_id, request.get('options'))
+            elif command == 'stat':
+                return self.leased(request, client_id, self.handle_stat, args[0], client_id)
             elif command == 'copy':
-                return self.handle_copy(args[0], args[1], client_id)
+                return self.handle_copy(args[0], args[1], client_id, progress)
             elif command == 'delete':
-                return self.handle_delete(args[0], client_id)
+                try:
+                    return self.handle_delete(args[0], client_id)
+                finally:
+                    self.recall_leases(args[0], client_id)
+            elif command == 'batch':
+                return self.handle_batch(request.get('options', {}), client_id)
+            elif command == 'stats':
+                return {'status': 'success', 'stats': self.metrics.snapshot()}
+            elif command == 'sync_start':
+                return self.handle_sync_start(args[0], client_id, request.get('options', {}))
+            elif command == 'sync_chunk':
+                return self.handle_sync_chunk(request.get('options', {}), client_id)
+            elif command == 'sync_commit':
+                return self.handle_sync_commit(request.get('options', {}), client_id)
+            elif command == 'sync_abort':
+                return self.handle_sync_abort(request.get('options', {}), client_id)
             else:
                 return {'status': 'error', 'message': 'Invalid command'}
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
             
-    def handle_ls(self, path, client_id):
-        """Handle ls command"""
-        with self.lock:
-            try:
-                if path.startswith('remoto:'):
-                    path = os.path.join(self.export_dir, path[7:])
+    async def handle_client_async(self, conn, address):
+        """Handle a client connection on the asyncio engine"""
+        client_id = f"{address[0]}:{address[1]}"
+        conn.metrics = self.metrics
+        conn.time_decode = self.profiler is not None
+        self.metrics.inc('connections_total')
+        self.clients[client_id] = conn
+        # Lease recalls and progress reports, written without holding the
+        # worker thread that sends them
+        outbox = AsyncOutbox(conn)
+        self.outboxes[client_id] = outbox
+        
+        logging.info(f"New client connected: {client_id}")
+        
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        try:
+            while True:
+                request = await conn.recv_message()
+                if request is None:
+                    break
+                    
+                if request.get('command') == 'hello':
+                    await conn.accept_hello(request)
+                    continue
+                    
+                trace = self.begin_trace(conn, request, client_id)
+                if request.get('command') == 'read':
+                    await self.stream_read_async(conn, request, client_id, trace)
+                elif 'id' in request:
+                    await in_flight.acquire()
+                    task = asyncio.create_task(self.answer_request_async(conn, request, client_id, in_flight,
+                                                                         outbox, trace))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
                 else:
-                    path = os.path.abspath(path)
+                    response = await self.async_server.run_blocking(self.process_request, request, client_id,
+                                                                    None, trace)
+                    await self.respond_async(conn, response, trace)
                     
+        except Exception as e:
+            logging.error(f"Error handling client {client_id}: {str(e)}")
+        finally:
+            # Pipelined requests still running answer on this connection and
+            # may use its outbox and leases: wait for all of them to finish,
+            # however the loop ended
+            if tasks:
+                await asyncio.wait(tasks)
+            del self.outboxes[client_id]
+            await outbox.close()
+            self.abort_syncs(client_id)
+            self.leases.release(client_id)
+            del self.clients[client_id]
+            logging.info(f"Client disconnected: {client_id}")
+            
+    async def answer_request_async(self, conn, request, client_id, in_flight, outbox, trace=None):
+        """Process a pipelined request on the asyncio engine"""
+        try:
+            progress = None
+            if request.get('progress'):
+                # Called from the worker thread, which must not wait for the
+                # client to read; reports are dropped if it falls far behind
+                progress = lambda state: outbox.put(dict(state, status='progress', id=request['id']),
+                                                    droppable=True)
+            response = await self.async_server.run_blocking(self.process_request, request, client_id, progress,
+                                                            trace)
+            response['id'] = request['id']
+            if progress:
+                # The final response goes after the reports
+                await outbox.flush()
+            await self.respond_async(conn, response, trace)
+        except Exception as e:
+            logging.error(f"Error answering client {client_id}: {str(e)}")
+        finally:
+            in_flight.release()
+            
+    async def stream_read_async(self, conn, request, client_id, trace=None):
+        """Send a read header frame followed by the file contents on the asyncio engine"""
+        started = time.perf_counter()
+        try:
+            response, file = await self.async_server.run_blocking(
+                self.run_traced, trace, self.leased, request, client_id, self.handle_read,
+                request.get('args', [])[0], client_id)
+        except Exception as e:
+            response, file = {'status': 'error', 'message': str(e)}, None
+        if 'id' in request:
+            response['id'] = request['id']
+        try:
+            if not file:
+                await self.respond_async(conn, response, trace)
+                return
+            sending = time.perf_counter()
+            with file:
+                await conn.send_file(file, use_sendfile=self.use_sendfile,
+                                     executor=self.executor, header=response)
+            if trace:
+                trace.add('send', time.perf_counter() - sending)
+                self.profiler.finish(trace, response['status'])
+        finally:
+            self.record_request('read', response['status'], started)
+            
+    def answer_request(self, conn, request, client_id, in_flight, outbox, trace=None):
+        """Process a pipelined request and send its response tagged with the request id"""
+        try:
+            progress = None
+            if request.get('progress'):
+                # Reports are dropped if the client falls far behind
+                progress = lambda state: outbox.put(dict(state, status='progress', id=request['id']),
+                                                    droppable=True)
+            response = self.process_request(request, client_id, progress, trace)
+            response['id'] = request['id']
+            if progress:
+                # The final response goes after the reports
+                outbox.flush()
+            self.respond(conn, response, trace)
+        except Exception as e:
+            logging.error(f"Error answering client {client_id}: {str(e)}")
+        finally:
+            in_flight.release()
+            
+    def stream_read(self, conn, request, client_id, trace=None):
+        """Send a read header frame followed by the file contents"""
+        started = time.perf_counter()
+        try:
+            response, file = self.run_traced(trace, self.leased, request, client_id, self.handle_read,
+                                             request.get('args', [])[0], client_id)
+        except Exception as e:
+            response, file = {'status': 'error', 'message': str(e)}, None
+        if 'id' in request:
+            response['id'] = request['id']
+        # Hold the send lock so no pipelined response lands inside the stream
+        try:
+            with conn.send_lock:
+                if not file:
+                    self.respond(conn, response, trace)
+                    return
+                sending = time.perf_counter()
+                conn.send_message(response)
+                with file:
+                    conn.send_file(file, use_sendfile=self.use_sendfile)
+            if trace:
+                trace.add('send', time.perf_counter() - sending)
+                self.profiler.finish(trace, response['status'])
+        finally:
+            self.record_request('read', response['status'], started)
+            
+    def leased(self, request, client_id, handler, *args):
+        """Run a handler reading the path of `request`. When the request
+        asks for a lease on a 'remoto:' path it is granted before reading,
+        so a change racing with the read still recalls it, and a successful
+        response tells the client for how long"""
+        path = request.get('args', [''])[0]
+        lease = None
+        if request.get('lease') and path.startswith('remoto:'):
+            lease = self.leases.grant(self.resolve_path(path), client_id)
+        result = handler(*args)
+        response = result[0] if isinstance(result, tuple) else result
+        if lease and response['status'] == 'success':
+            response['lease'] = lease
+        return result
+        
+    def recall_leases(self, path, client_id, tree=False):
+        """Tell the other clients holding leases that a change of `path`
+        breaks to drop what they cached. Runs before the change is
+        acknowledged, so a client opening the path afterwards sees it"""
+        if path.startswith('remoto:'):
+            self.notify_recalled(self.leases.recall(self.resolve_path(path), tree), client_id)
+            
+    def notify_recalled(self, recalled, client_id):
+        """Send every holder but `client_id` one message with its recalled
+        paths, and wait until they are written. A holder that does not read
+        them holds this up for at most the lease time, after which its
+        leases have run out anyway: clients count a lease from when they
+        sent the request, so they never trust one longer than the server"""
+        deadline = time.monotonic() + self.leases.duration
+        pending = []
+        for holder, paths in recalled.items():
+            outbox = self.outboxes.get(holder)
+            if holder == client_id or not outbox:
+                continue
+            try:
+                message = {'status': 'invalidate', 'paths': [self.client_path(leased) for leased in paths]}
+                pending.append(outbox.put(message))
+            except Exception as e:
+                logging.error(f"Error recalling leases of client {holder}: {str(e)}")
+        for sent in pending:
+            sent.wait(max(deadline - time.monotonic(), 0))
+                
+    def client_path(self, path):
+        """The 'remoto:' path of a path inside the export directory"""
+        relative = os.path.relpath(path, self.export_dir)
+        return 'remoto:/' + ('' if relative == '.' else relative.replace(os.sep, '/'))
+        
+    def resolve_path(self, path):
+        """Map a 'remoto:' path into the export directory, other paths to absolute ones"""
+        if path.startswith('remoto:'):
+            return os.path.normpath(os.path.join(self.export_dir, path[7:].lstrip('/')))
+        return os.path.abspath(path)
+        
+    def handle_read(self, path, client_id):
+        """Handle read command"""
+        if not path.startswith('remoto:'):
+            return {'status': 'error', 'message': 'Only remote files can be read'}, None
+        path = self.resolve_path(path)
+        
+        with self.locks.locked(reads=[path]):
+            if not os.path.isfile(path):
+                return {'status': 'error', 'message': 'File does not exist'}, None
+                
+            # The file is streamed after the lock is released; the open
+            # descriptor keeps its contents readable even if it is deleted
+            file = open(path, 'rb')
+            st = os.fstat(file.fileno())
+            
+        log_operation(client_id, 'read', f"CLIENTE_{client_id} leu o arquivo '{path}'", path=path, size=st.st_size)
+        return {'status': 'success', 'size': st.st_size, 'mtime': st.st_mtime_ns}, file
+            
+    def handle_ls(self, path, client_id, options=None):
+        """Handle ls command. `options` selects one page of a sorted and
+        filtered listing, see common/pagination.py"""
+        try:
+            path = self.resolve_path(path)
+            with self.locks.locked(reads=[path]):
                 if not os.path.exists(path):
                     return {'status': 'error', 'message': 'Path does not exist'}
                     
+                page, next_cursor = page_with_options(self.listing_cache.get(path), options)
                 files = []
-                for item in os.listdir(path):
-                    full_path = os.path.join(path, item)
+                for name, is_dir, size, _ in page:
                     files.append({
-                        'name': item,
-                        'is_dir': os.path.isdir(full_path),
-                        'size': os.path.getsize(full_path) if os.path.isfile(full_path) else 0
+                        'name': name,
+                        'is_dir': is_dir,
+                        'size': size
                     })
                     
-                logging.info(f"CLIENTE_{client_id} realizou operação 'ls' no diretório '{path}'")
-                return {'status': 'success', 'files': files}
+            log_operation(client_id, 'ls', f"CLIENTE_{client_id} realizou operação 'ls' no diretório '{path}'",
+                          path=path, entries=len(files))
+            return {'status': 'success', 'files': files, 'next_cursor': next_cursor}
+            
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
                 
-            except Exception as e:
-                return {'status': 'error', 'message': str(e)}
+    def handle_stat(self, path, client_id):
+        """Handle stat command: the type, size and mtime of a path"""
+        try:
+            path = self.resolve_path(path)
+            with self.locks.locked(reads=[path]):
+                st = os.stat(path)
+            return {'status': 'success', 'is_dir': stat.S_ISDIR(st.st_mode), 'size': st.st_size,
+                    'mtime': st.st_mtime_ns}
+        except FileNotFoundError:
+            return {'status': 'error', 'message': 'Path does not exist'}
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+            
+    def handle_copy(self, src, dst, client_id, progress=None):
+        """Handle copy command for a file or a whole directory tree"""
+        remote = dst.startswith('remoto:')
+        try:
+            src = self.resolve_path(src)
+            dst = self.copy_destination(src, self.resolve_path(dst))
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+        created = dst
+        try:
+            with self.locks.locked(reads=[src], writes=[dst]):
+                created = self.created_root(dst)
+                return self.copy_locked(src, dst, client_id, progress)
                 
-    def handle_copy(self, src, dst, client_id):
-        """Handle copy command"""
-        with self.lock:
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+        finally:
+            if remote:
+                self.notify_recalled(self.leases.recall(created, True), client_id)
+            
+    def created_root(self, path):
+        """The topmost directory a write of `path` creates along with its
+        missing parents, or `path` itself. Recalling it as a tree covers
+        the listings of every directory the write adds"""
+        while not os.path.exists(os.path.dirname(path)):
+            path = os.path.dirname(path)
+        return path
+        
+    def copy_destination(self, src, dst):
+        """The path a copy of `src` to `dst` writes: a file copied onto a
+        directory goes inside it, as with cp"""
+        if os.path.isfile(src) and os.path.isdir(dst):
+            return os.path.join(dst, os.path.basename(src))
+        return dst
+        
+    def copy_locked(self, src, dst, client_id, progress=None, rollback=None):
+        """Copy resolved paths whose locks are held. With a `rollback`
+        journal, the copy records how to undo it"""
+        if not os.path.exists(src):
+            return {'status': 'error', 'message': 'Source file does not exist'}
+            
+        if os.path.isdir(src):
+            if os.path.exists(dst):
+                return {'status': 'error', 'message': 'Destination directory already exists'}
+            if rollback:
+                rollback.makedirs(os.path.dirname(dst))
+                rollback.created(dst)
             try:
-                # Handle source path
-                if src.startswith('remoto:'):
-                    src = os.path.join(self.export_dir, src[7:])
-                else:
-                    src = os.path.abspath(src)
-                    
-                # Handle destination path
-                if dst.startswith('remoto:'):
-                    dst = os.path.join(self.export_dir, dst[7:])
-                else:
-                    dst = os.path.abspath(dst)
-                    
-                if not os.path.exists(src):
-                    return {'status': 'error', 'message': 'Source file does not exist'}
-                    
-                # Create destination directory if it doesn't exist
-                os.makedirs(os.path.dirname(dst), exist_ok=True)
-                
-                shutil.copy2(src, dst)
-                logging.info(f"CLIENTE_{client_id} copiou o arquivo '{src}' para '{dst}'")
-                return {'status': 'success', 'message': 'File copied successfully'}
-                
-            except Exception as e:
-                return {'status': 'error', 'message': str(e)}
-                
+                result = copy_tree(src, dst, self.copy_workers, progress)
+            finally:
+                self.listing_cache.invalidate(dst)
+            log_operation(client_id, 'copy', f"CLIENTE_{client_id} copiou o diretório '{src}' para '{dst}'",
+                          src=src, dst=dst, files=result['files_done'], bytes=result['bytes_done'])
+            return {'status': 'success', 'message': 'Directory copied successfully',
+                    'files': result['files_done'], 'bytes': result['bytes_done']}
+            
+        # Create destination directory if it doesn't exist
+        if rollback:
+            rollback.makedirs(os.path.dirname(dst))
+            if os.path.isdir(dst):
+                raise IsADirectoryError(f"Is a directory: '{dst}'")
+            if os.path.lexists(dst):
+                # Kept until the batch commits, the copy writes a new file
+                rollback.stash(dst)
+            else:
+                rollback.created(dst)
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            
+        try:
+            size = copy_file(src, dst)
+        finally:
+            self.listing_cache.invalidate(dst)
+        log_operation(client_id, 'copy', f"CLIENTE_{client_id} copiou o arquivo '{src}' para '{dst}'",
+                      src=src, dst=dst, files=1, bytes=size)
+        return {'status': 'success', 'message': 'File copied successfully'}
+        
     def handle_delete(self, path, client_id):
         """Handle delete command"""
-        with self.lock:
+        try:
+            path = self.resolve_path(path)
+            with self.locks.locked(writes=[path]):
+                return self.delete_locked(path, client_id)
+                
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+            
+    def delete_locked(self, path, client_id, rollback=None):
+        """Delete a resolved path whose lock is held. With a `rollback`
+        journal the file is only moved aside until the batch commits"""
+        if not os.path.exists(path):
+            return {'status': 'error', 'message': 'File does not exist'}
+            
+        try:
+            if rollback:
+                if os.path.isdir(path):
+                    raise IsADirectoryError(f"Is a directory: '{path}'")
+                rollback.stash(path)
+            else:
+                os.remove(path)
+        finally:
+            self.listing_cache.invalidate(path)
+        log_operation(client_id, 'delete', f"CLIENTE_{client_id} deletou o arquivo '{path}'", path=path)
+        return {'status': 'success', 'message': 'File deleted successfully'}
+        
+    def handle_batch(self, options, client_id):
+        """Handle batch command: run a list of copy and delete operations
+        under a single acquisition of all their locks.
+        
+        `options['ops']` holds {'command', 'args'} objects and the response
+        one result per operation. Without `atomic` every operation runs and
+        failures are reported per operation; with it the first failure
+        stops the batch and undoes the operations before it.
+        """
+        ops = options.get('ops', [])
+        atomic = bool(options.get('atomic'))
+        for op in ops:
+            if op.get('command') not in BATCH_COMMANDS:
+                return {'status': 'error', 'message': f"Invalid command in batch: {op.get('command')}"}
+            if len(op.get('args', [])) != (2 if op['command'] == 'copy' else 1):
+                return {'status': 'error', 'message': f"Wrong arguments for {op['command']} in batch"}
+                
+        try:
+            resolved = [[self.resolve_path(path) for path in op['args']] for op in ops]
+            for op, paths in zip(ops, resolved):
+                if op['command'] == 'copy':
+                    paths[1] = self.copy_destination(*paths)
+            reads = [paths[0] for op, paths in zip(ops, resolved) if op['command'] == 'copy']
+            writes = [paths[-1] for paths in resolved]
+            rollback = Rollback(uuid.uuid4().hex) if atomic else None
+            results = []
+            created = list(writes)
             try:
-                if path.startswith('remoto:'):
-                    path = os.path.join(self.export_dir, path[7:])
-                else:
-                    path = os.path.abspath(path)
+                with self.locks.locked(reads=reads, writes=writes):
+                    created = [self.created_root(path) for path in writes]
+                    for op, paths in zip(ops, resolved):
+                        try:
+                            if op['command'] == 'copy':
+                                result = self.copy_locked(paths[0], paths[1], client_id, rollback=rollback)
+                            else:
+                                result = self.delete_locked(paths[0], client_id, rollback=rollback)
+                        except Exception as e:
+                            result = {'status': 'error', 'message': str(e)}
+                        results.append(result)
+                        if atomic and result['status'] != 'success':
+                            break
+                            
+                    failed = sum(result['status'] != 'success' for result in results)
+                    if atomic and failed:
+                        unrestored = rollback.rollback()
+                        for path in writes:
+                            self.listing_cache.invalidate(path)
+                    elif atomic:
+                        rollback.commit()
+            finally:
+                # Only what the batch may have changed: the destinations of
+                # the operations that ran
+                recalled = {}
+                for op, path, _ in zip(ops, created, results):
+                    if op['args'][-1].startswith('remoto:'):
+                        for holder, leased in self.leases.recall(path, op['command'] == 'copy').items():
+                            recalled.setdefault(holder, []).extend(leased)
+                self.notify_recalled(recalled, client_id)
+                
+            log_operation(client_id, 'batch', f"CLIENTE_{client_id} executou um lote de {len(results)} operações",
+                          operations=len(results), failed=failed, atomic=atomic)
+            if not failed:
+                return {'status': 'success', 'message': f'{len(ops)} operations completed', 'results': results}
+            if not atomic:
+                return {'status': 'error', 'message': f'{failed} of {len(ops)} operations failed',
+                        'results': results}
+                        
+            index = len(results) - 1
+            results = ([{'status': 'rolled_back'}] * index + [results[index]]
+                       + [{'status': 'skipped'}] * (len(ops) - index - 1))
+            message = f"Operation {index} failed ({results[index]['message']}), batch rolled back"
+            if unrestored:
+                message += f"; could not restore {', '.join(unrestored)}"
+            return {'status': 'error', 'message': message, 'results': results}
+            
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+            
+    def handle_sync_start(self, path, client_id, options):
+        """Start a delta sync of one file.
+        
+        Answers 'unchanged' when the destination already has the client's
+        size and mtime. Otherwise creates the new file next to the
+        destination and returns the block signature of the current one.
+        """
+        try:
+            path = self.resolve_path(path)
+            size, mtime = options['size'], options['mtime']
+            with self.locks.locked(reads=[path]):
+                try:
+                    base_stat = os.stat(path)
+                except FileNotFoundError:
+                    base_stat = None
+                if base_stat and not stat.S_ISREG(base_stat.st_mode):
+                    return {'status': 'error', 'message': 'Destination is not a regular file'}
+                if base_stat and base_stat.st_size == size and base_stat.st_mtime_ns == mtime:
+                    return {'status': 'success', 'unchanged': True}
                     
-                if not os.path.exists(path):
-                    return {'status': 'error', 'message': 'File does not exist'}
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                base = open(path, 'rb') if base_stat else None
+                base_size = base_stat.st_size if base_stat else 0
+                block_size = block_size_for(base_size)
+                try:
+                    blocks = signature(base, block_size) if base else []
+                except Exception:
+                    base.close()
+                    raise
+                
+            os.makedirs(self.incoming_dir, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.incoming_dir, prefix='sync-')
+            os.ftruncate(fd, size)
+            token = uuid.uuid4().hex
+            self.syncs[token] = {
+                'client': client_id,
+                'path': path,
+                'temp': temp,
+                'out': os.fdopen(fd, 'r+b'),
+                'base': base,
+                'base_stat': (base_size, base_stat.st_mtime_ns) if base_stat else None,
+                'block_size': block_size,
+                'mtime': mtime,
+            }
+            return {'status': 'success', 'token': token, 'block_size': block_size,
+                    'base_size': base_size, 'blocks': blocks}
                     
-                os.remove(path)
-                logging.info(f"CLIENTE_{client_id} deletou o arquivo '{path}'")
-                return {'status': 'success', 'message': 'File deleted successfully'}
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+            
+    def handle_sync_chunk(self, options, client_id):
+        """Apply delta operations to the new file of a sync. Chunks may
+        arrive in any order, each operation carries its own offset"""
+        try:
+            session = self.syncs.get(options['token'])
+            if not session or session['client'] != client_id:
+                return {'status': 'error', 'message': 'Unknown sync'}
+            out_fd = session['out'].fileno()
+            base_size = session['base_stat'][0] if session['base_stat'] else 0
+            for op in options['ops']:
+                if op[0] == 'copy':
+                    if not session['base']:
+                        return {'status': 'error', 'message': 'No blocks to copy from'}
+                    apply_copy(session['base'].fileno(), out_fd, op[1], op[2], op[3],
+                               session['block_size'], base_size)
+                else:
+                    os.pwrite(out_fd, base64.b64decode(op[2]), op[1])
+            return {'status': 'success'}
+            
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+            
+    def handle_sync_commit(self, options, client_id):
+        """Verify the new file of a sync and move it over the destination"""
+        session = self.syncs.get(options.get('token'))
+        if not session or session['client'] != client_id or not self.syncs.pop(options['token'], None):
+            return {'status': 'error', 'message': 'Unknown sync'}
+        try:
+            digest = hashlib.sha256()
+            hash_file(session['out'], digest)
+            if digest.hexdigest() != options['sha256']:
+                return {'status': 'error', 'message': 'Checksum mismatch after applying the delta'}
                 
-            except Exception as e:
-                return {'status': 'error', 'message': str(e)}
+            path = session['path']
+            with self.locks.locked(writes=[path]):
+                try:
+                    current = os.stat(path)
+                    mode = stat.S_IMODE(current.st_mode)
+                    current = (current.st_size, current.st_mtime_ns)
+                except FileNotFoundError:
+                    current, mode = None, 0o644
+                if current != session['base_stat']:
+                    return {'status': 'error', 'message': 'Destination changed during sync'}
+                    
+                os.chmod(session['temp'], mode)
+                os.utime(session['temp'], ns=(session['mtime'], session['mtime']))
+                try:
+                    os.replace(session['temp'], path)
+                finally:
+                    self.listing_cache.invalidate(path)
+            self.recall_leases(self.client_path(path), client_id)
+            log_operation(client_id, 'sync', f"CLIENTE_{client_id} sincronizou o arquivo '{path}'",
+                          path=path, size=os.fstat(session['out'].fileno()).st_size)
+            return {'status': 'success', 'message': 'File synchronized successfully'}
+            
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+        finally:
+            self.close_sync(session)
+            
+    def handle_sync_abort(self, options, client_id):
+        """Drop a sync the client gave up on"""
+        session = self.syncs.get(options.get('token'))
+        if session and session['client'] == client_id and self.syncs.pop(options['token'], None):
+            self.close_sync(session)
+        return {'status': 'success'}
+        
+    def abort_syncs(self, client_id):
+        """Drop the unfinished syncs of a disconnected client"""
+        for token, session in list(self.syncs.items()):
+            if session['client'] == client_id and self.syncs.pop(token, None):
+                self.close_sync(session)
+                
+    def close_sync(self, session):
+        session['out'].close()
+        if session['base']:
+            session['base'].close()
+        try:
+            os.remove(session['temp'])
+        except FileNotFoundError:
+            pass
 
 if __name__ == '__main__':
-    server = NFSServer()
-    server.start() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='NFS Server')
+    parser.add_argument('--host', default='localhost', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    parser.add_argument('--export-dir', default='/tmp/nfs_export', help='Directory exported to clients')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread', help='Connection handling engine')
+    parser.add_argument('--max-connections', type=int, default=256, help='Clients served at once')
+    parser.add_argument('--accept-queue', type=int, default=128, help='Clients waiting for the thread engine before it answers busy')
+    parser.add_argument('--workers', type=int, default=8, help='Threads running requests')
+    parser.add_argument('--copy-workers', type=int, default=8, help='Threads copying the files of a directory in parallel')
+    parser.add_argument('--lease-time', type=int, default=LEASE_TIME, help='Seconds clients may cache a path without asking')
+    parser.add_argument('--log-file', default=LOG_FILE, help='Operation log, rotated by size and age')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+                        help='Format of the log file: text lines or one JSON object per line')
+    parser.add_argument('--log-max-bytes', type=int, default=MAX_BYTES, help='Rotate the log past this size (0: never)')
+    parser.add_argument('--log-rotate-interval', type=float, default=0,
+                        help='Rotate the log after this many seconds (0: never)')
+    parser.add_argument('--log-backups', type=int, default=BACKUP_COUNT, help='Rotated log files kept')
+    parser.add_argument('--quiet', action='store_true', help='Do not echo the log to the console')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this localhost port')
+    parser.add_argument('--profile-sample', type=int, default=0, metavar='N',
+                        help='Profile one request in N with cProfile (see common/profiling.py)')
+    parser.add_argument('--slow-request', type=float, metavar='SECONDS',
+                        help='Log requests taking this long with the time of each phase')
+    parser.add_argument('--profile-dir', default='profiles', help='Directory for profiles and slow request traces')
+    args = parser.parse_args()
+    
+    # Log records are written by a background thread, never by the threads
+    # serving requests
+    audit_log = AuditLog(args.log_file, json_lines=args.log_format == 'json', console=not args.quiet,
+                         max_bytes=args.log_max_bytes, backup_count=args.log_backups,
+                         rotate_interval=args.log_rotate_interval).start()
+    try:
+        server = NFSServer(args.host, args.port, args.export_dir, workers=args.workers,
+                           copy_workers=args.copy_workers, lease_time=args.lease_time)
+        if args.profile_sample or args.slow_request is not None:
+            server.profiler = RequestProfiler(args.profile_sample, args.slow_request, args.profile_dir,
+                                              server.metrics, log=logging.warning)
+            logging.info(f"Profiling requests into {args.profile_dir}")
+        if args.metrics_port:
+            server.metrics.serve(args.metrics_port)
+            logging.info(f"Metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+        server.start(args.engine, args.max_connections, args.accept_queue)
+    finally:
+        audit_log.stop() 
\ No newline at end of file